@@ -1,6 +1,7 @@
 from knowledge import MODEL_KNOWLEDGE
 from functools import lru_cache
-from typing import Dict, List, Tuple
+from typing import Dict, List, Set, Tuple
+from utils import vxlog
 
 # Alias resolution
 @lru_cache(maxsize=1)
@@ -49,7 +50,9 @@ def get_deterministic(identified: List[dict] = []) -> float:
 
 SIGN_AGREEMENT_THRESHOLD = 0.2
 
-def calculate(identified_subjects: List[dict], llm_score: float, alpha: float = 0.5) -> Tuple[float, float, float]:
+# prescan_hits are the canonical names prescan.scan found in the description and transcript, when given
+# every subject is flagged with whether the text mentions it and KB entries the LLM missed are logged
+def calculate(identified_subjects: List[dict], llm_score: float, alpha: float = 0.5, prescan_hits: Set[str] = None) -> Tuple[float, float, float]:
     det_score = get_deterministic(identified_subjects)
 
     alignment_conflict = abs(det_score - llm_score)
@@ -80,10 +83,18 @@ def calculate(identified_subjects: List[dict], llm_score: float, alpha: float =
         kb_entry: dict = MODEL_KNOWLEDGE.get(canonical, {})
         
         subject["isInKnowledge"] = bool(kb_entry)
+        if prescan_hits is not None:
+            subject["isInPrescan"] = canonical in prescan_hits
  
         # Add knowledge base data to the subject
         subject["expected_alignment"] = float(kb_entry.get("alignment_tendency", 0.0))
         subject["alignment_score"] = stance * subject["expected_alignment"]
         subject["alignment_gap"] = abs(stance - subject["expected_alignment"])
 
+    if prescan_hits is not None:
+        identified = {_resolve_alias(subject.get("subject", "")) for subject in identified_subjects}
+        missed = sorted(prescan_hits - identified)
+        if missed:
+            vxlog.info(f"Pre-scan found knowledge base subjects the LLM did not identify: {', '.join(missed)}")
+
     return final_alignment, det_score, alignment_conflict
\ No newline at end of file
@@ -0,0 +1,58 @@
+import os
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Set
+
+from knowledge import MODEL_KNOWLEDGE
+from utils.aho_corasick import AhoCorasick
+
+# Entries at or above this weight are always sent to Gemini, whether the pre-scan found them or not
+GEMINI_KB_CORE_MIN_WEIGHT = float(os.getenv("GEMINI_KB_CORE_MIN_WEIGHT", "1.8"))
+# Extra canonical names that are always sent, comma separated
+GEMINI_KB_CORE = [name.strip().lower() for name in os.getenv("GEMINI_KB_CORE", "").split(",") if name.strip()]
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+# Lowercase, without diacritics (ș -> s, ă -> a) and with every run of non word characters as one
+# space. The text is padded with spaces so " name " only matches whole words
+def normalize(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return f" {_NON_WORD.sub(' ', stripped).strip()} "
+
+
+# Deterministic pre-scan of the description and transcript for every canonical name and alias
+@lru_cache(maxsize=1)
+def _build_matcher() -> AhoCorasick:
+    patterns: Dict[str, str] = {}
+    for canonical, data in MODEL_KNOWLEDGE.items():
+        canonical_lower = canonical.lower()
+        for name in [canonical_lower] + [alias.lower() for alias in data.get("aliases", [])]:
+            pattern = normalize(name)
+            if pattern.strip():
+                patterns[pattern] = canonical_lower
+    return AhoCorasick(patterns)
+
+
+# Canonical names of the knowledge base entries mentioned in any of the texts
+def scan(*texts: str) -> Set[str]:
+    matcher = _build_matcher()
+    hits: Set[str] = set()
+    for text in texts:
+        if text:
+            hits |= matcher.find_all(normalize(text))
+    return hits
+
+
+@lru_cache(maxsize=1)
+def _core() -> frozenset:
+    core = {canonical for canonical, data in MODEL_KNOWLEDGE.items() if float(data.get("weight", 1.0)) >= GEMINI_KB_CORE_MIN_WEIGHT}
+    return frozenset(core | {name for name in GEMINI_KB_CORE if name in MODEL_KNOWLEDGE})
+
+
+# The part of the knowledge base sent to Gemini for one video, the pre-scan hits plus the core entries
+def knowledge_subset(hits: Set[str]) -> dict:
+    names = _core() | set(hits)
+    return {canonical: data for canonical, data in MODEL_KNOWLEDGE.items() if canonical in names}
@@ -1,9 +1,121 @@
-from .transcriber import transcribe_audio
-from .sentiment import SentimentAnalyzer
+import os
+import time
+import numpy as np
 
-def process(audio_path: str):
-    transcript, lang, console_output = transcribe_audio(audio_path, model_name="ggml-large-v3.bin")
+from .transcriber import transcribe, transcribe_pcm, transcribe_audio, DEFAULT_MODEL_NAME
+from . import transcriber
+from .sentiment import SentimentAnalyzer, NO_SENTIMENT
+from .model_policy import ModelPolicy
+from . import vad
+from .pcm import read_wav, duration_seconds
+from utils import vxlog
 
-    text_sentiment_results = SentimentAnalyzer.get_sentiment(transcript, lang)
+# Run the VAD pre-pass for the speech ratio, silences are only trimmed with VAD_TRIM_SILENCE and
+# speech-free clips only skipped with VAD_SKIP_LOW_SPEECH
+VAD_ENABLED = os.getenv("VAD_ENABLED", "true").lower() in ("1", "true", "yes")
+# Pick the whisper model per video from the backlog and audio length instead of always using large-v3
+WHISPER_ADAPTIVE_MODEL = os.getenv("WHISPER_ADAPTIVE_MODEL", "false").lower() in ("1", "true", "yes")
+# Score every whisper segment as well, in the same sentiment batch as the full transcript
+SENTIMENT_TIMELINE = os.getenv("SENTIMENT_TIMELINE", "true").lower() in ("1", "true", "yes")
 
-    return transcript, lang, text_sentiment_results
\ No newline at end of file
+# audio is either a WAV path or a float32 PCM buffer from download.extract_pcm
+# Returns {"transcript", "lang", "sentiment", "sentiment_timeline", "speech_ratio", "whisper_model"},
+# speech_ratio is None when the VAD is disabled and whisper_model is None when transcription was skipped.
+# sentiment_timeline holds one [start, end, positive, negative, neutral] row per segment, times are
+# in seconds of the original audio, and is None when SENTIMENT_TIMELINE is disabled
+def process(audio):
+    speech_ratio = None
+    regions = None
+
+    if VAD_ENABLED:
+        pcm = audio if isinstance(audio, np.ndarray) else read_wav(audio)
+        mask = vad.speech_mask(pcm)
+        speech_ratio = vad.speech_ratio(mask)
+
+        if vad.VAD_SKIP_LOW_SPEECH and speech_ratio < vad.VAD_MIN_SPEECH_RATIO:
+            vxlog.info(f"Speech ratio {speech_ratio:.2f} is below {vad.VAD_MIN_SPEECH_RATIO}, skipping transcription and text sentiment")
+            return {
+                "transcript": "",
+                "lang": "unknown",
+                "sentiment": dict(NO_SENTIMENT),
+                "sentiment_timeline": [] if SENTIMENT_TIMELINE else None,
+                "speech_ratio": speech_ratio,
+                "whisper_model": None,
+            }
+
+        audio = pcm
+        if vad.VAD_TRIM_SILENCE and speech_ratio >= vad.VAD_MIN_SPEECH_RATIO:
+            trimmed, trimmed_regions = vad.trim_silence(pcm, mask)
+            if len(trimmed) >= (1.0 - vad.VAD_MAX_TRIM_RATIO) * len(pcm):
+                audio, regions = trimmed, trimmed_regions
+                vxlog.debug(f"Speech ratio {speech_ratio:.2f}, trimmed audio from {len(pcm) / 16000:.1f}s to {len(audio) / 16000:.1f}s")
+            else:
+                vxlog.debug(f"Speech ratio {speech_ratio:.2f}, trimming would keep {len(trimmed) / 16000:.1f}s of {len(pcm) / 16000:.1f}s, transcribing the whole audio")
+
+    transcription, model_name = _transcribe_with_policy(audio)
+    transcript, lang = transcription["transcript"], transcription["language"]
+
+    segments = [segment for segment in transcription.get("segments", []) if segment["text"]] if SENTIMENT_TIMELINE else []
+    sentiments = SentimentAnalyzer.get_sentiment_batch([(transcript, lang)] + [(segment["text"], lang) for segment in segments])
+    text_sentiment_results = sentiments[0]
+
+    sentiment_timeline = None
+    if SENTIMENT_TIMELINE:
+        sentiment_timeline = _sentiment_timeline(segments, sentiments[1:], regions)
+
+    return {
+        "transcript": transcript,
+        "lang": lang,
+        "sentiment": text_sentiment_results,
+        "sentiment_timeline": sentiment_timeline,
+        "speech_ratio": speech_ratio,
+        "whisper_model": model_name,
+    }
+
+
+# Segment times are shifted back to the original audio when the VAD trimmed silences out of it
+def _sentiment_timeline(segments: list, sentiments: list, regions) -> list:
+    timeline = []
+    for segment, sentiment in zip(segments, sentiments):
+        start, end = segment["start"], segment["end"]
+        if regions:
+            start, end = vad.to_original_time(start, regions), vad.to_original_time(end, regions)
+        timeline.append([
+            round(start, 2), round(end, 2),
+            round(sentiment["positive"], 4), round(sentiment["negative"], 4), round(sentiment["neutral"], 4)
+        ])
+    return timeline
+
+
+# Returns the transcription and the whisper model that actually ran
+def _transcribe_with_policy(audio):
+    # An external whisper-server runs its own model, there is nothing to choose
+    if not WHISPER_ADAPTIVE_MODEL or transcriber.uses_external_server():
+        transcription = transcribe(audio, model_name=DEFAULT_MODEL_NAME)
+        return transcription, transcription.get("model", DEFAULT_MODEL_NAME)
+
+    if not isinstance(audio, np.ndarray):
+        audio = read_wav(audio)
+    duration = duration_seconds(audio)
+    started_at = time.monotonic()
+
+    model_name = ModelPolicy.select(duration)
+    transcription = _timed_transcribe(audio, model_name, duration)
+
+    # At most one retry on a larger model, and only while the SLO allows it
+    escalated_model = ModelPolicy.escalate(model_name, transcription["language"], duration, time.monotonic() - started_at)
+    if escalated_model is not None:
+        vxlog.info(f"Detected language {transcription['language']} is not trusted on {model_name}, retrying with {escalated_model}")
+        model_name = escalated_model
+        transcription = _timed_transcribe(audio, model_name, duration)
+
+    return transcription, transcription.get("model", model_name)
+
+
+# The real time factor only measures the transcription, a whisper-server that still has to load its model is started first
+def _timed_transcribe(audio: np.ndarray, model_name: str, duration: float) -> dict:
+    transcriber.warm_up(audio, model_name)
+    started_at = time.monotonic()
+    transcription = transcribe(audio, model_name=model_name)
+    ModelPolicy.record(model_name, duration, time.monotonic() - started_at)
+    return transcription
@@ -0,0 +1,110 @@
+import os
+import threading
+from collections import OrderedDict
+
+from utils import vxlog
+
+# RAM the resident sentiment models may use together, 0 disables the budget
+SENTIMENT_MODEL_BUDGET_MB = float(os.getenv("SENTIMENT_MODEL_BUDGET_MB", "2048"))
+# Keep the english model loaded, it is the fallback for every unsupported language
+SENTIMENT_PIN_FALLBACK = os.getenv("SENTIMENT_PIN_FALLBACK", "true").lower() in ("1", "true", "yes")
+
+
+# Approximate resident size of a loaded model in bytes
+def model_size(model) -> int:
+    if hasattr(model, "parameters"):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    # ONNX Runtime sessions keep roughly the model file in memory
+    path = getattr(model, "path", None)
+    if path and os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+class _ModelManager:
+    """
+    Keeps the loaded (model, tokenizer) pairs under a RAM budget. The least recently used model is
+    unloaded first when a new one does not fit, pinned models are never unloaded.
+    """
+
+    def __init__(self, budget_mb: float):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.pinned = set()
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, model_name: str) -> bool:
+        return model_name in self._entries
+
+    def pin(self, model_name: str):
+        self.pinned.add(model_name)
+
+    def get(self, model_name: str):
+        with self._lock:
+            entry = self._entries.get(model_name)
+            if entry is not None:
+                self._entries.move_to_end(model_name)
+            return entry
+
+    def put(self, model_name: str, model, tokenizer):
+        size = model_size(model)
+        with self._lock:
+            self._entries[model_name] = (model, tokenizer)
+            self._sizes[model_name] = size
+            self._usage_for(model_name)["loads"] += 1
+            evicted = self._evict(keep=model_name)
+        vxlog.debug(f"Loaded sentiment model {model_name} ({size / 1024 / 1024:.0f} MB), {self.resident_bytes() / 1024 / 1024:.0f} MB resident")
+        # Models that keep getting evicted and loaded again mean the budget is too small for the language mix
+        if evicted:
+            self.log_usage()
+
+    def record_use(self, model_name: str, lang: str, texts: int):
+        with self._lock:
+            usage = self._usage_for(model_name)
+            usage["requests"] += 1
+            usage["texts"] += texts
+            usage["languages"][lang] = usage["languages"].get(lang, 0) + texts
+
+    def resident_bytes(self) -> int:
+        return sum(self._sizes.get(model_name, 0) for model_name in list(self._entries))
+
+    # Per model counters of requests, scored texts, loads, evictions and texts per requested language
+    def usage_stats(self) -> dict:
+        with self._lock:
+            return {model_name: dict(usage, languages=dict(usage["languages"])) for model_name, usage in self._usage.items()}
+
+    def log_usage(self):
+        for model_name, usage in self.usage_stats().items():
+            languages = ", ".join(f"{lang}: {texts}" for lang, texts in sorted(usage["languages"].items()))
+            vxlog.info(
+                f"Sentiment model {model_name}: {usage['requests']} requests, {usage['texts']} texts ({languages}), "
+                f"loaded {usage['loads']} times, evicted {usage['evictions']} times"
+            )
+
+    def _usage_for(self, model_name: str) -> dict:
+        return self._usage.setdefault(model_name, {"requests": 0, "texts": 0, "loads": 0, "evictions": 0, "languages": {}})
+
+    # Returns the number of unloaded models
+    def _evict(self, keep: str) -> int:
+        if self.budget_bytes <= 0:
+            return 0
+
+        resident = sum(self._sizes.get(model_name, 0) for model_name in self._entries)
+        evicted = 0
+        # Oldest first
+        for model_name in list(self._entries):
+            if resident <= self.budget_bytes:
+                break
+            if model_name == keep or model_name in self.pinned:
+                continue
+
+            del self._entries[model_name]
+            resident -= self._sizes.pop(model_name, 0)
+            usage = self._usage_for(model_name)
+            usage["evictions"] += 1
+            vxlog.info(f"Unloaded sentiment model {model_name} to stay under {self.budget_bytes / 1024 / 1024:.0f} MB, it served {usage['texts']} texts and was loaded {usage['loads']} times")
+            evicted += 1
+        return evicted
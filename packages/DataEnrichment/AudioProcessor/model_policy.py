@@ -0,0 +1,88 @@
+import os
+import threading
+
+from utils import vxlog
+
+# Whisper models from the most to the least accurate, as name:real_time_factor where the real time
+# factor is the expected seconds of compute per second of audio on this host. The factors are only
+# the starting point, they are replaced by measured averages as videos get transcribed
+WHISPER_MODEL_TIERS = os.getenv(
+    "WHISPER_MODEL_TIERS",
+    "ggml-large-v3.bin:0.6,ggml-medium.bin:0.3,ggml-small-q5_1.bin:0.1"
+)
+# Target for backlog wait + transcription time of a video, smaller models are picked to stay under it
+WHISPER_LATENCY_SLO_SECONDS = float(os.getenv("WHISPER_LATENCY_SLO_SECONDS", "300"))
+# Languages the smaller tiers transcribe well enough, others are escalated one tier up when the SLO
+# allows it. Most of the videos are Romanian, escalating them would transcribe most videos twice
+WHISPER_SMALL_MODEL_LANGS = [lang.strip() for lang in os.getenv("WHISPER_SMALL_MODEL_LANGS", "ro,en").split(",") if lang.strip()]
+
+# Weight of the newest measurement in the running averages
+_SMOOTHING = 0.2
+
+
+class _ModelPolicy:
+    def __init__(self, tiers: str):
+        self.tiers = []
+        self.real_time_factors = {}
+        for tier in tiers.split(","):
+            name, _, factor = tier.strip().partition(":")
+            self.tiers.append(name)
+            self.real_time_factors[name] = float(factor or 1.0)
+
+        self.average_duration = 30.0
+        self._queue_depth_source = None
+        self._lock = threading.Lock()
+
+    # The worker registers a callable returning how many videos are waiting for this process
+    def set_queue_depth_source(self, source):
+        self._queue_depth_source = source
+
+    def queue_depth(self) -> int:
+        if self._queue_depth_source is None:
+            return 0
+        try:
+            return max(0, int(self._queue_depth_source()))
+        except Exception as e:
+            vxlog.warning(f"Could not read the queue depth for model selection: {e}")
+            return 0
+
+    # Estimated seconds until this video is transcribed by model_name, including the videos waiting before it
+    def _estimated_latency(self, model_name: str, duration: float, queue_depth: int) -> float:
+        return (duration + queue_depth * self.average_duration) * self.real_time_factors[model_name]
+
+    # Picks the most accurate model whose estimated latency for this video fits the SLO
+    def select(self, duration: float) -> str:
+        queue_depth = self.queue_depth()
+
+        for model_name in self.tiers:
+            if self._estimated_latency(model_name, duration, queue_depth) <= WHISPER_LATENCY_SLO_SECONDS:
+                break
+
+        if model_name != self.tiers[0]:
+            vxlog.info(f"Using {model_name} for {duration:.0f}s of audio with {queue_depth} videos waiting")
+        return model_name
+
+    # Returns the next more accurate model when the detected language is not trusted on this tier and
+    # the time already spent (elapsed) plus the larger model still fit the SLO, None otherwise
+    def escalate(self, model_name: str, lang: str, duration: float, elapsed: float):
+        index = self.tiers.index(model_name) if model_name in self.tiers else 0
+        if index == 0 or lang in WHISPER_SMALL_MODEL_LANGS:
+            return None
+
+        escalated_model = self.tiers[index - 1]
+        estimated_latency = elapsed + self._estimated_latency(escalated_model, duration, self.queue_depth())
+        if estimated_latency > WHISPER_LATENCY_SLO_SECONDS:
+            vxlog.info(f"Keeping the {model_name} transcript of {lang}, {escalated_model} would take about {estimated_latency:.0f}s")
+            return None
+        return escalated_model
+
+    def record(self, model_name: str, duration: float, elapsed: float):
+        if duration <= 0:
+            return
+        with self._lock:
+            self.average_duration += _SMOOTHING * (duration - self.average_duration)
+            factor = self.real_time_factors.get(model_name, elapsed / duration)
+            self.real_time_factors[model_name] = factor + _SMOOTHING * (elapsed / duration - factor)
+
+
+ModelPolicy = _ModelPolicy(WHISPER_MODEL_TIERS)
@@ -0,0 +1,108 @@
+import os
+import threading
+import numpy as np
+
+from utils import vxlog
+
+try:
+    import onnxruntime
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+    onnxruntime = None
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+onnx_models_dir = os.path.abspath(os.path.join(script_dir, "support", "onnx"))
+
+# Intra-op threads of every ONNX Runtime session, 0 lets ONNX Runtime use all cores
+SENTIMENT_ONNX_THREADS = int(os.getenv("SENTIMENT_ONNX_THREADS", "0"))
+
+_export_lock = threading.Lock()
+# Intra-op threads of sessions created from now on, lowered by limit_threads in forked workers
+_session_threads = SENTIMENT_ONNX_THREADS
+
+
+def available() -> bool:
+    return onnxruntime is not None
+
+
+def model_dir(model_name: str) -> str:
+    return os.path.join(onnx_models_dir, model_name.replace("/", "__"))
+
+
+def quantized_path(model_name: str) -> str:
+    return os.path.join(model_dir(model_name), "model.int8.onnx")
+
+
+class OnnxSequenceClassifier:
+    """
+    Int8 quantized export of a transformers sequence classifier served by ONNX Runtime.
+    logits() takes the tokenizer output and returns the same logits as the PyTorch model
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = _session_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def logits(self, encoded_input) -> np.ndarray:
+        feed = {name: encoded_input[name].numpy().astype(np.int64) for name in self.input_names}
+        return self.session.run(None, feed)[0]
+
+
+# Caps the threads of every session created afterwards, an explicit SENTIMENT_ONNX_THREADS stays the upper bound
+def limit_threads(num_threads: int):
+    global _session_threads
+    num_threads = max(1, num_threads)
+    _session_threads = min(SENTIMENT_ONNX_THREADS, num_threads) if SENTIMENT_ONNX_THREADS > 0 else num_threads
+
+
+# Exports and quantizes the PyTorch model when the int8 model is not on disk yet, without creating a
+# session. load_torch_model is only called for the export
+def prepare(model_name: str, tokenizer, load_torch_model) -> str:
+    path = quantized_path(model_name)
+
+    with _export_lock:
+        if not os.path.exists(path):
+            _export(model_name, tokenizer, load_torch_model(), path)
+
+    return path
+
+
+# Loads the cached int8 model, exporting it first when needed
+def load(model_name: str, tokenizer, load_torch_model) -> OnnxSequenceClassifier:
+    return OnnxSequenceClassifier(prepare(model_name, tokenizer, load_torch_model))
+
+
+def _export(model_name: str, tokenizer, model, path: str):
+    import torch
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    full_precision_path = os.path.join(os.path.dirname(path), "model.onnx")
+    vxlog.info(f"Exporting sentiment model {model_name} to ONNX")
+
+    sample = tokenizer(["sample text", "a second, longer sample text"], return_tensors="pt", padding=True)
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    model.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in input_names),
+            full_precision_path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+    # Written under a temporary name so a crash never leaves a half quantized model behind
+    partial_path = f"{path}.part-{os.getpid()}"
+    quantize_dynamic(full_precision_path, partial_path, weight_type=QuantType.QInt8)
+    os.replace(partial_path, path)
+    os.remove(full_precision_path)
+    vxlog.info(f"Saved int8 ONNX model {model_name} → {path}")
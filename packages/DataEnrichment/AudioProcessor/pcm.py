@@ -0,0 +1,36 @@
+import io
+import wave
+import numpy as np
+
+# Whisper expects 16 kHz mono audio
+SAMPLE_RATE = 16000
+
+
+# Encodes float32 samples in [-1, 1] as an in-memory 16 bit PCM WAV file
+def to_wav_bytes(pcm: np.ndarray, sample_rate: int = SAMPLE_RATE) -> bytes:
+    samples = np.clip(pcm, -1.0, 1.0)
+    samples = (samples * 32767.0).astype("<i2")
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+# Decodes raw little endian 16 bit PCM (ffmpeg -f s16le) to float32 samples
+def from_s16le(raw: bytes) -> np.ndarray:
+    return np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768.0
+
+
+def read_wav(path: str) -> np.ndarray:
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2 or wav.getnchannels() != 1:
+            raise ValueError(f"Expected 16 bit mono WAV, got {wav.getsampwidth() * 8} bit with {wav.getnchannels()} channels: {path}")
+        return from_s16le(wav.readframes(wav.getnframes()))
+
+
+def duration_seconds(pcm: np.ndarray, sample_rate: int = SAMPLE_RATE) -> float:
+    return len(pcm) / float(sample_rate)
@@ -1,12 +1,20 @@
 from transformers import AutoModelForSequenceClassification
 from transformers import AutoTokenizer
+from transformers import AutoConfig
 from scipy.special import softmax
+import torch
 
 import os
+import hashlib
+import unicodedata
+import threading
 import numpy as np
 import warnings
 import logging
 from utils import vxlog
+from utils.kv_cache import KVCache
+from . import onnx_backend
+from .model_manager import _ModelManager, SENTIMENT_MODEL_BUDGET_MB, SENTIMENT_PIN_FALLBACK
 
 # Suppress transformers library warnings about unused model weights
 logging.getLogger("transformers.modeling_utils").setLevel(logging.ERROR)
@@ -18,18 +26,53 @@ warnings.filterwarnings("ignore", message=".*encoder_attention_mask.*")
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
+# Texts per forward pass in get_sentiment_batch
+SENTIMENT_BATCH_SIZE = int(os.getenv("SENTIMENT_BATCH_SIZE", "16"))
+
+# Tokens shared by consecutive windows of a transcript longer than the 512 token model limit
+SENTIMENT_WINDOW_STRIDE = int(os.getenv("SENTIMENT_WINDOW_STRIDE", "128"))
+
+# "torch" runs the full precision models, "onnx" int8 quantized exports through ONNX Runtime
+SENTIMENT_BACKEND = os.getenv("SENTIMENT_BACKEND", "torch")
+
+SENTIMENT_CACHE = os.getenv("SENTIMENT_CACHE", "true").lower() in ("1", "true", "yes")
+SENTIMENT_CACHE_MAX_ENTRIES = int(os.getenv("SENTIMENT_CACHE_MAX_ENTRIES", "100000"))
+SENTIMENT_CACHE_TTL_DAYS = float(os.getenv("SENTIMENT_CACHE_TTL_DAYS", "30"))
+
+NO_SENTIMENT = {"positive": 0.0, "neutral": 0.0, "negative": 0.0}
+
+
+# Averages the window scores of every text, weighted by the number of real tokens in each window
+def _aggregate_windows(window_scores: np.ndarray, window_to_text: np.ndarray, window_tokens: np.ndarray, text_count: int) -> np.ndarray:
+    weights = np.asarray(window_tokens, dtype=np.float64)
+    totals = np.zeros((text_count, window_scores.shape[1]))
+    np.add.at(totals, window_to_text, window_scores * weights[:, None])
+    weight_sums = np.zeros(text_count)
+    np.add.at(weight_sums, window_to_text, weights)
+    return totals / np.maximum(weight_sums, 1e-10)[:, None]
+
 # This is a sentiment analyzer that uses specifc models for en, fr, de, ro
 
 class _SentimentAnalyzer:
     def __init__(self):
-        self.loaded_models = {}
-        self.loaded_tokenizers = {}
+        # Loaded (model, tokenizer) pairs, least recently used ones are unloaded over the RAM budget
+        self.loaded_models = _ModelManager(SENTIMENT_MODEL_BUDGET_MB)
+        # Guards lazy model loading when several pipeline workers ask for a model at once
+        self._load_lock = threading.Lock()
+        self.backend = SENTIMENT_BACKEND
+        if self.backend == "onnx" and not onnx_backend.available():
+            vxlog.warning("SENTIMENT_BACKEND is onnx but onnxruntime is not installed (requirements-onnx.txt). Using torch")
+            self.backend = "torch"
         self.model_map = {
             'en': 'cardiffnlp/twitter-roberta-base-sentiment-latest',
             'de': 'oliverguhr/german-sentiment-bert',
             'ro': 'DGurgurov/xlm-r_romanian_sentiment',
         }
+        if SENTIMENT_PIN_FALLBACK:
+            self.loaded_models.pin(self.model_map["en"])
         self.id2label_maps = {}
+        # Scores of already seen transcripts, shared by all workers on the host
+        self.cache = KVCache("sentiment", SENTIMENT_CACHE_MAX_ENTRIES, SENTIMENT_CACHE_TTL_DAYS * 86400) if SENTIMENT_CACHE else None
         self.label_translation_map = {
             'cardiffnlp/twitter-roberta-base-sentiment-latest': {
                 'positive': 'positive',
@@ -66,10 +109,16 @@ class _SentimentAnalyzer:
         if model_name not in self.loaded_models:
             vxlog.debug(f"Loading model {self.model_map[lang]} for language {lang}")
             try:
-                self.loaded_tokenizers[model_name] = AutoTokenizer.from_pretrained(model_name)
-                model = AutoModelForSequenceClassification.from_pretrained(model_name)
-                self.loaded_models[model_name] = model
-                self.id2label_maps[model_name] = model.config.id2label
+                tokenizer = AutoTokenizer.from_pretrained(model_name)
+                if self.backend == "onnx":
+                    # The PyTorch weights are only loaded when the ONNX export is not cached yet
+                    model = onnx_backend.load(model_name, tokenizer, lambda: AutoModelForSequenceClassification.from_pretrained(model_name))
+                    id2label = AutoConfig.from_pretrained(model_name).id2label
+                else:
+                    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+                    id2label = model.config.id2label
+                self.id2label_maps[model_name] = id2label
+                self.loaded_models.put(model_name, model, tokenizer)
                 vxlog.debug(f"Successfully loaded model {model_name}")
             except Exception as e:
                 vxlog.error(f"An error occurred when tryng to load model {model_name} {e}")
@@ -77,71 +126,178 @@ class _SentimentAnalyzer:
                 return None, None
         
 
-    def _get_model(self, lang: str):
+    def _get_model(self, lang: str, texts: int = 0):
+        with self._load_lock:
+            model_name, model, tokenizer = self._get_model_unlocked(lang)
+        self.loaded_models.record_use(model_name, lang, texts)
+        return model, tokenizer
+
+    def _get_model_unlocked(self, lang: str):
         # Check if the model is already loaded
         model_name = self.model_map[lang]
-        if model_name not in self.loaded_models:
+        entry = self.loaded_models.get(model_name)
+        if entry is None:
             self._load_model(lang)
+            entry = self.loaded_models.get(model_name)
 
         # Check if the model succesfully loaded
-        if model_name not in self.loaded_models:
+        if entry is None:
             # Default to the english model if it failed to load
-            universal_model_name = self.model_map["en"]
-            if universal_model_name not in self.loaded_models:
+            model_name = self.model_map["en"]
+            entry = self.loaded_models.get(model_name)
+            if entry is None:
                 self._load_model("en")
+                entry = self.loaded_models.get(model_name)
             
             # If english model also fails to load then we stop
-            if universal_model_name not in self.loaded_models:
+            if entry is None:
                  raise RuntimeError("Critical error: Default English sentiment model failed to load.")
 
-            return self.loaded_models[universal_model_name], self.loaded_tokenizers[universal_model_name]
+        model, tokenizer = entry
+        return model_name, model, tokenizer
+
 
+    # Loads the models up front, used by the supervisor so forked workers share the weights.
+    # ONNX Runtime sessions are not fork safe, for the onnx backend only the int8 exports are written
+    # here and every worker creates its own sessions
+    def preload(self, langs: list = None):
+        for lang in langs or list(self.model_map.keys()):
+            if lang not in self.model_map:
+                continue
+            if self.backend == "onnx":
+                self._prepare_onnx(lang)
+            else:
+                self._get_model(lang)
 
-        return self.loaded_models[model_name], self.loaded_tokenizers[model_name]
+    def _prepare_onnx(self, lang: str):
+        model_name = self.model_map[lang]
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            onnx_backend.prepare(model_name, tokenizer, lambda: AutoModelForSequenceClassification.from_pretrained(model_name))
+        except Exception as e:
+            vxlog.error(f"An error occurred when tryng to export model {model_name} {e}")
 
+    # Caps the torch and ONNX Runtime intra-op threads so that several worker processes do not
+    # oversubscribe the cores. ONNX sessions created before the call keep their thread count
+    def limit_threads(self, num_threads: int):
+        torch.set_num_threads(max(1, num_threads))
+        onnx_backend.limit_threads(num_threads)
 
     def get_sentiment(self, transcription: str, lang: str):
-        lang = self._check_lang(lang)
+        return self.get_sentiment_batch([(transcription, lang)])[0]
 
-        model, tokenizer = self._get_model(lang)
-        model_name = self.model_map[lang]
+    # Scores many (text, lang) pairs, texts of the same model share padded forward passes.
+    # Results come back in input order
+    def get_sentiment_batch(self, items: list) -> list:
+        results = [None] * len(items)
 
-        try:
-            encoded_input = tokenizer(transcription, return_tensors='pt', truncation=True, max_length=512) 
-            output = model(**encoded_input)
+        groups = {}
+        for index, (text, lang) in enumerate(items):
+            groups.setdefault(self._check_lang(lang), []).append(index)
+
+        for lang, indices in groups.items():
+            if self.cache is not None:
+                indices = self._from_cache(items, indices, lang, results)
+                if not indices:
+                    continue
 
-            scores = output[0][0].detach().numpy()
-            scores = softmax(scores)
+            model, tokenizer = self._get_model(lang, texts=len(indices))
+            # The english model stands in when the language model failed to load
+            model_name = self.model_map.get(lang, self.model_map["en"])
 
+            try:
+                scores = self._score_windows(model, tokenizer, [items[index][0] for index in indices])
+            except Exception as e:
+                vxlog.error(f"An Error occured during sentiment analysis {e}")
+                continue
             vxlog.debug(f"SENTIMENT MODEL SCORES {scores}")
 
-            # Get the correct mappings for the current model
-            id2label = self.id2label_maps[model_name]
-            translator = self.label_translation_map[model_name]
+            for index, row in zip(indices, scores):
+                if row is None:
+                    continue
+                results[index] = self._to_standard_labels(model_name, row)
+                if self.cache is not None:
+                    self.cache.set(self._cache_key(items[index][0], lang, model_name), results[index])
 
-            # Initialize results with all sentiments at 0.0
-            sentiment_results = {
-                "positive": 0.0,
-                "neutral": 0.0,
-                "negative": 0.0
-            }
+        return [result if result is not None else dict(NO_SENTIMENT) for result in results]
 
-            
-            # Map scores to their standard labels
-            for i in range(len(scores)):
-                model_label = id2label[i]
-                standard_label = translator.get(model_label)
-                if standard_label:
-                    sentiment_results[standard_label] = float(scores[i])
+    # Texts over 512 tokens are cut into overlapping windows. The windows of all texts are batched
+    # together, SENTIMENT_BATCH_SIZE windows per forward pass however long the texts are, and the
+    # window scores are averaged per text. A text whose windows failed gets None
+    def _score_windows(self, model, tokenizer, texts: list) -> list:
+        encoded = tokenizer(
+            texts,
+            truncation=True,
+            max_length=512,
+            stride=SENTIMENT_WINDOW_STRIDE,
+            return_overflowing_tokens=True,
+        )
+        window_to_text = np.array(encoded.pop("overflow_to_sample_mapping"))
+        window_count = len(window_to_text)
 
-            return sentiment_results
+        # Windows of similar length go in the same batch so little of it is padding
+        order = sorted(range(window_count), key=lambda window: len(encoded["input_ids"][window]))
+        window_tokens = np.array([len(input_ids) for input_ids in encoded["input_ids"]])
+        window_scores = None
+        failed = np.zeros(window_count, dtype=bool)
+
+        for batch_start in range(0, window_count, SENTIMENT_BATCH_SIZE):
+            batch = order[batch_start:batch_start + SENTIMENT_BATCH_SIZE]
+            try:
+                encoded_input = tokenizer.pad({key: [encoded[key][window] for window in batch] for key in encoded.keys()}, return_tensors='pt')
+                batch_scores = softmax(self._logits(model, encoded_input), axis=1)
+                if window_scores is None:
+                    window_scores = np.zeros((window_count, batch_scores.shape[1]))
+                window_scores[batch] = batch_scores
+            except Exception as e:
+                vxlog.error(f"An Error occured during sentiment analysis {e}")
+                failed[batch] = True
+
+        if window_scores is None:
+            return [None] * len(texts)
+        scores = _aggregate_windows(window_scores, window_to_text, window_tokens, len(texts))
+        failed_texts = set(window_to_text[failed].tolist())
+        return [None if index in failed_texts else row for index, row in enumerate(scores)]
+
+    # Fills results for the cached texts and returns the indices that still have to be scored
+    def _from_cache(self, items: list, indices: list, lang: str, results: list) -> list:
+        model_name = self.model_map.get(lang, self.model_map["en"])
+        missing = []
+        for index in indices:
+            cached = self.cache.get(self._cache_key(items[index][0], lang, model_name))
+            if cached is None:
+                missing.append(index)
+            else:
+                results[index] = cached
+        return missing
+
+    # Reposts often share the transcript up to whitespace, the backend and window stride change the scores
+    def _cache_key(self, text: str, lang: str, model_name: str) -> str:
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        text_hash = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"{model_name}:{self.backend}:{SENTIMENT_WINDOW_STRIDE}:{lang}:{text_hash}"
+
+    def _logits(self, model, encoded_input) -> np.ndarray:
+        if isinstance(model, onnx_backend.OnnxSequenceClassifier):
+            return model.logits(encoded_input)
+        with torch.inference_mode():
+            return model(**encoded_input).logits.numpy()
+
+    # Maps the scores of one text from the model labels to positive / neutral / negative
+    def _to_standard_labels(self, model_name: str, scores) -> dict:
+        # Get the correct mappings for the current model
+        id2label = self.id2label_maps[model_name]
+        translator = self.label_translation_map[model_name]
+
+        # Initialize results with all sentiments at 0.0
+        sentiment_results = dict(NO_SENTIMENT)
+
+        for i in range(len(scores)):
+            model_label = id2label[i]
+            standard_label = translator.get(model_label)
+            if standard_label:
+                sentiment_results[standard_label] = float(scores[i])
+
+        return sentiment_results
 
-        except Exception as e:
-            vxlog.error(f"An Error occured during sentiment analysis {e}")
-            return {
-                "positive": 0.0,
-                "neutral": 0.0,
-                "negative": 0.0
-            }
-            
 SentimentAnalyzer = _SentimentAnalyzer()
\ No newline at end of file
@@ -1,9 +1,17 @@
 import subprocess
 import os
+import json
+import tempfile
+import numpy as np
 from typing import Tuple
 import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import vxlog
+from . import whisper_server
+from . import vad
+from .pcm import SAMPLE_RATE, to_wav_bytes, read_wav, duration_seconds
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 whisper_cpp_dir = os.path.abspath(os.path.join(script_dir, "support", "whisper.cpp"))
@@ -11,10 +19,143 @@ models_dir = os.path.join(whisper_cpp_dir, "models")
 
 DEFAULT_MODEL_NAME = "ggml-large-v3.bin"
 
+# "cli" spawns whisper-cli for every file, "server" keeps the model resident in a whisper-server
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "cli")
+
+# whisper-cli only reads files, buffers are written to a memory backed directory when it exists
+PCM_SCRATCH_DIR = os.getenv("PCM_SCRATCH_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+# Long audio is cut at silences and the chunks are transcribed by parallel whisper-cli processes
+WHISPER_CHUNKED = os.getenv("WHISPER_CHUNKED", "false").lower() in ("1", "true", "yes")
+# Only audio longer than this is chunked, below it the process start and model load dominate
+WHISPER_CHUNK_MIN_SECONDS = float(os.getenv("WHISPER_CHUNK_MIN_SECONDS", "180"))
+WHISPER_CHUNK_SECONDS = float(os.getenv("WHISPER_CHUNK_SECONDS", "60"))
+# whisper-cli processes per long video, the cores are split evenly between them
+WHISPER_PARALLEL_CHUNKS = int(os.getenv("WHISPER_PARALLEL_CHUNKS", str(max(1, (os.cpu_count() or 1) // 4))))
+
+
+# Returns {"transcript", "language", "segments": [{"start", "end", "text"}], "model"}, times are in
+# seconds and model is the whisper model that actually ran. audio is either the path of a 16 kHz
+# mono WAV or a float32 PCM buffer
+def transcribe(audio, model_name=DEFAULT_MODEL_NAME) -> dict:
+    if isinstance(audio, np.ndarray):
+        return transcribe_pcm(audio, model_name)
+
+    audio_path = audio
+    if WHISPER_CHUNKED:
+        pcm = read_wav(audio_path)
+        if _should_chunk(pcm):
+            return transcribe_chunked(pcm, model_name)
+
+    if WHISPER_BACKEND == "server":
+        vxlog.info(f"Transcribing with resident whisper-server model {model_name}")
+        with open(audio_path, "rb") as f:
+            return whisper_server.get_server(model_name).transcribe(f.read(), os.path.basename(audio_path))
+
+    result, _console_output = _transcribe_cli(audio_path, model_name)
+    return result
+
+
+def transcribe_pcm(pcm: np.ndarray, model_name=DEFAULT_MODEL_NAME) -> dict:
+    if _should_chunk(pcm):
+        return transcribe_chunked(pcm, model_name)
+
+    if WHISPER_BACKEND == "server":
+        vxlog.info(f"Transcribing in-memory audio with resident whisper-server model {model_name}")
+        return whisper_server.get_server(model_name).transcribe(to_wav_bytes(pcm))
+
+    with tempfile.TemporaryDirectory(dir=PCM_SCRATCH_DIR) as scratch_dir:
+        audio_path = os.path.join(scratch_dir, "audio.wav")
+        with open(audio_path, "wb") as f:
+            f.write(to_wav_bytes(pcm))
+
+        result, _console_output = _transcribe_cli(audio_path, model_name)
+        return result
+
+
 def transcribe_audio(audio_path: str, model_name=DEFAULT_MODEL_NAME):
+    if WHISPER_BACKEND == "server" or WHISPER_CHUNKED:
+        result = transcribe(audio_path, model_name)
+        return result["transcript"], result["language"], ""
+
+    result, console_output = _transcribe_cli(audio_path, model_name)
+    return result["transcript"], result["language"], console_output
+
+
+# Whether every transcription goes to an external whisper-server, whichever model is asked for
+def uses_external_server() -> bool:
+    return WHISPER_BACKEND == "server" and bool(whisper_server.WHISPER_SERVER_URL)
+
+
+# Starts the resident server of the model ahead of a timed transcription, so the model load is not
+# counted as transcription time
+def warm_up(pcm: np.ndarray, model_name=DEFAULT_MODEL_NAME):
+    if WHISPER_BACKEND == "server" and not _should_chunk(pcm):
+        whisper_server.get_server(model_name).ensure_running()
+
+
+def _should_chunk(pcm: np.ndarray) -> bool:
+    return WHISPER_CHUNKED and duration_seconds(pcm) >= WHISPER_CHUNK_MIN_SECONDS
+
+
+# Splits the audio at silences near every WHISPER_CHUNK_SECONDS and transcribes the chunks in
+# parallel whisper-cli processes. The chunks always go through the cli, a single whisper-server
+# handles one request at a time and would serialize them again
+def transcribe_chunked(pcm: np.ndarray, model_name=DEFAULT_MODEL_NAME) -> dict:
+    mask = vad.speech_mask(pcm)
+    # The cut search window stays well inside short chunks
+    search_seconds = min(10.0, WHISPER_CHUNK_SECONDS / 4)
+    boundaries = [0] + vad.split_points(mask, len(pcm), WHISPER_CHUNK_SECONDS, search_seconds) + [len(pcm)]
+    chunks = list(zip(boundaries[:-1], boundaries[1:]))
+
+    parallel = max(1, min(WHISPER_PARALLEL_CHUNKS, len(chunks)))
+    threads = max(1, (os.cpu_count() or 1) // parallel)
+    vxlog.info(f"Transcribing {duration_seconds(pcm):.0f}s of audio as {len(chunks)} chunks, {parallel} whisper-cli processes with {threads} threads each")
+
+    with tempfile.TemporaryDirectory(dir=PCM_SCRATCH_DIR) as scratch_dir:
+        def transcribe_chunk(index):
+            start, end = chunks[index]
+            audio_path = os.path.join(scratch_dir, f"chunk-{index}.wav")
+            with open(audio_path, "wb") as f:
+                f.write(to_wav_bytes(pcm[start:end]))
+            result, _console_output = _transcribe_cli(audio_path, model_name, threads=threads)
+            return result
+
+        # The threads only wait on the whisper-cli processes, the work runs in those processes
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = list(executor.map(transcribe_chunk, range(len(chunks))))
+
+    result = stitch_chunks(results, [start / SAMPLE_RATE for start, _end in chunks], [(end - start) / SAMPLE_RATE for start, end in chunks])
+    result["model"] = model_name
+    return result
+
+
+# Joins chunk transcriptions in order, shifting segment times by the chunk offsets. The language
+# is the one detected for most of the audio
+def stitch_chunks(results: list, offsets: list, durations: list) -> dict:
+    segments = []
+    language_seconds = Counter()
+    for result, offset, duration in zip(results, offsets, durations):
+        for segment in result["segments"]:
+            segments.append({
+                "start": segment["start"] + offset,
+                "end": segment["end"] + offset,
+                "text": segment["text"],
+            })
+        if result["language"] != "unknown":
+            language_seconds[result["language"]] += duration
+
+    return {
+        "transcript": "\n".join(segment["text"] for segment in segments if segment["text"]).strip(),
+        "language": language_seconds.most_common(1)[0][0] if language_seconds else "unknown",
+        "segments": segments,
+    }
+
+
+def _transcribe_cli(audio_path: str, model_name: str, threads: int = None):
     model_path = os.path.join(models_dir, model_name)
     executable_path = os.path.join(whisper_cpp_dir, "build", "bin", "whisper-cli")
-    
+
     vxlog.info(f"Starting transcriber model {model_name}")
 
     command = [
@@ -22,28 +163,33 @@ def transcribe_audio(audio_path: str, model_name=DEFAULT_MODEL_NAME):
         "-m", model_path,
         "-f", audio_path,
         "-l", "auto",
-        "-otxt" # write the transcription to a .txt files
+        "-oj" # write the transcription with segments and the detected language to a .json file
     ]
+    if threads:
+        command += ["-t", str(threads)]
 
     try:
         # Run the Whisper.cpp model thru the CLI
         process = subprocess.run(command, check=True, capture_output=True, text=True, cwd=os.path.dirname(audio_path))
 
-        # Load transcription into memory from the .txt file then remove it
-        transcription_path = f"{audio_path}.txt"
+        # Load transcription into memory from the .json file then remove it
+        transcription_path = f"{audio_path}.json"
         if not os.path.exists(transcription_path):
             raise FileNotFoundError(f"Transcription path does NOT exist {transcription_path}")
 
         with open(transcription_path, "r") as f:
-            transcript = f.read().strip()
-        
+            output = json.load(f)
+
         os.remove(transcription_path)
 
-        # Get identified language from the output of the process
-        language = get_lang_from_process_output(process)
-        
-        return transcript, language, process.stdout + process.stderr
-    
+        result = parse_cli_json(output)
+        result["model"] = model_name
+        # Older whisper-cli builds do not write the language into the json output
+        if result["language"] == "unknown":
+            result["language"] = get_lang_from_process_output(process)
+
+        return result, process.stdout + process.stderr
+
     except subprocess.CalledProcessError as e:
         vxlog.error(f"Whisper.cpp exited with error: {e}")
         vxlog.error(f"Whisper.cpp stderr:\n{e.stderr}")
@@ -51,6 +197,24 @@ def transcribe_audio(audio_path: str, model_name=DEFAULT_MODEL_NAME):
         raise
 
 
+def parse_cli_json(output: dict) -> dict:
+    segments = []
+    for item in output.get("transcription", []):
+        offsets = item.get("offsets", {})
+        segments.append({
+            "start": offsets.get("from", 0) / 1000.0,
+            "end": offsets.get("to", 0) / 1000.0,
+            "text": item.get("text", "").strip(),
+        })
+
+    return {
+        # Same layout as the -otxt output, one segment per line
+        "transcript": "\n".join(segment["text"] for segment in segments).strip(),
+        "language": output.get("result", {}).get("language") or "unknown",
+        "segments": segments,
+    }
+
+
 def get_lang_from_process_output(process: subprocess.CompletedProcess[str])->str :
     detected_lang = "unknown"
     for line in process.stderr.splitlines():
@@ -59,4 +223,4 @@ def get_lang_from_process_output(process: subprocess.CompletedProcess[str])->str
             detected_lang = match.group(1)
             break  # Found it, no need to search further
 
-    return detected_lang
\ No newline at end of file
+    return detected_lang
@@ -0,0 +1,150 @@
+import os
+import numpy as np
+
+from .pcm import SAMPLE_RATE
+
+# Energy + speech band VAD. It is meant as a cheap pre-pass that catches music-only and silent
+# clips before whisper, not as an accurate speech segmenter
+
+VAD_FRAME_MS = 30
+# Frames quieter than the noise floor plus this margin are silence
+VAD_MARGIN_DB = float(os.getenv("VAD_MARGIN_DB", "12"))
+# Absolute floor, nothing under this level is speech however quiet the clip is
+VAD_MIN_DB = float(os.getenv("VAD_MIN_DB", "-50"))
+# Share of the frame energy that has to sit in the 300 - 3400 Hz speech band
+VAD_SPEECH_BAND_RATIO = float(os.getenv("VAD_SPEECH_BAND_RATIO", "0.55"))
+# Speech frames are extended by this much on both sides so word onsets and pauses are not cut
+VAD_HANGOVER_MS = int(os.getenv("VAD_HANGOVER_MS", "300"))
+# Skip transcription of clips with less speech than VAD_MIN_SPEECH_RATIO. Off by default, the energy
+# VAD misses speech over loud music and the skipped transcript cannot be told apart from a silent clip
+VAD_SKIP_LOW_SPEECH = os.getenv("VAD_SKIP_LOW_SPEECH", "false").lower() in ("1", "true", "yes")
+VAD_MIN_SPEECH_RATIO = float(os.getenv("VAD_MIN_SPEECH_RATIO", "0.05"))
+# Shorten long silences before transcription. Off by default for the same reason as the skip, speech
+# the VAD misses would be cut out of the audio whisper gets
+VAD_TRIM_SILENCE = os.getenv("VAD_TRIM_SILENCE", "false").lower() in ("1", "true", "yes")
+# Silences longer than this are shortened to this length before transcription
+VAD_MAX_SILENCE_MS = int(os.getenv("VAD_MAX_SILENCE_MS", "1000"))
+# The audio is kept whole when trimming would remove more than this share of it, the VAD most likely
+# missed the speech
+VAD_MAX_TRIM_RATIO = float(os.getenv("VAD_MAX_TRIM_RATIO", "0.5"))
+
+
+def _frames(pcm: np.ndarray, frame_length: int) -> np.ndarray:
+    frame_count = len(pcm) // frame_length
+    return pcm[:frame_count * frame_length].reshape(frame_count, frame_length)
+
+
+# Returns a boolean speech mask with one entry per VAD_FRAME_MS frame
+def speech_mask(pcm: np.ndarray, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    frame_length = sample_rate * VAD_FRAME_MS // 1000
+    frames = _frames(pcm, frame_length)
+    if len(frames) == 0:
+        return np.zeros(0, dtype=bool)
+
+    energy_db = 10.0 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    noise_floor_db = np.percentile(energy_db, 10)
+    loud = energy_db > max(noise_floor_db + VAD_MARGIN_DB, VAD_MIN_DB)
+
+    # Share of the spectral energy inside the speech band, for all frames in one FFT
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame_length), axis=1)) ** 2
+    frequencies = np.fft.rfftfreq(frame_length, d=1.0 / sample_rate)
+    in_band = (frequencies >= 300) & (frequencies <= 3400)
+    band_ratio = spectrum[:, in_band].sum(axis=1) / (spectrum.sum(axis=1) + 1e-10)
+
+    mask = loud & (band_ratio >= VAD_SPEECH_BAND_RATIO)
+
+    hangover = VAD_HANGOVER_MS // VAD_FRAME_MS
+    if hangover > 0 and mask.any():
+        mask = np.convolve(mask.astype(np.int32), np.ones(2 * hangover + 1, dtype=np.int32), mode="same") > 0
+    return mask
+
+
+def speech_ratio(mask: np.ndarray) -> float:
+    if len(mask) == 0:
+        return 0.0
+    return float(mask.mean())
+
+
+# Shortens every silence longer than VAD_MAX_SILENCE_MS. Returns the trimmed samples and the
+# kept (trimmed_start, original_start, length) regions in samples, to map timestamps back
+def trim_silence(pcm: np.ndarray, mask: np.ndarray, sample_rate: int = SAMPLE_RATE):
+    frame_length = sample_rate * VAD_FRAME_MS // 1000
+    max_silence_frames = max(1, VAD_MAX_SILENCE_MS // VAD_FRAME_MS)
+
+    keep = mask.copy()
+    # Run boundaries of the silent frames
+    silent = np.concatenate(([False], ~mask, [False])).astype(np.int8)
+    changes = np.flatnonzero(np.diff(silent))
+    for start, end in zip(changes[::2], changes[1::2]):
+        if end - start > max_silence_frames:
+            # Keep half of the allowed silence at each edge of the gap
+            edge = max_silence_frames // 2
+            keep[start:start + edge] = True
+            keep[end - (max_silence_frames - edge):end] = True
+        else:
+            keep[start:end] = True
+
+    sample_keep = np.repeat(keep, frame_length)
+    # The tail that does not fill a whole frame is always kept
+    sample_keep = np.concatenate((sample_keep, np.ones(len(pcm) - len(sample_keep), dtype=bool)))
+
+    regions = []
+    padded = np.concatenate(([False], sample_keep, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    trimmed_position = 0
+    for start, end in zip(edges[::2], edges[1::2]):
+        regions.append((trimmed_position, int(start), int(end - start)))
+        trimmed_position += int(end - start)
+
+    return pcm[sample_keep], regions
+
+
+# Maps a time in the trimmed audio back to the original audio
+def to_original_time(seconds: float, regions: list, sample_rate: int = SAMPLE_RATE) -> float:
+    sample = seconds * sample_rate
+    for trimmed_start, original_start, length in regions:
+        if sample < trimmed_start + length:
+            return (original_start + max(0.0, sample - trimmed_start)) / sample_rate
+    if regions:
+        trimmed_start, original_start, length = regions[-1]
+        return (original_start + length) / sample_rate
+    return seconds
+
+
+# Sample positions that cut the audio into chunks of about target_seconds, each cut is moved to the
+# middle of the longest silence within search_seconds of the target so no word is split
+def split_points(mask: np.ndarray, total_samples: int, target_seconds: float, search_seconds: float = 10.0, sample_rate: int = SAMPLE_RATE) -> list:
+    if target_seconds <= search_seconds:
+        raise ValueError(f"target_seconds ({target_seconds}) has to be longer than search_seconds ({search_seconds})")
+
+    frame_length = sample_rate * VAD_FRAME_MS // 1000
+    frames_per_second = 1000.0 / VAD_FRAME_MS
+    target_frames = int(target_seconds * frames_per_second)
+    search_frames = int(search_seconds * frames_per_second)
+
+    # Length of the silent run every frame belongs to, and where that run is centered
+    silent = np.concatenate(([False], ~mask, [False])).astype(np.int8)
+    changes = np.flatnonzero(np.diff(silent))
+    run_length = np.zeros(len(mask), dtype=np.int64)
+    run_center = np.arange(len(mask))
+    for start, end in zip(changes[::2], changes[1::2]):
+        run_length[start:end] = end - start
+        run_center[start:end] = (start + end) // 2
+
+    points = []
+    position = 0
+    while len(mask) - position > target_frames + search_frames:
+        target = position + target_frames
+        low, high = max(position + 1, target - search_frames), target + search_frames
+        window = run_length[low:high]
+        cut = target
+        if window.max() > 0:
+            silence_center = int(run_center[low + int(np.argmax(window))])
+            # The center of a silence longer than the chunk can lie behind the previous cut, the
+            # position has to move forward by more than the search window every round
+            if silence_center > position + search_frames:
+                cut = silence_center
+        points.append(cut * frame_length)
+        position = cut
+
+    return [point for point in points if 0 < point < total_samples]
@@ -0,0 +1,159 @@
+import os
+import subprocess
+import threading
+import time
+import zlib
+import requests
+
+from utils import vxlog
+from .languages import to_language_code
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+whisper_cpp_dir = os.path.abspath(os.path.join(script_dir, "support", "whisper.cpp"))
+models_dir = os.path.join(whisper_cpp_dir, "models")
+
+WHISPER_SERVER_HOST = os.getenv("WHISPER_SERVER_HOST", "127.0.0.1")
+WHISPER_SERVER_PORT = int(os.getenv("WHISPER_SERVER_PORT", "8178"))
+# Use an already running whisper-server instead of starting one, it serves whichever model it was started with
+WHISPER_SERVER_URL = os.getenv("WHISPER_SERVER_URL")
+# Model the server at WHISPER_SERVER_URL was started with, stored with every transcript it makes
+WHISPER_SERVER_MODEL = os.getenv("WHISPER_SERVER_MODEL") or "unknown"
+WHISPER_SERVER_STARTUP_TIMEOUT = float(os.getenv("WHISPER_SERVER_STARTUP_TIMEOUT", "300"))
+WHISPER_SERVER_REQUEST_TIMEOUT = float(os.getenv("WHISPER_SERVER_REQUEST_TIMEOUT", "900"))
+
+
+class WhisperServerError(Exception):
+    pass
+
+
+class _WhisperServer:
+    """
+    Long lived whisper.cpp server that keeps a model resident and transcribes audio sent over
+    a local HTTP socket. The first process to start it owns it, other worker processes on the
+    same port reuse the running server, so the model is only loaded once per machine.
+    """
+
+    def __init__(self, model_name: str, port: int):
+        self.model_name = model_name
+        self.port = port
+        self.base_url = WHISPER_SERVER_URL or f"http://{WHISPER_SERVER_HOST}:{port}"
+        # An external server serves its own model whatever model was asked for
+        self.served_model = WHISPER_SERVER_MODEL if WHISPER_SERVER_URL else model_name
+        self.process = None
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+
+    def is_healthy(self) -> bool:
+        try:
+            response = self.session.get(f"{self.base_url}/health", timeout=2)
+            return response.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def ensure_running(self):
+        with self._lock:
+            if self.is_healthy():
+                return
+            if WHISPER_SERVER_URL:
+                raise WhisperServerError(f"whisper-server at {WHISPER_SERVER_URL} is not reachable")
+
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+            self._wait_until_ready()
+
+    def transcribe(self, audio: bytes, filename: str = "audio.wav") -> dict:
+        self.ensure_running()
+
+        try:
+            response = self.session.post(
+                f"{self.base_url}/inference",
+                files={"file": (filename, audio, "audio/wav")},
+                data={
+                    "response_format": "verbose_json",
+                    "language": "auto",
+                    "temperature": "0.0",
+                },
+                timeout=WHISPER_SERVER_REQUEST_TIMEOUT
+            )
+            response.raise_for_status()
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise WhisperServerError(f"whisper-server transcription failed: {e}")
+
+        if "error" in result:
+            raise WhisperServerError(f"whisper-server returned an error: {result['error']}")
+
+        segments = [
+            {
+                "start": float(segment.get("start", 0.0)),
+                "end": float(segment.get("end", 0.0)),
+                "text": segment.get("text", "").strip(),
+            }
+            for segment in result.get("segments", [])
+        ]
+
+        return {
+            "transcript": result.get("text", "").strip(),
+            "language": to_language_code(result.get("detected_language") or result.get("language")),
+            "segments": segments,
+            "model": self.served_model,
+        }
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    def _start(self):
+        executable_path = os.path.join(whisper_cpp_dir, "build", "bin", "whisper-server")
+        model_path = os.path.join(models_dir, self.model_name)
+
+        vxlog.info(f"Starting whisper-server with model {self.model_name} on port {self.port}")
+        self.process = subprocess.Popen(
+            [
+                executable_path,
+                "-m", model_path,
+                "--host", WHISPER_SERVER_HOST,
+                "--port", str(self.port),
+                "-l", "auto",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            # Keep the server out of the worker's process group so Ctrl+C does not kill it mid request
+            start_new_session=True
+        )
+
+    def _wait_until_ready(self):
+        deadline = time.monotonic() + WHISPER_SERVER_STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.is_healthy():
+                vxlog.info(f"whisper-server with model {self.model_name} is ready")
+                return
+            # Our server exited, either another worker process won the race for the port and its
+            # server answers shortly, or the server cannot start at all
+            if self.process is not None and self.process.poll() is not None:
+                self.process = None
+                deadline = min(deadline, time.monotonic() + 15)
+            time.sleep(1)
+
+        raise WhisperServerError(f"whisper-server with model {self.model_name} did not become ready in {WHISPER_SERVER_STARTUP_TIMEOUT}s")
+
+
+_servers = {}
+# Pipeline stage threads ask for servers concurrently, two instances for one model would both start a server on its port
+_servers_lock = threading.Lock()
+
+
+# Returns the resident server for a model. Every model gets its own port derived from its name so
+# that separate worker processes agree on it. Servers are left running when a worker exits so the
+# next worker can reuse the loaded model
+def get_server(model_name: str) -> _WhisperServer:
+    with _servers_lock:
+        if model_name not in _servers:
+            port = WHISPER_SERVER_PORT + zlib.crc32(model_name.encode()) % 1000
+            _servers[model_name] = _WhisperServer(model_name, port)
+        return _servers[model_name]
@@ -0,0 +1,147 @@
+import os
+import statistics
+
+import numpy as np
+
+import sqlQueries
+from utils import vxlog
+from . import fingerprint
+
+# Skip transcription and Gemini for videos that are near-duplicates of an already enriched one
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+# Largest number of differing bits for two hashes to count as the same content. Near-duplicates are
+# only guaranteed to be found up to 7 bits, the number of bands minus one
+DEDUP_AUDIO_MAX_DISTANCE = int(os.getenv("DEDUP_AUDIO_MAX_DISTANCE", "6"))
+DEDUP_FRAME_MAX_DISTANCE = int(os.getenv("DEDUP_FRAME_MAX_DISTANCE", "6"))
+# Largest fraction of differing sub-fingerprint bits for the audio to count as the same recording,
+# re-encodes stay well below it and different speech in the same voice lands near 0.5
+DEDUP_AUDIO_MAX_ERROR_RATE = float(os.getenv("DEDUP_AUDIO_MAX_ERROR_RATE", "0.35"))
+# Largest offset searched between the two audio tracks, covers a trimmed or padded intro
+DEDUP_AUDIO_MAX_SHIFT_SECONDS = float(os.getenv("DEDUP_AUDIO_MAX_SHIFT_SECONDS", "2.0"))
+# Relative duration difference allowed between a video and its duplicate
+DEDUP_DURATION_TOLERANCE = float(os.getenv("DEDUP_DURATION_TOLERANCE", "0.1"))
+DEDUP_MAX_CANDIDATES = int(os.getenv("DEDUP_MAX_CANDIDATES", "50"))
+
+_BAND_BITS = 8
+_BANDS = 64 // _BAND_BITS
+# Band kind of the audio hash, frame hashes use 1 + their position
+_AUDIO_KIND = 0
+
+
+# Splits every hash into (kind, band, value) rows for the band index
+def _bands(fingerprint_data: dict):
+    hashes = []
+    if _usable(fingerprint_data["audio_hash"]):
+        hashes.append((_AUDIO_KIND, fingerprint_data["audio_hash"]))
+    # Flat frames (black, single color) would match every other flat frame
+    hashes += [(position + 1, value) for position, value in enumerate(fingerprint_data["frame_hashes"]) if _usable(value)]
+
+    kinds, bands, values = [], [], []
+    for kind, value in hashes:
+        for band in range(_BANDS):
+            kinds.append(kind)
+            bands.append(band)
+            values.append((value >> (band * _BAND_BITS)) & ((1 << _BAND_BITS) - 1))
+    return kinds, bands, values
+
+
+def _usable(value) -> bool:
+    return value is not None and not fingerprint.is_degenerate(value)
+
+
+# The audio has to be the same recording, matched over time since the 64 bit hash only tells the voice apart
+def _same_audio(query: dict, candidate: dict) -> bool:
+    query_frames, candidate_frames = query.get("audio_frames"), candidate.get("audio_frames")
+    # Rows fingerprinted before the sub-fingerprints existed cannot be checked
+    if query_frames is None or candidate_frames is None:
+        return False
+    max_shift = int(DEDUP_AUDIO_MAX_SHIFT_SECONDS * fingerprint.frames_per_second())
+    return fingerprint.frames_error_rate(query_frames, candidate_frames, max_shift) <= DEDUP_AUDIO_MAX_ERROR_RATE
+
+
+# The frames have to agree, the audio alone is no evidence since reposts share trending sounds.
+# When either clip has usable audio it has to agree as well
+def _is_duplicate(query: dict, candidate: dict) -> bool:
+    if query["duration"] and candidate["duration"]:
+        if abs(query["duration"] - candidate["duration"]) > DEDUP_DURATION_TOLERANCE * max(query["duration"], candidate["duration"]):
+            return False
+
+    if _usable(query["audio_hash"]) or _usable(candidate["audio_hash"]):
+        if not (_usable(query["audio_hash"]) and _usable(candidate["audio_hash"])):
+            return False
+        if fingerprint.hamming(query["audio_hash"], candidate["audio_hash"]) > DEDUP_AUDIO_MAX_DISTANCE:
+            return False
+        if not _same_audio(query, candidate):
+            return False
+
+    frame_pairs = [(a, b) for a, b in zip(query["frame_hashes"], candidate["frame_hashes"]) if _usable(a) or _usable(b)]
+    if not frame_pairs:
+        return False
+    # The median lets an edited intro or an added outro frame through
+    return statistics.median(fingerprint.hamming(a, b) for a, b in frame_pairs) <= DEDUP_FRAME_MAX_DISTANCE
+
+
+def compute_fingerprint(pcm, video_path: str) -> dict:
+    return fingerprint.compute(pcm, video_path)
+
+
+# Returns the id of a completed video with the same content, or None
+def find_duplicate(db_conn, video_id: str, fingerprint_data: dict):
+    kinds, bands, values = _bands(fingerprint_data)
+    if not kinds:
+        return None
+
+    with db_conn.cursor() as cur:
+        cur.execute(sqlQueries.FIND_FINGERPRINT_CANDIDATES_QUERY, {
+            "video_id": video_id,
+            "kinds": kinds,
+            "bands": bands,
+            "values": values,
+            "limit": DEDUP_MAX_CANDIDATES,
+        })
+        rows = cur.fetchall()
+
+    for candidate_id, duration, audio_hash, audio_frames, frame_hashes in rows:
+        candidate = {
+            "duration": duration,
+            "audio_hash": fingerprint.to_unsigned(audio_hash) if audio_hash is not None else None,
+            "audio_frames": np.array(audio_frames, dtype=np.int32).view(np.uint32) if audio_frames is not None else None,
+            "frame_hashes": [fingerprint.to_unsigned(value) for value in frame_hashes or []],
+        }
+        if _is_duplicate(fingerprint_data, candidate):
+            vxlog.info(f"Video {video_id} is a near-duplicate of {candidate_id}")
+            return candidate_id
+    return None
+
+
+def register(db_conn, video_id: str, fingerprint_data: dict):
+    kinds, bands, values = _bands(fingerprint_data)
+    audio_hash = fingerprint_data["audio_hash"]
+    audio_frames = fingerprint_data.get("audio_frames")
+
+    with db_conn.cursor() as cur:
+        cur.execute(sqlQueries.UPSERT_VIDEO_FINGERPRINT_QUERY, {
+            "video_id": video_id,
+            "duration": fingerprint_data["duration"],
+            "audio_hash": fingerprint.to_signed(audio_hash) if audio_hash is not None else None,
+            # INTEGER is signed as well
+            "audio_frames": audio_frames.view(np.int32).tolist() if audio_frames is not None else None,
+            "frame_hashes": [fingerprint.to_signed(value) for value in fingerprint_data["frame_hashes"]],
+            "kinds": kinds,
+            "bands": bands,
+            "values": values,
+        })
+    db_conn.commit()
+
+
+# Copies the results of source_video_id to video_id, returns False when the source is no longer completed
+def copy_enrichment(db_conn, video_id: str, source_video_id: str) -> bool:
+    with db_conn.cursor() as cur:
+        cur.execute(sqlQueries.COPY_DUPLICATE_ENRICHMENT_QUERY, {
+            "video_id": video_id,
+            "source_video_id": source_video_id,
+        })
+        copied = cur.rowcount > 0
+    db_conn.commit()
+    return copied
+
@@ -0,0 +1,157 @@
+import os
+import cv2
+import numpy as np
+
+from AudioProcessor.pcm import SAMPLE_RATE
+
+# Frames sampled evenly over the video for the perceptual hashes
+DEDUP_FRAME_COUNT = int(os.getenv("DEDUP_FRAME_COUNT", "5"))
+
+# The audio hash compares the energy of neighbouring frequency bands inside 8 time blocks,
+# 8 blocks x 8 band pairs = 64 bits. Only the band order is kept so volume changes and
+# re-encoding do not change it
+_AUDIO_TIME_BLOCKS = 8
+_AUDIO_BAND_EDGES = np.geomspace(100, 4000, 10)
+_AUDIO_FFT_SIZE = 4096
+# Audio quieter than this (about -70 dBFS RMS) is treated as silence and not hashed
+_AUDIO_MIN_RMS = 3e-4
+# Hashes with fewer set or unset bits than this carry no content, silence and flat frames hash to 0
+_MIN_HASH_BITS = 4
+
+# The audio hash only captures the spectral envelope, the voice and not what it says. The sub-fingerprints
+# follow Haitsma & Kalker (the scheme chromaprint builds on): one 32 bit code every 32 ms where every bit is
+# the sign of the change over time of the energy difference between two neighbouring bands. A steady
+# envelope cancels out, the phonemes and their timing do not
+_FRAME_FFT_SIZE = 2048
+_FRAME_HOP = 512
+_FRAME_BAND_EDGES = np.geomspace(300, 3000, 34)
+_FRAME_BIT_WEIGHTS = (1 << np.arange(32, dtype=np.uint64)).astype(np.uint64)
+# Frames per FFT call, keeps the windowed copy of long clips small
+_FRAME_CHUNK = 1024
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+# Postgres has no unsigned 64 bit integer, hashes are stored as signed BIGINT
+def is_degenerate(value: int) -> bool:
+    set_bits = bin(value & 0xFFFFFFFFFFFFFFFF).count("1")
+    return min(set_bits, 64 - set_bits) < _MIN_HASH_BITS
+
+
+def to_signed(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def audio_hash(pcm: np.ndarray, sample_rate: int = SAMPLE_RATE):
+    frame_count = len(pcm) // _AUDIO_FFT_SIZE
+    if frame_count < _AUDIO_TIME_BLOCKS or np.sqrt(np.mean(pcm ** 2)) < _AUDIO_MIN_RMS:
+        return None
+
+    frames = pcm[:frame_count * _AUDIO_FFT_SIZE].reshape(frame_count, _AUDIO_FFT_SIZE)
+    power = np.abs(np.fft.rfft(frames * np.hanning(_AUDIO_FFT_SIZE), axis=1)) ** 2
+    frequencies = np.fft.rfftfreq(_AUDIO_FFT_SIZE, d=1.0 / sample_rate)
+
+    # Band energies of every frame, then averaged inside each time block
+    band_index = np.digitize(frequencies, _AUDIO_BAND_EDGES) - 1
+    in_range = (band_index >= 0) & (band_index < len(_AUDIO_BAND_EDGES) - 1)
+    band_energy = np.zeros((frame_count, len(_AUDIO_BAND_EDGES) - 1))
+    for band in range(len(_AUDIO_BAND_EDGES) - 1):
+        band_energy[:, band] = power[:, in_range & (band_index == band)].sum(axis=1)
+
+    blocks = np.array_split(band_energy, _AUDIO_TIME_BLOCKS)
+    block_energy = np.log10(np.stack([block.mean(axis=0) for block in blocks]) + 1e-10)
+
+    value = _bits_to_int(block_energy[:, :-1] > block_energy[:, 1:])
+    return None if is_degenerate(value) else value
+
+
+def _band_matrix(sample_rate: int) -> np.ndarray:
+    frequencies = np.fft.rfftfreq(_FRAME_FFT_SIZE, d=1.0 / sample_rate)
+    band_index = np.digitize(frequencies, _FRAME_BAND_EDGES) - 1
+    return (band_index[:, None] == np.arange(len(_FRAME_BAND_EDGES) - 1)[None, :]).astype(np.float32)
+
+
+# Returns the uint32 sub-fingerprint sequence, None for clips too short or too quiet to fingerprint
+def audio_frames(pcm: np.ndarray, sample_rate: int = SAMPLE_RATE):
+    if len(pcm) < _FRAME_FFT_SIZE + 2 * _FRAME_HOP or np.sqrt(np.mean(pcm ** 2)) < _AUDIO_MIN_RMS:
+        return None
+
+    frames = np.lib.stride_tricks.sliding_window_view(pcm.astype(np.float32), _FRAME_FFT_SIZE)[::_FRAME_HOP]
+    window = np.hanning(_FRAME_FFT_SIZE).astype(np.float32)
+    bands = _band_matrix(sample_rate)
+    band_energy = np.concatenate([
+        (np.abs(np.fft.rfft(frames[start:start + _FRAME_CHUNK] * window, axis=1)) ** 2) @ bands
+        for start in range(0, len(frames), _FRAME_CHUNK)
+    ])
+
+    band_difference = band_energy[:, :-1] - band_energy[:, 1:]
+    bits = (band_difference[1:] - band_difference[:-1]) > 0
+    return (bits.astype(np.uint64) @ _FRAME_BIT_WEIGHTS).astype(np.uint32)
+
+
+# Lowest fraction of differing bits between two sub-fingerprint sequences over time shifts of up to
+# max_shift frames, at least half of the shorter sequence has to overlap. Unrelated audio sits near 0.5
+def frames_error_rate(a: np.ndarray, b: np.ndarray, max_shift: int) -> float:
+    min_overlap = max(1, min(len(a), len(b)) // 2)
+    best = 1.0
+    for shift in range(-max_shift, max_shift + 1):
+        x, y = a[max(shift, 0):], b[max(-shift, 0):]
+        overlap = min(len(x), len(y))
+        if overlap < min_overlap:
+            continue
+        errors = np.unpackbits((x[:overlap] ^ y[:overlap]).view(np.uint8)).sum()
+        best = min(best, errors / (32.0 * overlap))
+    return best
+
+
+def frames_per_second(sample_rate: int = SAMPLE_RATE) -> float:
+    return sample_rate / float(_FRAME_HOP)
+
+
+# dHash, a 9x8 grayscale thumbnail where every bit says if a pixel is brighter than its right neighbour
+def frame_hash(frame: np.ndarray) -> int:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _bits_to_int(thumbnail[:, 1:] > thumbnail[:, :-1])
+
+
+def frame_hashes(video_path: str, count: int = DEDUP_FRAME_COUNT) -> list:
+    capture = cv2.VideoCapture(video_path)
+    try:
+        total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if total_frames <= 0:
+            return []
+
+        hashes = []
+        for position in range(count):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int(total_frames * (position + 1) / (count + 1)))
+            ok, frame = capture.read()
+            if ok:
+                hashes.append(frame_hash(frame))
+        return hashes
+    finally:
+        capture.release()
+
+
+# Returns {"duration", "audio_hash", "audio_frames", "frame_hashes"} with unsigned hashes, audio_hash and
+# audio_frames are None for clips too short or too quiet to hash
+def compute(pcm: np.ndarray, video_path: str) -> dict:
+    return {
+        "duration": len(pcm) / float(SAMPLE_RATE) if pcm is not None else None,
+        "audio_hash": audio_hash(pcm) if pcm is not None else None,
+        "audio_frames": audio_frames(pcm) if pcm is not None else None,
+        "frame_hashes": frame_hashes(video_path) if video_path else [],
+    }
@@ -1,11 +1,18 @@
 from .gemini import gemini
+from . import keyframes
 from utils import vxlog
 
-def process(video_path: str, video_id: str, transcript: str, sentiment: dict, description: str):
+# prescan_hits are the knowledge base entries found in the description and transcript, they pick the
+# knowledge base subset sent to Gemini when GEMINI_KB_MODE is subset. source_path is the original
+# video when video_path is the analysis proxy, keyframes are taken from it at full resolution.
+# use_cache=False asks Gemini again even when an answer for the same inputs is cached
+def process(video_path: str, video_id: str, transcript: str, sentiment: dict, description: str, prescan_hits: set = None, source_path: str = None, use_cache: bool = True):
     vxlog.info(f"Starting video processing for {video_id}")
 
     try:
-        analysis_result = gemini.analyze(video_path, transcript, sentiment, description)
+        frames = _keyframes(source_path or video_path, video_id)
+
+        analysis_result = gemini.analyze(video_path, transcript, sentiment, description, prescan_hits, frames, use_cache)
 
         vxlog.info(f"Video Analysis result {analysis_result}")
 
@@ -16,4 +23,26 @@ def process(video_path: str, video_id: str, transcript: str, sentiment: dict, de
             return None
     except Exception as e:
         vxlog.error(f"An error occurred during video processing for {video_id}: {e}")
-        return None 
\ No newline at end of file
+        return None
+
+
+# Scene change keyframes when VIDEO_ANALYSIS_MODE picks them for this video, otherwise None and the video is sent
+def _keyframes(video_path: str, video_id: str):
+    if not keyframes.use_keyframes(video_path):
+        return None
+
+    try:
+        frames = keyframes.extract(video_path)
+    except Exception as e:
+        vxlog.warning(f"Keyframe extraction failed for {video_id}, sending the video: {e}")
+        return None
+
+    if frames:
+        vxlog.info(f"Sending {len(frames)} keyframes for {video_id} instead of the video")
+    return frames or None
+
+
+# Gemini batch request for one video, with the same keyframe choice as process
+def batch_request(video_path: str, video_id: str, transcript: str, sentiment: dict, description: str, prescan_hits: set = None, source_path: str = None):
+    frames = _keyframes(source_path or video_path, video_id)
+    return gemini.batch_request(video_id, video_path, transcript, sentiment, description, prescan_hits, frames)
@@ -1,22 +1,63 @@
 from google import genai
 from google.genai import types
+from google.genai import errors
 from dotenv import load_dotenv
 import base64
 import os
 import json
+import time
+import hashlib
+import threading
 from knowledge import MODEL_KNOWLEDGE
-from .prompt import VIDEO_ANALYSIS_PROMPT_TEMPLATE
+from AlignmentCalculator import prescan
+from .prompt import SYSTEM_INSTRUCTIONS, KNOWLEDGE_BASE_TEMPLATE, EVIDENCE_TEMPLATE, KEYFRAMES_NOTE
 from .schema import VIDEO_ANALYSIS_SCHEMA
 from utils import vxlog
+from utils.kv_cache import KVCache
+from utils.media_cache import media_cache, file_sha256
 
 load_dotenv()
 
 GEMINI_MODEL_NAME = "gemini-2.5-flash-lite"
 
+# Send the instructions and knowledge base once as cached content instead of with every video
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "true").lower() in ("1", "true", "yes")
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# "full" sends the whole knowledge base (and caches it with the instructions), "subset" only the entries
+# the transcript pre-scan found plus the always-on core, next to the evidence of every video. The subset
+# cannot be cached since it changes per video, so it only pays off without the context cache
+GEMINI_KB_MODE = os.getenv("GEMINI_KB_MODE", "full" if GEMINI_CONTEXT_CACHE else "subset")
+# Points the client at another server implementing the Gemini API, e.g. VideoProcessor/gemini/standin.py
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+# Upload every video once through the Files API and reference it by uri instead of sending the bytes
+# inline with every request. Vertex AI has no Files API, videos are always sent inline there
+GEMINI_FILES_API = os.getenv("GEMINI_FILES_API", "true").lower() in ("1", "true", "yes")
+# Uploaded files are deleted by Gemini after 48 hours, handles are forgotten a bit earlier
+GEMINI_FILE_TTL_HOURS = float(os.getenv("GEMINI_FILE_TTL_HOURS", "46"))
+GEMINI_FILE_PROCESSING_TIMEOUT_SECONDS = float(os.getenv("GEMINI_FILE_PROCESSING_TIMEOUT_SECONDS", "300"))
+# Answers of analyze keyed by everything that goes into the request, re-running a video with the same
+# media, evidence, prompt, knowledge base and model does not pay for Gemini again
+GEMINI_RESPONSE_CACHE = os.getenv("GEMINI_RESPONSE_CACHE", "true").lower() in ("1", "true", "yes")
+GEMINI_RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_RESPONSE_CACHE_MAX_ENTRIES", "50000"))
+GEMINI_RESPONSE_CACHE_TTL_DAYS = float(os.getenv("GEMINI_RESPONSE_CACHE_TTL_DAYS", "30"))
+# Skip the lookup and ask Gemini again, the new answer replaces the cached one
+GEMINI_CACHE_BYPASS = os.getenv("GEMINI_CACHE_BYPASS", "false").lower() in ("1", "true", "yes")
+# A cache is replaced this long before it expires so that no request runs against an expired one
+_CACHE_REFRESH_MARGIN_SECONDS = 120
+# Wait before trying to create a cache again after it failed (e.g. the prefix is under the minimum size)
+_CACHE_RETRY_SECONDS = 600
+
 class _GeminiProcessor:
     def __init__(self):
         # Config is set in .env
-        self.client = genai.Client()
+        if GEMINI_BASE_URL:
+            self.client = genai.Client(http_options=types.HttpOptions(base_url=GEMINI_BASE_URL))
+        else:
+            self.client = genai.Client()
+        # Content hash -> uploaded file handle, shared by all workers on the host
+        self.file_handles = KVCache("gemini_files", 10000)
+        self._files_scope = GEMINI_BASE_URL or "gemini"
+        self.response_cache = KVCache("gemini_responses", GEMINI_RESPONSE_CACHE_MAX_ENTRIES, GEMINI_RESPONSE_CACHE_TTL_DAYS * 86400) if GEMINI_RESPONSE_CACHE else None
 
         self.model_name = GEMINI_MODEL_NAME
         self.generation_config = types.GenerateContentConfig(
@@ -45,51 +86,295 @@ class _GeminiProcessor:
             ]
         )
 
-        # Format the knowledge object that then gets passed onto the prompt
-        self.knowledge_string = json.dumps(MODEL_KNOWLEDGE, indent=2)
+        self._cache_lock = threading.Lock()
+        self._cache_name = None
+        self._cache_version = None
+        self._cache_expires_at = 0.0
+        self._cache_retry_at = 0.0
+        self.prompt_tokens_total = 0
+        self.cached_tokens_total = 0
+
+        # Prompt templates and generation config (schema, sampling), any change gives new response cache keys
+        prompt = json.dumps([SYSTEM_INSTRUCTIONS, KNOWLEDGE_BASE_TEMPLATE, EVIDENCE_TEMPLATE, KEYFRAMES_NOTE, self.generation_config.model_dump_json(exclude_none=True)])
+        self.prompt_version = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+        self.set_knowledge(MODEL_KNOWLEDGE)
+
+    def set_knowledge(self, knowledge: dict):
+        # Compact and key sorted so the same knowledge always gives the same prompt bytes and version
+        self.knowledge_string = json.dumps(knowledge, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        self.knowledge_prompt = KNOWLEDGE_BASE_TEMPLATE.format(knowledge_base=self.knowledge_string)
+        prefix = f"{self.model_name}\n{SYSTEM_INSTRUCTIONS}\n{self.knowledge_prompt}"
+        self.knowledge_version = hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16]
+
+    # Name of a live context cache holding the instructions and knowledge base, None when caching is
+    # off or unavailable. The cache is shared with the other workers through its display name
+    def _cached_content(self):
+        if not GEMINI_CONTEXT_CACHE:
+            return None
+
+        now = time.time()
+        with self._cache_lock:
+            if self._cache_name and self._cache_version == self.knowledge_version and now < self._cache_expires_at - _CACHE_REFRESH_MARGIN_SECONDS:
+                return self._cache_name
+            if now < self._cache_retry_at:
+                return None
 
+            display_name = f"zeruel-{GEMINI_KB_MODE}-{self.knowledge_version}"
+            try:
+                cache = self._find_cache(display_name, now)
+                if cache is None:
+                    cache = self.client.caches.create(
+                        model=self.model_name,
+                        config=types.CreateCachedContentConfig(
+                            display_name=display_name,
+                            system_instruction=SYSTEM_INSTRUCTIONS,
+                            contents=[self.knowledge_prompt] if GEMINI_KB_MODE == "full" else None,
+                            ttl=f"{GEMINI_CONTEXT_CACHE_TTL_SECONDS}s",
+                        )
+                    )
+                    vxlog.info(f"Created Gemini context cache {cache.name} for knowledge base version {self.knowledge_version}")
+            except Exception as e:
+                vxlog.warning(f"Could not create the Gemini context cache, sending the knowledge base inline: {e}")
+                self._cache_name = None
+                self._cache_retry_at = now + _CACHE_RETRY_SECONDS
+                return None
 
-    def analyze(self, video_path: str, transcript: str, sentiment: dict, description: str):
+            self._cache_name = cache.name
+            self._cache_version = self.knowledge_version
+            self._cache_expires_at = cache.expire_time.timestamp() if cache.expire_time else now + GEMINI_CONTEXT_CACHE_TTL_SECONDS
+            return self._cache_name
+
+    def _find_cache(self, display_name: str, now: float):
+        for cache in self.client.caches.list():
+            if cache.display_name == display_name and cache.expire_time and cache.expire_time.timestamp() > now + _CACHE_REFRESH_MARGIN_SECONDS:
+                return cache
+        return None
+
+    def _invalidate_cache(self):
+        with self._cache_lock:
+            self._cache_name = None
+
+    # media_parts is the video part, or the keyframe parts in keyframe mode
+    def _generate(self, media_parts: list, evidence_prompt: str, knowledge_prompt: str):
+        cached_content = self._cached_content()
+        if cached_content:
+            # In full mode the knowledge base is part of the cached prefix
+            contents = [*media_parts, evidence_prompt] if GEMINI_KB_MODE == "full" else [knowledge_prompt, *media_parts, evidence_prompt]
+            try:
+                return self.client.models.generate_content(
+                    model=self.model_name,
+                    config=self.generation_config.model_copy(update={"cached_content": cached_content}),
+                    contents=contents
+                )
+            except Exception as e:
+                # A rejected uploaded file is the likelier culprit, analyze retries with the bytes inline
+                # and that request shows whether the cache is broken too
+                if any(part.file_data is not None for part in media_parts) and isinstance(e, errors.ClientError):
+                    raise
+                # The cache may have been deleted or expired early, the inline request still works
+                vxlog.warning(f"Gemini request with context cache {cached_content} failed, retrying inline: {e}")
+                self._invalidate_cache()
+
+        return self.client.models.generate_content(
+            model=self.model_name,
+            config=self.generation_config.model_copy(update={"system_instruction": SYSTEM_INSTRUCTIONS}),
+            contents=[knowledge_prompt, *media_parts, evidence_prompt]
+        )
+
+    def _record_usage(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return
+
+        prompt_tokens = usage.prompt_token_count or 0
+        cached_tokens = usage.cached_content_token_count or 0
+        with self._cache_lock:
+            self.prompt_tokens_total += prompt_tokens
+            self.cached_tokens_total += cached_tokens
+            saved_share = self.cached_tokens_total / self.prompt_tokens_total if self.prompt_tokens_total else 0.0
+        vxlog.info(f"Gemini prompt used {prompt_tokens} tokens, {cached_tokens} from the context cache ({saved_share:.0%} of all prompt tokens cached so far)")
+
+
+    def _inline_video_part(self, video_path: str):
         with open(video_path, "rb") as f:
             video_bytes = f.read()
 
-        video_part = types.Part(
+        return types.Part(
             inline_data=types.Blob(
                 mime_type="video/mp4",
                 data=video_bytes
             )
         )
 
+    # Returns the video part and the file handle key when it references an uploaded file. Without
+    # allow_inline a failed upload raises instead of falling back to the video bytes
+    def _video_part(self, video_path: str, allow_inline: bool = True):
+        if GEMINI_FILES_API and not self.client.vertexai:
+            try:
+                return self._uploaded_video_part(video_path)
+            except Exception as e:
+                if not allow_inline:
+                    raise
+                vxlog.warning(f"Could not upload {video_path} to the Gemini Files API, sending it inline: {e}")
+        elif not allow_inline:
+            raise RuntimeError("Sending videos by reference needs the Gemini Files API")
+        return self._inline_video_part(video_path), None
+
+    def _uploaded_video_part(self, video_path: str):
+        content_hash = media_cache.content_hash(video_path) or file_sha256(video_path)
+        key = f"{self._files_scope}:{content_hash}"
+
+        handle = self.file_handles.get(key)
+        if handle is None:
+            handle = self._upload(video_path, content_hash)
+            self.file_handles.set(key, handle, ttl_seconds=GEMINI_FILE_TTL_HOURS * 3600)
+        else:
+            vxlog.debug(f"Reusing uploaded Gemini file {handle['name']} for {video_path}")
+
+        return types.Part.from_uri(file_uri=handle["uri"], mime_type=handle["mime_type"]), key
+
+    # The SDK streams the file from disk in chunks, videos are processed before they can be used
+    def _upload(self, video_path: str, content_hash: str) -> dict:
+        file = self.client.files.upload(
+            file=video_path,
+            config=types.UploadFileConfig(mime_type="video/mp4", display_name=content_hash[:40])
+        )
+
+        deadline = time.monotonic() + GEMINI_FILE_PROCESSING_TIMEOUT_SECONDS
+        while file.state == types.FileState.PROCESSING:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Gemini file {file.name} is still processing")
+            time.sleep(2)
+            file = self.client.files.get(name=file.name)
+
+        if file.state == types.FileState.FAILED:
+            raise RuntimeError(f"Gemini could not process file {file.name}: {file.error}")
+
+        vxlog.info(f"Uploaded {video_path} to Gemini as {file.name}")
+        return {"name": file.name, "uri": file.uri, "mime_type": file.mime_type or "video/mp4"}
+
+    # Knowledge base section for one video, the whole knowledge base unless subset mode has pre-scan hits
+    def _knowledge_prompt_for(self, prescan_hits):
+        if GEMINI_KB_MODE != "subset" or prescan_hits is None:
+            return self.knowledge_prompt
+
+        subset = prescan.knowledge_subset(prescan_hits)
+        vxlog.debug(f"Sending {len(subset)} knowledge base entries, {len(prescan_hits)} found by the pre-scan")
+        return KNOWLEDGE_BASE_TEMPLATE.format(knowledge_base=json.dumps(subset, sort_keys=True, separators=(",", ":"), ensure_ascii=False))
+
+    # Keyframes go first, each one labelled with its timestamp
+    def _keyframe_parts(self, keyframes: list) -> list:
+        parts = [types.Part.from_text(text=KEYFRAMES_NOTE)]
+        for timestamp, jpeg in keyframes:
+            parts.append(types.Part.from_text(text=f"Keyframe at {timestamp:.1f}s"))
+            parts.append(types.Part.from_bytes(data=jpeg, mime_type="image/jpeg"))
+        return parts
+
+    # Returns the media parts and the file handle key when they reference an uploaded file
+    def _media_parts(self, video_path: str, keyframes: list = None, allow_inline: bool = True):
+        if keyframes:
+            return self._keyframe_parts(keyframes), None
+        video_part, file_key = self._video_part(video_path, allow_inline)
+        return [video_part], file_key
+
+    def _evidence_prompt(self, transcript: str, sentiment: dict, description: str) -> str:
+        sentiment_str = json.dumps(sentiment, indent=4)
+
+        return EVIDENCE_TEMPLATE.format(
+            description=description,
+            transcript=transcript,
+            sentiment=sentiment_str
+        )
+
+    def parse_response(self, response) -> dict:
+        # Parse the JSON string response into a Python dictionary
+        parsed_response = json.loads(response.text)
+        # vxlog.info(json.dumps(parsed_response, indent=2))
+
+        # Cap values to valid ranges [-1.0, 1.0]
+        return value_cap_check(parsed_response)
+
+    # Hash of the video content, or of the keyframes when they are sent instead
+    def _media_hash(self, video_path: str, keyframes: list = None) -> str:
+        if keyframes:
+            digest = hashlib.sha256()
+            for timestamp, jpeg in keyframes:
+                digest.update(f"{timestamp:.3f}".encode("utf-8"))
+                digest.update(jpeg)
+            return f"keyframes:{digest.hexdigest()}"
+        return media_cache.content_hash(video_path) or file_sha256(video_path)
+
+    def _response_key(self, media_hash: str, evidence_prompt: str, knowledge_prompt: str) -> str:
+        # The knowledge prompt is the subset actually sent, it changes with the pre-scan hits
+        text_hash = hashlib.sha256(f"{knowledge_prompt}\n{evidence_prompt}".encode("utf-8")).hexdigest()
+        return f"{self.model_name}:{self.prompt_version}:{self.knowledge_version}:{GEMINI_KB_MODE}:{media_hash}:{text_hash}"
+
+    # keyframes, [(timestamp, JPEG bytes)] from VideoProcessor.keyframes, are sent instead of the video when given.
+    # use_cache=False skips the response cache lookup for this video, like GEMINI_CACHE_BYPASS does for all
+    def analyze(self, video_path: str, transcript: str, sentiment: dict, description: str, prescan_hits: set = None, keyframes: list = None, use_cache: bool = True):
         try:
-            sentiment_str = json.dumps(sentiment, indent=4)
+            evidence_prompt = self._evidence_prompt(transcript, sentiment, description)
+            knowledge_prompt = self._knowledge_prompt_for(prescan_hits)
 
-            final_prompt = VIDEO_ANALYSIS_PROMPT_TEMPLATE.format(
-                description=description,
-                transcript=transcript,
-                sentiment=sentiment_str,
-                knowledge_base=self.knowledge_string
-            )
+            # Looked up before the video is uploaded, a hit costs no request at all
+            response_key = None
+            if self.response_cache is not None:
+                response_key = self._response_key(self._media_hash(video_path, keyframes), evidence_prompt, knowledge_prompt)
+                if use_cache and not GEMINI_CACHE_BYPASS:
+                    cached = self.response_cache.get(response_key)
+                    if cached is not None:
+                        vxlog.info(f"Gemini response cache hit for {video_path}, {self.response_cache.stats()}")
+                        return cached
+                    vxlog.debug(f"Gemini response cache miss for {video_path}, {self.response_cache.stats()}")
 
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                config=self.generation_config,
-                contents=[
-                    video_part,
-                    final_prompt
-                ]
-            )
-            # Parse the JSON string response into a Python dictionary
-            parsed_response = json.loads(response.text)
-            # vxlog.info(json.dumps(parsed_response, indent=2))
-            
-            # Cap values to valid ranges [-1.0, 1.0]
-            parsed_response = value_cap_check(parsed_response)
-            
+            media_parts, file_key = self._media_parts(video_path, keyframes)
+            try:
+                response = self._generate(media_parts, evidence_prompt, knowledge_prompt)
+            except errors.ClientError as e:
+                if file_key is None or e.code not in (400, 403, 404):
+                    raise
+                # The uploaded file expired or was deleted, forget the handle and send the bytes this time
+                vxlog.warning(f"Gemini rejected the uploaded file for {video_path}, sending it inline: {e}")
+                self.file_handles.delete(file_key)
+                response = self._generate([self._inline_video_part(video_path)], evidence_prompt, knowledge_prompt)
+
+            self._record_usage(response)
+            parsed_response = self.parse_response(response)
+
+            if response_key is not None:
+                self.response_cache.set(response_key, parsed_response)
             return parsed_response
         except Exception as e:
             vxlog.error(f"An error occured during Gemini analysis for video {video_path}, error: {e}" )
             return None 
 
+    # One request of a batch job, the same prompt as analyze with the instructions inline. The video_id
+    # travels in the request metadata and comes back with its response. Videos are always referenced
+    # as uploaded files, the inline requests of a batch job share one 20 MB request
+    def batch_request(self, video_id: str, video_path: str, transcript: str, sentiment: dict, description: str, prescan_hits: set = None, keyframes: list = None):
+        media_parts, _file_key = self._media_parts(video_path, keyframes, allow_inline=False)
+
+        return types.InlinedRequest(
+            model=self.model_name,
+            contents=[self._knowledge_prompt_for(prescan_hits), *media_parts, self._evidence_prompt(transcript, sentiment, description)],
+            config=self.generation_config.model_copy(update={"system_instruction": SYSTEM_INSTRUCTIONS}),
+            metadata={"video_id": video_id},
+        )
+
+    # Submits the requests as one batch job and returns its name
+    def submit_batch(self, requests: list, display_name: str) -> str:
+        batch = self.client.batches.create(
+            model=self.model_name,
+            src=requests,
+            config=types.CreateBatchJobConfig(display_name=display_name)
+        )
+        vxlog.info(f"Submitted Gemini batch {batch.name} with {len(requests)} requests")
+        return batch.name
+
+    def get_batch(self, name: str):
+        return self.client.batches.get(name=name)
+
 
 gemini = _GeminiProcessor()
 
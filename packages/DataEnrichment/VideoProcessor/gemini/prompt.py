@@ -1,20 +1,8 @@
-VIDEO_ANALYSIS_PROMPT_TEMPLATE = """
-You are an expert geopolitical analyst specializing in detecting propaganda, disinformation, and nuanced sentiment in short-form video content. Your task is to analyze the provided evidence and produce a single, valid JSON object as output.
-
---- EVIDENCE FILE ---
-This is your primary source of truth.
-
-1.  **VIDEO DESCRIPTION (Creator's Intent):**
-    "{description}"
-
-2.  **AUDIO TRANSCRIPT (High-Accuracy):**
-    "{transcript}"
-
-3.  **INDEPENDENT SENTIMENT ANALYSIS (External Tool):**
-    {sentiment}
+# The prompt is split so that everything that is the same for every video (instructions and
+# knowledge base) can be sent once as a cached prefix, see _GeminiProcessor._cached_content
 
---- KNOWLEDGE BASE (Reference Data for Geopolitical Context) ---
-{knowledge_base}
+SYSTEM_INSTRUCTIONS = """
+You are an expert geopolitical analyst specializing in detecting propaganda, disinformation, and nuanced sentiment in short-form video content. Your task is to analyze the provided evidence and produce a single, valid JSON object as output.
 
 --- ANALYTICAL METHODOLOGY ---
 Follow this exact process to generate the final JSON output.
@@ -73,4 +61,30 @@ Follow this exact process to generate the final JSON output.
         *   *Reasoning:* The narrative focus is on subjects that are geopolitically neutral. Therefore, the video has no geopolitical alignment. The final `overall_alignment` must be `0.0`.
 
 Your final output must be a single, valid JSON object conforming to the schema. Do not include any other text or the scratchpad.
-"""
\ No newline at end of file
+"""
+
+KNOWLEDGE_BASE_TEMPLATE = """
+--- KNOWLEDGE BASE (Reference Data for Geopolitical Context) ---
+{knowledge_base}
+"""
+
+EVIDENCE_TEMPLATE = """
+--- EVIDENCE FILE ---
+This is your primary source of truth.
+
+1.  **VIDEO DESCRIPTION (Creator's Intent):**
+    "{description}"
+
+2.  **AUDIO TRANSCRIPT (High-Accuracy):**
+    "{transcript}"
+
+3.  **INDEPENDENT SENTIMENT ANALYSIS (External Tool):**
+    {sentiment}
+"""
+
+# Sent before the keyframes when the video is analysed from keyframes instead of the full video
+KEYFRAMES_NOTE = """
+--- VIDEO KEYFRAMES ---
+The video is given as keyframes, one per scene, in chronological order. The audio is not included,
+rely on the transcript for what is said and on the keyframes for what is shown, including on screen text.
+"""
@@ -0,0 +1,314 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Run as a script the DataEnrichment root is not on the path
+data_enrichment_root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if data_enrichment_root_path not in sys.path:
+    sys.path.append(data_enrichment_root_path)
+
+from utils import vxlog
+
+# Local stand-in for the parts of the Gemini Developer API the enrichment worker uses: resumable file
+# uploads, file lookups, cached contents, generateContent and batch jobs. Point the worker at it with
+# GEMINI_BASE_URL=http://127.0.0.1:8765 and any GEMINI_API_KEY to run the pipeline offline.
+# generateContent answers with a fixed, schema valid analysis and fails with 404 when a request
+# references a file that was never uploaded, like the real API does for expired files. Batch jobs
+# stay pending for --batch-seconds and then succeed with one such answer (or error) per request.
+#
+#   python VideoProcessor/gemini/standin.py --port 8765 --batch-seconds 5
+
+FILE_TTL_HOURS = 48
+
+CANNED_ANALYSIS = {
+    "summary": "Stand-in analysis, the video was not looked at.",
+    "identified_subjects": [],
+    "overall_alignment": 0.0,
+}
+
+
+# The SDK is not consistent about camelCase in nested request fields, accept both spellings
+def _field(payload: dict, camel: str, snake: str, default=None):
+    return payload.get(camel, payload.get(snake, default))
+
+
+def _timestamp(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class _State:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.uploads = {}
+        self.cached_contents = {}
+        self.batches = {}
+        self.batch_seconds = 5.0
+        # Request counters, served on GET /standin/stats
+        self.stats = {"uploads_started": 0, "uploads_finished": 0, "generate_requests": 0, "uploaded_bytes": 0, "batches_created": 0, "batch_requests": 0}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    state: _State = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> dict:
+        body = self._read_body()
+        return json.loads(body) if body else {}
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send_json(status, {"error": {"code": status, "message": message, "status": "NOT_FOUND" if status == 404 else "INVALID_ARGUMENT"}})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        state = self.state
+
+        if path == "/standin/stats":
+            with state.lock:
+                return self._send_json(200, dict(state.stats))
+
+        if path.startswith("/v1beta/files/"):
+            name = path[len("/v1beta/"):]
+            with state.lock:
+                file = state.files.get(name)
+            if file is None:
+                return self._send_error(404, f"File {name} not found")
+            return self._send_json(200, file)
+
+        if path == "/v1beta/cachedContents":
+            with state.lock:
+                return self._send_json(200, {"cachedContents": list(state.cached_contents.values())})
+
+        if path.startswith("/v1beta/batches/"):
+            return self._get_batch(path[len("/v1beta/"):])
+
+        self._send_error(404, f"Unknown path {path}")
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        state = self.state
+
+        if path == "/upload/v1beta/files":
+            return self._start_upload()
+        if path.startswith("/standin/upload/"):
+            return self._upload_chunk(path[len("/standin/upload/"):])
+        if path == "/v1beta/cachedContents":
+            return self._create_cached_content()
+        if path.startswith("/v1beta/models/") and path.endswith(":generateContent"):
+            return self._generate_content()
+        if path.startswith("/v1beta/models/") and path.endswith(":batchGenerateContent"):
+            return self._create_batch()
+        if path.startswith("/v1beta/batches/") and path.endswith(":cancel"):
+            return self._cancel_batch(path[len("/v1beta/"):-len(":cancel")])
+
+        self._send_error(404, f"Unknown path {path}")
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        name = path[len("/v1beta/"):]
+        with self.state.lock:
+            self.state.files.pop(name, None)
+            self.state.cached_contents.pop(name, None)
+        self._send_json(200, {})
+
+    def _start_upload(self):
+        request = self._read_json().get("file", {})
+        upload_id = uuid.uuid4().hex
+        with self.state.lock:
+            self.state.uploads[upload_id] = {"meta": request, "data": bytearray()}
+            self.state.stats["uploads_started"] += 1
+
+        host = self.headers.get("Host")
+        self._send_json(200, {}, headers={"X-Goog-Upload-URL": f"http://{host}/standin/upload/{upload_id}"})
+
+    def _upload_chunk(self, upload_id: str):
+        chunk = self._read_body()
+        command = self.headers.get("X-Goog-Upload-Command", "")
+        with self.state.lock:
+            upload = self.state.uploads.get(upload_id)
+            if upload is None:
+                return self._send_error(404, f"Upload {upload_id} not found")
+            upload["data"].extend(chunk)
+            self.state.stats["uploaded_bytes"] += len(chunk)
+
+            if "finalize" not in command:
+                return self._send_json(200, {}, headers={"X-Goog-Upload-Status": "active"})
+
+            del self.state.uploads[upload_id]
+            file_id = uuid.uuid4().hex[:12]
+            now = datetime.now(timezone.utc)
+            host = self.headers.get("Host")
+            file = {
+                "name": f"files/{file_id}",
+                "displayName": _field(upload["meta"], "displayName", "display_name", file_id),
+                "mimeType": _field(upload["meta"], "mimeType", "mime_type", "application/octet-stream"),
+                "sizeBytes": str(len(upload["data"])),
+                "sha256Hash": hashlib.sha256(bytes(upload["data"])).hexdigest(),
+                "createTime": _timestamp(now),
+                "updateTime": _timestamp(now),
+                "expirationTime": _timestamp(now + timedelta(hours=FILE_TTL_HOURS)),
+                "uri": f"http://{host}/v1beta/files/{file_id}",
+                "state": "ACTIVE",
+                "source": "UPLOADED",
+            }
+            self.state.files[file["name"]] = file
+            self.state.stats["uploads_finished"] += 1
+
+        self._send_json(200, {"file": file}, headers={"X-Goog-Upload-Status": "final"})
+
+    def _create_cached_content(self):
+        request = self._read_json()
+        ttl_seconds = float(str(request.get("ttl", "3600s")).rstrip("s"))
+        now = datetime.now(timezone.utc)
+        cached_content = {
+            "name": f"cachedContents/{uuid.uuid4().hex[:12]}",
+            "displayName": request.get("displayName", ""),
+            "model": request.get("model", ""),
+            "createTime": _timestamp(now),
+            "updateTime": _timestamp(now),
+            "expireTime": _timestamp(now + timedelta(seconds=ttl_seconds)),
+            "usageMetadata": {"totalTokenCount": len(json.dumps(request)) // 4},
+        }
+        with self.state.lock:
+            self.state.cached_contents[cached_content["name"]] = cached_content
+        self._send_json(200, cached_content)
+
+    def _generate_content(self):
+        request = self._read_json()
+        with self.state.lock:
+            self.state.stats["generate_requests"] += 1
+            status, payload = _answer(self.state, request)
+        self._send_json(status, payload)
+
+    def _create_batch(self):
+        batch_request = self._read_json().get("batch", {})
+        requests = ((batch_request.get("inputConfig") or {}).get("requests") or {}).get("requests", [])
+        now = datetime.now(timezone.utc)
+        batch = {
+            "name": f"batches/{uuid.uuid4().hex[:12]}",
+            "metadata": {
+                "@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatch",
+                "displayName": batch_request.get("displayName", ""),
+                "state": "BATCH_STATE_PENDING",
+                "createTime": _timestamp(now),
+                "updateTime": _timestamp(now),
+            },
+        }
+        with self.state.lock:
+            self.state.batches[batch["name"]] = {"batch": batch, "requests": requests, "done_at": time.time() + self.state.batch_seconds}
+            self.state.stats["batches_created"] += 1
+            self.state.stats["batch_requests"] += len(requests)
+        self._send_json(200, batch)
+
+    def _get_batch(self, name: str):
+        with self.state.lock:
+            entry = self.state.batches.get(name)
+            if entry is None:
+                return self._send_error(404, f"Batch {name} not found")
+            metadata = entry["batch"]["metadata"]
+            if metadata["state"] in ("BATCH_STATE_PENDING", "BATCH_STATE_RUNNING"):
+                if time.time() < entry["done_at"]:
+                    metadata["state"] = "BATCH_STATE_RUNNING"
+                else:
+                    # Answered when the job is first looked at after its pending time
+                    metadata["output"] = {"inlinedResponses": {"inlinedResponses": [_batch_response(self.state, request) for request in entry["requests"]]}}
+                    metadata["state"] = "BATCH_STATE_SUCCEEDED"
+                    metadata["endTime"] = metadata["updateTime"] = _timestamp(datetime.now(timezone.utc))
+            payload = json.loads(json.dumps(entry["batch"]))
+        self._send_json(200, payload)
+
+    def _cancel_batch(self, name: str):
+        with self.state.lock:
+            entry = self.state.batches.get(name)
+            if entry is None:
+                return self._send_error(404, f"Batch {name} not found")
+            if entry["batch"]["metadata"]["state"] in ("BATCH_STATE_PENDING", "BATCH_STATE_RUNNING"):
+                entry["batch"]["metadata"]["state"] = "BATCH_STATE_CANCELLED"
+        self._send_json(200, {})
+
+
+def _batch_response(state: _State, request: dict) -> dict:
+    status, payload = _answer(state, request.get("request", {}))
+    response = {"response": payload} if status == 200 else {"error": payload["error"]}
+    if "metadata" in request:
+        response["metadata"] = request["metadata"]
+    return response
+
+
+# Answer of generateContent for one request, the caller holds the state lock
+def _answer(state: _State, request: dict):
+    for content in request.get("contents", []):
+        for part in content.get("parts", []):
+            file_uri = _field(_field(part, "fileData", "file_data", {}), "fileUri", "file_uri")
+            if file_uri and f"files/{file_uri.rsplit('/', 1)[-1]}" not in state.files:
+                return 404, {"error": {"code": 404, "message": f"File {file_uri} not found or expired", "status": "NOT_FOUND"}}
+    cached_content = request.get("cachedContent") or (request.get("generationConfig") or {}).get("cachedContent")
+    cached_tokens = state.cached_contents.get(cached_content, {}).get("usageMetadata", {}).get("totalTokenCount", 0)
+
+    prompt_tokens = len(json.dumps(request.get("contents", []))) // 4 + cached_tokens
+    return 200, {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": json.dumps(CANNED_ANALYSIS)}]},
+            "finishReason": "STOP",
+            "index": 0,
+        }],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "cachedContentTokenCount": cached_tokens,
+            "candidatesTokenCount": 32,
+            "totalTokenCount": prompt_tokens + 32,
+        },
+        "modelVersion": "standin",
+    }
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765, batch_seconds: float = 5.0) -> ThreadingHTTPServer:
+    state = _State()
+    state.batch_seconds = batch_seconds
+    handler = type("StandinHandler", (_Handler,), {"state": state})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-seconds", type=float, default=5.0, help="Time a batch job stays pending")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.batch_seconds)
+    vxlog.info(f"Gemini stand-in listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import cv2
+import numpy as np
+
+# "video" always sends the whole video, "keyframes" always sends scene change keyframes and "auto"
+# sends keyframes for videos at least KEYFRAME_MIN_DURATION_SECONDS long, where the video tokens add up
+VIDEO_ANALYSIS_MODE = os.getenv("VIDEO_ANALYSIS_MODE", "video")
+KEYFRAME_MIN_DURATION_SECONDS = float(os.getenv("KEYFRAME_MIN_DURATION_SECONDS", "90"))
+# Upper bound of keyframes sent per video, every image costs about as many tokens as one second of video
+KEYFRAME_MAX_COUNT = int(os.getenv("KEYFRAME_MAX_COUNT", "12"))
+# Videos with fewer scenes (talking heads) still get this many frames, spread evenly
+KEYFRAME_MIN_COUNT = int(os.getenv("KEYFRAME_MIN_COUNT", "3"))
+# Frames decoded per second of video for the scene detection
+KEYFRAME_SAMPLE_FPS = float(os.getenv("KEYFRAME_SAMPLE_FPS", "2"))
+# Share of the color histogram that has to change between two sampled frames for a scene change
+KEYFRAME_SCENE_THRESHOLD = float(os.getenv("KEYFRAME_SCENE_THRESHOLD", "0.35"))
+# Longer side of the JPEGs, large enough to read on screen text
+KEYFRAME_MAX_SIZE = int(os.getenv("KEYFRAME_MAX_SIZE", "768"))
+KEYFRAME_JPEG_QUALITY = int(os.getenv("KEYFRAME_JPEG_QUALITY", "80"))
+
+# Sampled frames are shrunk to this width before their histograms are computed
+_THUMBNAIL_WIDTH = 64
+# 8 hue x 4 saturation x 4 value bins
+_HISTOGRAM_BINS = np.array([8, 4, 4])
+
+
+def duration(video_path: str):
+    capture = cv2.VideoCapture(video_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        if fps <= 0 or frame_count <= 0:
+            return None
+        return frame_count / fps
+    finally:
+        capture.release()
+
+
+def use_keyframes(video_path: str) -> bool:
+    if VIDEO_ANALYSIS_MODE == "keyframes":
+        return True
+    if VIDEO_ANALYSIS_MODE != "auto":
+        return False
+    video_duration = duration(video_path)
+    return video_duration is not None and video_duration >= KEYFRAME_MIN_DURATION_SECONDS
+
+
+# Decodes every step-th frame into a small HSV thumbnail. Returns the thumbnails as one
+# (frames, height, width, 3) array and their frame indices
+def _sample_thumbnails(capture, step: int):
+    thumbnails, indices = [], []
+    index = 0
+    while True:
+        # grab() skips the color conversion of the frames that are not sampled
+        if not capture.grab():
+            break
+        if index % step == 0:
+            ok, frame = capture.retrieve()
+            if ok:
+                height = max(1, round(frame.shape[0] * _THUMBNAIL_WIDTH / frame.shape[1]))
+                thumbnail = cv2.resize(frame, (_THUMBNAIL_WIDTH, height), interpolation=cv2.INTER_AREA)
+                thumbnails.append(cv2.cvtColor(thumbnail, cv2.COLOR_BGR2HSV))
+                indices.append(index)
+        index += 1
+    if not thumbnails:
+        return None, []
+    return np.stack(thumbnails), indices
+
+
+# Normalized HSV histogram of every thumbnail, computed for all frames at once with one bincount
+def _histograms(thumbnails: np.ndarray) -> np.ndarray:
+    frame_count = len(thumbnails)
+    # OpenCV hue is 0-179, saturation and value 0-255
+    hue = thumbnails[..., 0].astype(np.int32) * _HISTOGRAM_BINS[0] // 180
+    saturation = thumbnails[..., 1].astype(np.int32) * _HISTOGRAM_BINS[1] // 256
+    value = thumbnails[..., 2].astype(np.int32) * _HISTOGRAM_BINS[2] // 256
+    bins = (hue * _HISTOGRAM_BINS[1] + saturation) * _HISTOGRAM_BINS[2] + value
+
+    bin_count = int(_HISTOGRAM_BINS.prod())
+    offsets = (np.arange(frame_count) * bin_count)[:, None, None]
+    counts = np.bincount((bins + offsets).ravel(), minlength=frame_count * bin_count)
+    counts = counts.reshape(frame_count, bin_count).astype(np.float32)
+    return counts / counts.sum(axis=1, keepdims=True)
+
+
+# Positions (into the sampled frames) of one representative frame per scene, at most max_count
+def _select(histograms: np.ndarray, max_count: int, min_count: int, threshold: float) -> list:
+    frame_count = len(histograms)
+    # Share of the histogram that moved between consecutive frames, 0 to 1
+    diffs = 0.5 * np.abs(np.diff(histograms, axis=0)).sum(axis=1)
+
+    cuts = np.flatnonzero(diffs > threshold) + 1
+    if len(cuts) > max_count - 1:
+        # Keep the hardest cuts
+        cuts = np.sort(cuts[np.argsort(diffs[cuts - 1])[::-1][:max_count - 1]])
+
+    boundaries = np.concatenate(([0], cuts, [frame_count]))
+    # The middle of a scene is past its transition and most likely to show the content
+    positions = {int((start + end - 1) // 2) for start, end in zip(boundaries[:-1], boundaries[1:])}
+
+    if len(positions) < min_count:
+        positions |= {int(position) for position in np.linspace(0, frame_count - 1, min(min_count, frame_count)).round()}
+
+    return sorted(positions)[:max_count]
+
+
+def _encode(frame: np.ndarray) -> bytes:
+    height, width = frame.shape[:2]
+    scale = KEYFRAME_MAX_SIZE / max(height, width)
+    if scale < 1:
+        frame = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, KEYFRAME_JPEG_QUALITY])
+    if not ok:
+        raise RuntimeError("Could not encode keyframe as JPEG")
+    return jpeg.tobytes()
+
+
+# Returns [(timestamp in seconds, JPEG bytes)] of the scene change keyframes, in order
+def extract(video_path: str, max_count: int = KEYFRAME_MAX_COUNT) -> list:
+    capture = cv2.VideoCapture(video_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        step = max(1, round(fps / KEYFRAME_SAMPLE_FPS))
+
+        thumbnails, indices = _sample_thumbnails(capture, step)
+        if thumbnails is None:
+            return []
+        positions = _select(_histograms(thumbnails), max_count, KEYFRAME_MIN_COUNT, KEYFRAME_SCENE_THRESHOLD)
+
+        # Only the chosen frames are decoded again at full size
+        keyframes = []
+        for position in positions:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, indices[position])
+            ok, frame = capture.read()
+            if ok:
+                keyframes.append((indices[position] / fps, _encode(frame)))
+        return keyframes
+    finally:
+        capture.release()
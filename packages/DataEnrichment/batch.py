@@ -0,0 +1,308 @@
+import glob
+import json
+import os
+import time
+
+from google.genai import types
+
+import VideoProcessor
+from AlignmentCalculator import prescan
+from utils.get_video_description import get_video_description
+from VideoProcessor.gemini import gemini
+from worker import EnrichmentJob, download_step, fingerprint_step, audio_step, store_step
+from utils import vxlog
+from utils.media_cache import media_cache
+
+# Backfills through the Gemini Batch API: videos are downloaded, transcribed and prepared in chunks of
+# GEMINI_BATCH_MAX_REQUESTS, the Gemini requests of every chunk are submitted as batch jobs before the
+# next chunk is prepared and the results are stored once the jobs are done. Progress is kept in a state
+# file so a restarted backfill resumes where it stopped, without preparing, submitting or storing a
+# video twice
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+batch_state_dir = os.path.join(script_dir, "tmp/batch")
+
+# Requests per batch job, and the serialized size of all of them. The inline requests of one job are
+# sent as a single request, which has to stay under 20 MB
+GEMINI_BATCH_MAX_REQUESTS = int(os.getenv("GEMINI_BATCH_MAX_REQUESTS", "500"))
+GEMINI_BATCH_MAX_BYTES = int(float(os.getenv("GEMINI_BATCH_MAX_MB", "18")) * 1024 * 1024)
+GEMINI_BATCH_POLL_SECONDS = float(os.getenv("GEMINI_BATCH_POLL_SECONDS", "60"))
+
+_FINISHED_STATES = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+}
+
+# EnrichmentJob fields kept in the state file between preparing and storing a video
+_JOB_FIELDS = [
+    "video_path", "proxy_path", "audio_path", "transcript", "lang", "text_sentiment_analysis",
+    "sentiment_timeline", "speech_ratio", "whisper_model", "description",
+]
+
+
+class _BatchState:
+    """
+    Progress of a backfill. Status changes are appended to a journal next to the state file, the
+    whole state is only rewritten at checkpoints (after preparing, after every submitted job and
+    after every ingested job). Every checkpoint starts a new journal, so a crash right after one
+    never replays changes the state already moved past.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Media cache pin holder of the prepared videos
+        self.holder = f"batch-{os.path.splitext(os.path.basename(path))[0]}"
+        self.data = {"videos": {}, "batches": [], "journal": 0}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+            self.data.setdefault("journal", 0)
+        if os.path.exists(path) or os.path.exists(self.journal_path):
+            vxlog.info(f"Resuming batch backfill from {path}")
+            self._replay()
+            # Starts a clean journal after a possibly cut off last line
+            self.save()
+        self._remove_journals(keep=self.journal_path)
+
+    @property
+    def journal_path(self) -> str:
+        return f"{self.path}.journal-{self.data['journal']}"
+
+    @property
+    def videos(self) -> dict:
+        return self.data["videos"]
+
+    @property
+    def batches(self) -> list:
+        return self.data["batches"]
+
+    # Written to a temporary file and renamed, a crash never leaves a half written state behind
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        previous_journal_path = self.journal_path
+        self.data["journal"] += 1
+        partial_path = f"{self.path}.part"
+        with open(partial_path, "w") as f:
+            json.dump(self.data, f)
+        os.replace(partial_path, self.path)
+        if os.path.exists(previous_journal_path):
+            os.remove(previous_journal_path)
+
+    def set_status(self, video_id: str, status: str, job: EnrichmentJob = None):
+        change = {"video_id": video_id, "status": status}
+        if job is not None:
+            change["job"] = {field: getattr(job, field) for field in _JOB_FIELDS}
+            change["job"]["prescan_hits"] = sorted(job.prescan_hits) if job.prescan_hits is not None else None
+        self._apply(change)
+
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        with open(self.journal_path, "a") as f:
+            f.write(json.dumps(change) + "\n")
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._remove_journals()
+
+    def _remove_journals(self, keep: str = None):
+        for journal_path in glob.glob(f"{glob.escape(self.path)}.journal-*"):
+            if journal_path != keep:
+                os.remove(journal_path)
+
+    def _apply(self, change: dict):
+        entry = self.videos.setdefault(change["video_id"], {})
+        entry["status"] = change["status"]
+        if "job" in change:
+            entry["job"] = change["job"]
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # The last line of a crashed run can be cut off
+                    break
+                self._apply(change)
+
+
+# Files of a prepared video stay pinned under the name of the backfill until its request is built, the
+# request points at the uploaded file from then on. The pin survives a restart of the backfill
+def _pin(job: EnrichmentJob, holder: str):
+    media_cache.pin(job.video_path, job.audio_path, job.proxy_path, holder=holder)
+
+
+def _unpin(job: EnrichmentJob, holder: str):
+    media_cache.unpin(job.video_path, job.audio_path, job.proxy_path, holder=holder)
+
+
+def _restore_job(video_id: str, entry: dict) -> EnrichmentJob:
+    job = EnrichmentJob(video_id)
+    saved = entry.get("job", {})
+    for field in _JOB_FIELDS:
+        setattr(job, field, saved.get(field))
+    job.prescan_hits = set(saved["prescan_hits"]) if saved.get("prescan_hits") is not None else None
+    return job
+
+
+# Runs everything up to the Gemini request. Returns True when the video still needs Gemini, False when
+# its outcome is already stored in job.status (a failure or a copied near-duplicate)
+def _prepare(job: EnrichmentJob, db_conn) -> bool:
+    for step in (download_step, fingerprint_step, audio_step):
+        try:
+            step(job, db_conn)
+        except Exception as e:
+            job.error = e
+            break
+
+    if job.error is None and job.duplicate_of is None:
+        try:
+            job.description = get_video_description(job.video_id, db_conn)
+            job.prescan_hits = prescan.scan(job.description, job.transcript)
+            return True
+        except Exception as e:
+            job.error = e
+
+    store_step(job, db_conn)
+    return False
+
+
+def _fail(job: EnrichmentJob, state: _BatchState, db_conn, error: Exception):
+    job.error = error
+    store_step(job, db_conn)
+    _unpin(job, state.holder)
+    state.set_status(job.video_id, job.status)
+
+
+def _submit(state: _BatchState, db_conn, display_name: str):
+    video_ids = [video_id for video_id, entry in state.videos.items() if entry["status"] == "prepared"]
+
+    requests, request_ids, request_bytes = [], [], 0
+    for video_id in video_ids:
+        job = _restore_job(video_id, state.videos[video_id])
+        try:
+            request = VideoProcessor.batch_request(
+                job.proxy_path or job.video_path, job.video_id, job.transcript, job.text_sentiment_analysis,
+                job.description, job.prescan_hits, job.video_path
+            )
+            # Bytes are base64 encoded in the JSON body, the way they are sent
+            size = len(request.model_dump_json(exclude_none=True))
+            if size > GEMINI_BATCH_MAX_BYTES:
+                raise ValueError(f"Gemini batch request of {size} bytes does not fit in {GEMINI_BATCH_MAX_BYTES} bytes")
+        except Exception as e:
+            vxlog.error(f"Could not build the Gemini batch request for video_id: {video_id}: {e}")
+            _fail(job, state, db_conn, e)
+            continue
+        _unpin(job, state.holder)
+
+        if requests and (len(requests) >= GEMINI_BATCH_MAX_REQUESTS or request_bytes + size > GEMINI_BATCH_MAX_BYTES):
+            _submit_job(state, requests, request_ids, display_name)
+            requests, request_ids, request_bytes = [], [], 0
+
+        requests.append(request)
+        request_ids.append(video_id)
+        request_bytes += size
+
+    if requests:
+        _submit_job(state, requests, request_ids, display_name)
+
+
+def _submit_job(state: _BatchState, requests: list, request_ids: list, display_name: str):
+    # A crash between creating the job and saving the state submits these videos again on the next run
+    name = gemini.submit_batch(requests, f"{display_name}-{len(state.batches)}")
+    state.batches.append({"name": name, "video_ids": request_ids, "ingested": False})
+    for video_id in request_ids:
+        state.videos[video_id]["status"] = "submitted"
+    state.save()
+
+
+def _wait(name: str, poll_seconds: float):
+    while True:
+        batch = gemini.get_batch(name)
+        if batch.state in _FINISHED_STATES:
+            return batch
+        vxlog.info(f"Gemini batch {name} is {batch.state}, checking again in {poll_seconds:.0f}s")
+        time.sleep(poll_seconds)
+
+
+# Stores the result of every submitted video through the same path as the worker
+def _ingest(batch_entry: dict, batch, state: _BatchState, db_conn):
+    responses = {}
+    if batch.dest and batch.dest.inlined_responses:
+        for inlined in batch.dest.inlined_responses:
+            video_id = (inlined.metadata or {}).get("video_id")
+            if video_id:
+                responses[video_id] = inlined
+
+    for video_id in batch_entry["video_ids"]:
+        entry = state.videos[video_id]
+        if entry["status"] != "submitted":
+            continue
+
+        job = _restore_job(video_id, entry)
+        inlined = responses.get(video_id)
+        if inlined is None:
+            job.error = RuntimeError(f"Gemini batch {batch.name} ended {batch.state} without a response")
+        elif inlined.error is not None:
+            job.error = RuntimeError(f"Gemini batch request failed: {inlined.error}")
+        else:
+            try:
+                job.analysis_result_json = gemini.parse_response(inlined.response)
+            except Exception as e:
+                job.error = e
+
+        store_step(job, db_conn)
+        state.set_status(video_id, job.status)
+
+    batch_entry["ingested"] = True
+    state.save()
+
+
+def run_batch(video_ids: list, db_conn, state_path: str = None, display_name: str = "zeruel-backfill", poll_seconds: float = GEMINI_BATCH_POLL_SECONDS):
+    state = _BatchState(state_path or os.path.join(batch_state_dir, f"{display_name}.json"))
+
+    # Videos a previous run prepared but did not submit are submitted first, the ones whose files were
+    # evicted in the meantime are prepared again
+    pending = []
+    for video_id, entry in list(state.videos.items()):
+        if entry["status"] != "prepared":
+            continue
+        job = _restore_job(video_id, entry)
+        _pin(job, state.holder)
+        if not all(os.path.exists(path) for path in (job.video_path, job.proxy_path) if path):
+            _unpin(job, state.holder)
+            del state.videos[video_id]
+            pending.append(video_id)
+    state.save()
+    _submit(state, db_conn, display_name)
+
+    # Only one chunk of media is pinned at a time, a full backfill stays inside the media cache quota
+    requeued = set(pending)
+    pending += [video_id for video_id in video_ids if video_id not in state.videos and video_id not in requeued]
+    for start in range(0, len(pending), GEMINI_BATCH_MAX_REQUESTS):
+        for video_id in pending[start:start + GEMINI_BATCH_MAX_REQUESTS]:
+            job = EnrichmentJob(video_id)
+            if _prepare(job, db_conn):
+                _pin(job, state.holder)
+                state.set_status(video_id, "prepared", job)
+            else:
+                state.set_status(video_id, job.status)
+
+        state.save()
+        _submit(state, db_conn, display_name)
+
+    for batch_entry in state.batches:
+        if batch_entry["ingested"]:
+            continue
+        batch = _wait(batch_entry["name"], poll_seconds)
+        vxlog.info(f"Gemini batch {batch.name} finished as {batch.state}")
+        _ingest(batch_entry, batch, state, db_conn)
+
+    statuses = [entry["status"] for entry in state.videos.values()]
+    vxlog.success(f"Batch backfill done, {statuses.count('completed')} of {len(statuses)} videos completed")
+    state.remove()
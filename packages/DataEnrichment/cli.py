@@ -21,6 +21,7 @@ def main():
         logging.info(f"Starting enrichment for video_id: {args.video_id}")
         
         db_conn = db.get_connection()
+        db.ensure_schema(db_conn)
         
         process(args.video_id, db_conn)
         
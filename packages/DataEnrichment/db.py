@@ -2,6 +2,7 @@ import logging
 import psycopg2
 import os
 from dotenv import load_dotenv
+import sqlQueries
 
 load_dotenv()
 
@@ -28,3 +29,16 @@ def get_connection():
     except psycopg2.OperationalError as e:
         logging.error(f"Could not connect to database: {e}")
         raise
+
+
+# Adds the columns and tables the enrichment service writes to, safe to run on every start
+def ensure_schema(connection):
+    try:
+        with connection.cursor() as cur:
+            cur.execute(sqlQueries.VIDEO_FEATURES_MIGRATION_QUERY)
+            cur.execute(sqlQueries.CREATE_VIDEO_FINGERPRINTS_TABLES_QUERY)
+        connection.commit()
+    except psycopg2.Error as e:
+        connection.rollback()
+        logging.error(f"Could not migrate the video_features table: {e}")
+        raise
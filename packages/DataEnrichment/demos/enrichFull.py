@@ -2,6 +2,7 @@ import sys
 import os
 import logging
 import json
+import argparse
 from dotenv import load_dotenv
 
 # Change cwd to the DataEnrichment root folder
@@ -15,8 +16,10 @@ load_dotenv()
 
 import db
 from worker import process
+from batch import run_batch
 
 db_conn = db.get_connection()
+db.ensure_schema(db_conn)
 
 def get_all_video_ids_from_db(conn):
     """
@@ -36,12 +39,28 @@ def get_all_video_ids_from_db(conn):
         return []
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='Send the Gemini requests of all videos as Gemini Batch API jobs instead of one request per video'
+    )
+    parser.add_argument(
+        '--batch-state',
+        default=None,
+        help='State file of the batch backfill, a run with an existing state file resumes it (default tmp/batch/zeruel-backfill.json)'
+    )
+    args = parser.parse_args()
+
     video_ids = get_all_video_ids_from_db(db_conn)
     if video_ids:
         logging.info(f"Successfully fetched {len(video_ids)} video IDs from the database.")
-        # You can now iterate over these IDs and pass them to your worker
-        for video_id in video_ids:
-            process(video_id, db_conn)
+        if args.batch:
+            run_batch(video_ids, db_conn, state_path=args.batch_state)
+        else:
+            # You can now iterate over these IDs and pass them to your worker
+            for video_id in video_ids:
+                process(video_id, db_conn)
     else:
         logging.warning("Could not fetch video IDs from the database, or the table is empty.")
 
@@ -0,0 +1,141 @@
+import os
+import queue
+import threading
+import time
+
+from utils import vxlog
+
+# Connection attempts of a stage worker before the item is failed, with exponential backoff
+PIPELINE_DB_CONNECT_ATTEMPTS = int(os.getenv("PIPELINE_DB_CONNECT_ATTEMPTS", "3"))
+
+# Marks the end of the input for a single stage worker
+_STOP = object()
+
+
+class Stage:
+    def __init__(self, name: str, handler, workers: int = 1, queue_size: int = 4, needs_db: bool = False, handles_errors: bool = False):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        # Bounded input queue, a full queue blocks the previous stage (backpressure)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.needs_db = needs_db
+        # Stages that record failures also receive items that failed in an earlier stage
+        self.handles_errors = handles_errors
+        self.threads = []
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages, each stage with its own worker threads and a
+    bounded input queue, so several items can be in different stages at the same time.
+
+    Handlers are called as handler(item, db_conn). An exception marks item.error and the
+    item is forwarded untouched to the stages that handle errors.
+    """
+
+    def __init__(self, stages: list, connection_factory=None, on_done=None):
+        self.stages = stages
+        self.connection_factory = connection_factory
+        self.on_done = on_done
+        self._started = False
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for worker_index in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._run_stage_worker,
+                    args=(stage, next_stage),
+                    name=f"{stage.name}-{worker_index}",
+                    daemon=True
+                )
+                thread.start()
+                stage.threads.append(thread)
+
+        self._started = True
+        vxlog.info("Pipeline started: " + " → ".join(f"{stage.name}({stage.workers})" for stage in self.stages))
+
+    # Blocks while the first stage is full
+    def submit(self, item):
+        if not self._started:
+            raise RuntimeError("Pipeline must be started before submitting items")
+        self.stages[0].queue.put(item)
+
+    def depth(self) -> int:
+        return sum(stage.queue.qsize() for stage in self.stages)
+
+    # Drains every item already submitted, then stops the workers stage by stage
+    def close(self):
+        for stage in self.stages:
+            for _ in stage.threads:
+                stage.queue.put(_STOP)
+            for thread in stage.threads:
+                thread.join()
+            stage.threads = []
+
+        self._started = False
+        vxlog.info("Pipeline drained and stopped")
+
+    # Connection for a stage worker, retried a few times so a short database outage does not fail items.
+    # Returns None when the database stays unreachable
+    def _connect(self, stage: Stage):
+        for attempt in range(PIPELINE_DB_CONNECT_ATTEMPTS):
+            try:
+                return self.connection_factory()
+            except Exception as e:
+                vxlog.error(f"Stage '{stage.name}' could not connect to the database (attempt {attempt + 1}/{PIPELINE_DB_CONNECT_ATTEMPTS}): {e}")
+                if attempt + 1 < PIPELINE_DB_CONNECT_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+        return None
+
+    def _run_stage_worker(self, stage: Stage, next_stage: Stage):
+        db_conn = None
+        try:
+            while True:
+                item = stage.queue.get()
+                if item is _STOP:
+                    break
+
+                failed = False
+                if getattr(item, "error", None) is None or stage.handles_errors:
+                    # Connected lazily and again after a failure, a worker without a connection keeps
+                    # draining its queue instead of dying and blocking the stages before it
+                    if stage.needs_db and db_conn is None:
+                        db_conn = self._connect(stage)
+
+                    if stage.needs_db and db_conn is None:
+                        failed = True
+                        item.error = item.error or ConnectionError(f"Stage '{stage.name}' has no database connection")
+                    else:
+                        try:
+                            stage.handler(item, db_conn)
+                        except Exception as e:
+                            vxlog.error(f"Stage '{stage.name}' failed for {item}: {e}")
+                            item.error = e
+                            failed = True
+                            # The connection can be broken or stuck in an aborted transaction
+                            if db_conn is not None:
+                                _close_quietly(db_conn)
+                                db_conn = None
+
+                if next_stage is not None:
+                    next_stage.queue.put(item)
+                elif failed:
+                    # The outcome was not recorded, the item is not completed so its queue redelivers it
+                    vxlog.warning(f"Outcome of {item} was not recorded, leaving it for redelivery")
+                elif self.on_done:
+                    try:
+                        self.on_done(item)
+                    except Exception as e:
+                        vxlog.error(f"Pipeline completion callback failed for {item}: {e}")
+        finally:
+            if db_conn:
+                db_conn.close()
+
+
+def _close_quietly(db_conn):
+    try:
+        db_conn.close()
+    except Exception:
+        pass
@@ -0,0 +1,2 @@
+from .redis_streams import RedisStreamQueue
+from .postgres_leases import PostgresLeaseQueue
@@ -0,0 +1,129 @@
+import os
+import socket
+import threading
+import time
+
+import sqlQueries
+from utils import vxlog
+
+# Lease length, a worker that stops renewing its leases for this long is treated as crashed
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "600"))
+LEASE_BATCH_SIZE = int(os.getenv("LEASE_BATCH_SIZE", "4"))
+# A video whose lease expired this many times in a row (the worker died on it) is left alone. Releasing
+# a lease resets the count, so videos in LEASE_RETRY_STATUSES are claimed again however often they fail
+LEASE_MAX_ATTEMPTS = int(os.getenv("LEASE_MAX_ATTEMPTS", "3"))
+LEASE_POLL_SECONDS = float(os.getenv("LEASE_POLL_SECONDS", "10"))
+# Comma separated enrichment statuses that are claimed again, e.g. "failed"
+LEASE_RETRY_STATUSES = [status.strip() for status in os.getenv("LEASE_RETRY_STATUSES", "").split(",") if status.strip()]
+
+
+class PostgresLeaseQueue:
+    """
+    Work queue backed by the videos table. Workers claim batches of videos by taking a lease
+    in enrichment_leases, renew the leases while working and release them once the outcome
+    is stored. Leases of crashed workers expire and the videos become claimable again.
+
+    Exposes the same read()/ack() interface as RedisStreamQueue, the receipt is the video_id.
+    """
+
+    def __init__(self, connection_factory, worker_id: str = None):
+        self.connection_factory = connection_factory
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._conn = None
+        # The heartbeat thread and the consumer share the connection
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stopped = threading.Event()
+        self._depth = (0.0, 0)
+
+    def ensure_schema(self):
+        self._execute(sqlQueries.CREATE_ENRICHMENT_LEASES_TABLE_QUERY)
+
+    def start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._renew_loop, name="lease-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+    # Makes a blocked read() return, safe to call from a signal handler
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        self.stop()
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    # Returns a list of (receipt, video_id), polls until at least one video is claimed
+    def read(self, count: int = LEASE_BATCH_SIZE) -> list:
+        self.start_heartbeat()
+
+        while not self._stopped.is_set():
+            self._give_up_exhausted()
+            rows = self._execute(sqlQueries.CLAIM_ENRICHMENT_LEASES_QUERY, {
+                "retry_statuses": LEASE_RETRY_STATUSES,
+                "max_attempts": LEASE_MAX_ATTEMPTS,
+                "batch_size": count,
+                "worker_id": self.worker_id,
+                "lease_seconds": LEASE_SECONDS,
+            }, fetch=True)
+
+            if rows:
+                video_ids = [row[0] for row in rows]
+                vxlog.info(f"Claimed {len(video_ids)} videos as '{self.worker_id}'")
+                return [(video_id, video_id) for video_id in video_ids]
+
+            self._stopped.wait(LEASE_POLL_SECONDS)
+        return []
+
+    # Backlog size, counted at most once a minute because the count scans the videos table
+    def depth(self) -> int:
+        counted_at, depth = self._depth
+        if time.monotonic() - counted_at > 60:
+            rows = self._execute(sqlQueries.COUNT_CLAIMABLE_VIDEOS_QUERY, {
+                "retry_statuses": LEASE_RETRY_STATUSES,
+                "max_attempts": LEASE_MAX_ATTEMPTS,
+            }, fetch=True)
+            depth = rows[0][0]
+            self._depth = (time.monotonic(), depth)
+        return depth
+
+    def ack(self, video_id: str):
+        self._execute(sqlQueries.RELEASE_ENRICHMENT_LEASE_QUERY, {
+            "video_id": video_id,
+            "worker_id": self.worker_id,
+        })
+
+    def dead_letter(self, video_id: str, _video_id: str, reason: str):
+        vxlog.warning(f"Releasing lease for {video_id} without processing: {reason}")
+        self.ack(video_id)
+
+    # Clears the expired leases of videos that ran out of attempts, each one is logged once
+    def _give_up_exhausted(self):
+        rows = self._execute(sqlQueries.GIVE_UP_EXHAUSTED_LEASES_QUERY, {"max_attempts": LEASE_MAX_ATTEMPTS}, fetch=True)
+        for video_id, attempts in rows:
+            vxlog.error(f"Giving up on {video_id}, its lease expired {attempts} times without being released")
+
+    def _renew_loop(self):
+        while not self._stopped.wait(LEASE_SECONDS / 3):
+            try:
+                self._execute(sqlQueries.RENEW_ENRICHMENT_LEASES_QUERY, {
+                    "worker_id": self.worker_id,
+                    "lease_seconds": LEASE_SECONDS,
+                })
+            except Exception as e:
+                vxlog.error(f"Failed to renew leases for '{self.worker_id}': {e}")
+
+    def _execute(self, query: str, params: dict = None, fetch: bool = False):
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                self._conn = self.connection_factory()
+            try:
+                with self._conn.cursor() as cur:
+                    cur.execute(query, params)
+                    rows = cur.fetchall() if fetch else None
+                self._conn.commit()
+                return rows
+            except Exception:
+                self._conn.rollback()
+                raise
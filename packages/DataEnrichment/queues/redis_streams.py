@@ -0,0 +1,112 @@
+import os
+import socket
+import redis
+
+from utils import vxlog
+
+ENRICHMENT_STREAM = os.getenv("ENRICHMENT_STREAM", "enrichment_stream")
+ENRICHMENT_CONSUMER_GROUP = os.getenv("ENRICHMENT_CONSUMER_GROUP", "enrichment_workers")
+ENRICHMENT_DEAD_LETTER_STREAM = os.getenv("ENRICHMENT_DEAD_LETTER_STREAM", f"{ENRICHMENT_STREAM}:dead")
+
+# Entries left unacked this long belong to a crashed consumer and are claimed by a live one.
+# Must be longer than the slowest enrichment, otherwise a busy consumer gets its work stolen
+STREAM_CLAIM_IDLE_MS = int(os.getenv("STREAM_CLAIM_IDLE_MS", str(30 * 60 * 1000)))
+# Entries delivered this many times without an ack are moved to the dead letter stream
+STREAM_MAX_DELIVERIES = int(os.getenv("STREAM_MAX_DELIVERIES", "3"))
+STREAM_BLOCK_MS = int(os.getenv("STREAM_BLOCK_MS", "5000"))
+
+
+class RedisStreamQueue:
+    def __init__(self, redis_client: redis.Redis, consumer_name: str = None):
+        self.redis = redis_client
+        self.stream = ENRICHMENT_STREAM
+        self.group = ENRICHMENT_CONSUMER_GROUP
+        self.consumer_name = consumer_name or f"{socket.gethostname()}-{os.getpid()}"
+
+    def ensure_group(self):
+        try:
+            # Start from the beginning of the stream so entries added before the first worker are not skipped
+            self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+            vxlog.info(f"Created consumer group '{self.group}' on stream '{self.stream}'")
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    # Returns a list of (message_id, video_id), reclaimed entries of crashed consumers come first
+    def read(self, count: int = 1) -> list:
+        messages = self._reclaim(count)
+        if messages:
+            return messages
+
+        response = self.redis.xreadgroup(
+            self.group,
+            self.consumer_name,
+            {self.stream: ">"},
+            count=count,
+            block=STREAM_BLOCK_MS
+        )
+
+        for _stream, entries in response or []:
+            for message_id, fields in entries:
+                messages.append((message_id, fields.get("video_id")))
+        return messages
+
+    def ack(self, message_id: str):
+        self.redis.xack(self.stream, self.group, message_id)
+
+    def depth(self) -> int:
+        try:
+            groups = self.redis.xinfo_groups(self.stream)
+        except redis.exceptions.ResponseError:
+            return 0
+        for group in groups:
+            if group.get("name") == self.group:
+                return int(group.get("lag") or 0) + int(group.get("pending") or 0)
+        return 0
+
+    def dead_letter(self, message_id: str, video_id: str, reason: str):
+        self.redis.xadd(ENRICHMENT_DEAD_LETTER_STREAM, {
+            "video_id": video_id or "",
+            "message_id": message_id,
+            "reason": reason
+        })
+        self.ack(message_id)
+        vxlog.warning(f"Moved {message_id} (video_id: {video_id}) to '{ENRICHMENT_DEAD_LETTER_STREAM}': {reason}")
+
+    def _reclaim(self, count: int) -> list:
+        pending = self.redis.xpending_range(
+            self.stream,
+            self.group,
+            min="-",
+            max="+",
+            count=count,
+            idle=STREAM_CLAIM_IDLE_MS
+        )
+        if not pending:
+            return []
+
+        claimed = self.redis.xclaim(
+            self.stream,
+            self.group,
+            self.consumer_name,
+            STREAM_CLAIM_IDLE_MS,
+            [entry["message_id"] for entry in pending]
+        )
+        deliveries = {entry["message_id"]: entry["times_delivered"] for entry in pending}
+
+        messages = []
+        for message_id, fields in claimed:
+            video_id = fields.get("video_id") if fields else None
+
+            # The entry was trimmed from the stream, nothing left to process
+            if video_id is None:
+                self.ack(message_id)
+                continue
+
+            if deliveries.get(message_id, 0) >= STREAM_MAX_DELIVERIES:
+                self.dead_letter(message_id, video_id, f"delivered {deliveries[message_id]} times without an ack")
+                continue
+
+            vxlog.info(f"Reclaimed {message_id} (video_id: {video_id}) from a stalled consumer")
+            messages.append((message_id, video_id))
+        return messages
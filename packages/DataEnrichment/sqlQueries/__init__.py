@@ -4,12 +4,14 @@ UPDATE_SUCCESSFUL_ENRICHMENT_QUERY = """--sql
         video_id, transcript, detected_language, enrichment_status, last_enriched_at,
         llm_summary, llm_identified_subjects, llm_overall_alignment, llm_model_name,
         final_alignment, deterministic_alignment, alignment_conflict,
-        text_sentiment_positive, text_sentiment_negative, text_sentiment_neutral, polarity
+        text_sentiment_positive, text_sentiment_negative, text_sentiment_neutral, polarity,
+        speech_ratio, whisper_model_name, sentiment_timeline
     ) VALUES (
         %s, %s, %s, %s, CURRENT_TIMESTAMP,
         %s, %s, %s, %s,
         %s, %s, %s,
-        %s, %s, %s, %s
+        %s, %s, %s, %s,
+        %s, %s, %s
     )
     ON CONFLICT (video_id) DO UPDATE SET
         transcript = EXCLUDED.transcript,
@@ -26,7 +28,11 @@ UPDATE_SUCCESSFUL_ENRICHMENT_QUERY = """--sql
         text_sentiment_positive = EXCLUDED.text_sentiment_positive,
         text_sentiment_negative = EXCLUDED.text_sentiment_negative,
         text_sentiment_neutral = EXCLUDED.text_sentiment_neutral,
-        polarity = EXCLUDED.polarity;
+        polarity = EXCLUDED.polarity,
+        speech_ratio = EXCLUDED.speech_ratio,
+        whisper_model_name = EXCLUDED.whisper_model_name,
+        sentiment_timeline = EXCLUDED.sentiment_timeline,
+        duplicate_of = NULL;
 """
 
 
@@ -38,4 +44,197 @@ UPDATE_ENRICHMENT_STATUS_ON_FAILURE_QUERY = """--sql
     ON CONFLICT (video_id) DO UPDATE SET
         enrichment_status = EXCLUDED.enrichment_status,
         last_enriched_at = CURRENT_TIMESTAMP;
-"""
\ No newline at end of file
+"""
+
+# Columns added to video_features by the enrichment service, applied on startup by db.ensure_schema
+VIDEO_FEATURES_MIGRATION_QUERY = """--sql
+    ALTER TABLE video_features ADD COLUMN IF NOT EXISTS speech_ratio REAL;
+    ALTER TABLE video_features ADD COLUMN IF NOT EXISTS whisper_model_name TEXT;
+    -- One [start, end, positive, negative, neutral] row per transcript segment
+    ALTER TABLE video_features ADD COLUMN IF NOT EXISTS sentiment_timeline REAL[][];
+    -- Set when the results were copied from a near-duplicate video instead of being computed
+    ALTER TABLE video_features ADD COLUMN IF NOT EXISTS duplicate_of TEXT;
+"""
+
+
+# Lease table used by the Postgres work queue, a row exists for every video a worker has ever claimed
+# leased_until is NULL once the lease is released and in the past once the worker holding it died
+CREATE_ENRICHMENT_LEASES_TABLE_QUERY = """--sql
+    CREATE TABLE IF NOT EXISTS public.enrichment_leases (
+        video_id TEXT PRIMARY KEY,
+        worker_id TEXT,
+        leased_until TIMESTAMPTZ,
+        attempts INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS enrichment_leases_leased_until_idx ON public.enrichment_leases (leased_until);
+    -- Released leases used to keep their attempts
+    UPDATE public.enrichment_leases SET attempts = 0
+    WHERE leased_until IS NULL AND worker_id IS NULL AND attempts > 0;
+"""
+
+
+# Claims a batch of unprocessed videos (or videos in one of the retry statuses) whose lease is free or expired.
+# SKIP LOCKED lets concurrent workers claim disjoint batches, the WHERE on the conflict update keeps a
+# worker from overwriting a lease another worker committed after this statement took its snapshot
+CLAIM_ENRICHMENT_LEASES_QUERY = """--sql
+    WITH candidates AS (
+        SELECT v.video_id
+        FROM public.videos v
+        LEFT JOIN public.video_features vf ON v.video_id = vf.video_id
+        LEFT JOIN public.enrichment_leases l ON v.video_id = l.video_id
+        WHERE (vf.video_id IS NULL OR vf.enrichment_status = ANY(%(retry_statuses)s))
+          AND (l.video_id IS NULL OR l.leased_until IS NULL OR l.leased_until < CURRENT_TIMESTAMP)
+          AND COALESCE(l.attempts, 0) < %(max_attempts)s
+        ORDER BY v.created_at DESC
+        LIMIT %(batch_size)s
+        FOR UPDATE OF v SKIP LOCKED
+    )
+    INSERT INTO public.enrichment_leases (video_id, worker_id, leased_until, attempts)
+    SELECT video_id, %(worker_id)s, CURRENT_TIMESTAMP + %(lease_seconds)s * INTERVAL '1 second', 1
+    FROM candidates
+    ON CONFLICT (video_id) DO UPDATE SET
+        worker_id = EXCLUDED.worker_id,
+        leased_until = EXCLUDED.leased_until,
+        attempts = enrichment_leases.attempts + 1
+    WHERE enrichment_leases.leased_until IS NULL OR enrichment_leases.leased_until < CURRENT_TIMESTAMP
+    RETURNING video_id;
+"""
+
+
+# Number of videos that can still be claimed, used as the backlog size
+COUNT_CLAIMABLE_VIDEOS_QUERY = """--sql
+    SELECT COUNT(*)
+    FROM public.videos v
+    LEFT JOIN public.video_features vf ON v.video_id = vf.video_id
+    LEFT JOIN public.enrichment_leases l ON v.video_id = l.video_id
+    WHERE (vf.video_id IS NULL OR vf.enrichment_status = ANY(%(retry_statuses)s))
+      AND (l.video_id IS NULL OR l.leased_until IS NULL OR l.leased_until < CURRENT_TIMESTAMP)
+      AND COALESCE(l.attempts, 0) < %(max_attempts)s;
+"""
+
+
+# Extends every lease the worker still holds, runs periodically while videos are being processed
+RENEW_ENRICHMENT_LEASES_QUERY = """--sql
+    UPDATE public.enrichment_leases
+    SET leased_until = CURRENT_TIMESTAMP + %(lease_seconds)s * INTERVAL '1 second'
+    WHERE worker_id = %(worker_id)s AND leased_until IS NOT NULL;
+"""
+
+
+# attempts counts the leases that expired in a row, a released lease starts over
+RELEASE_ENRICHMENT_LEASE_QUERY = """--sql
+    UPDATE public.enrichment_leases
+    SET leased_until = NULL, worker_id = NULL, attempts = 0
+    WHERE video_id = %(video_id)s AND worker_id = %(worker_id)s;
+"""
+
+
+# Clears the expired leases of videos that ran out of attempts, they stay unclaimable and are only returned once.
+# worker_id keeps the last worker that died on the video
+GIVE_UP_EXHAUSTED_LEASES_QUERY = """--sql
+    UPDATE public.enrichment_leases
+    SET leased_until = NULL
+    WHERE leased_until < CURRENT_TIMESTAMP AND attempts >= %(max_attempts)s
+    RETURNING video_id, attempts;
+"""
+
+
+# Perceptual fingerprints of every downloaded video, hashes are unsigned 64 bit values stored as BIGINT
+# and the audio sub-fingerprints unsigned 32 bit values stored as INTEGER.
+# The bands table splits every hash into 8 bit bands so that near-duplicates (hashes that differ in
+# fewer bits than there are bands) always share at least one exact band value with the query
+CREATE_VIDEO_FINGERPRINTS_TABLES_QUERY = """--sql
+    CREATE TABLE IF NOT EXISTS public.video_fingerprints (
+        video_id TEXT PRIMARY KEY,
+        duration REAL,
+        audio_hash BIGINT,
+        frame_hashes BIGINT[],
+        created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE public.video_fingerprints ADD COLUMN IF NOT EXISTS audio_frames INTEGER[];
+    CREATE TABLE IF NOT EXISTS public.video_fingerprint_bands (
+        kind SMALLINT NOT NULL,
+        band SMALLINT NOT NULL,
+        value SMALLINT NOT NULL,
+        video_id TEXT NOT NULL,
+        PRIMARY KEY (kind, band, value, video_id)
+    );
+    CREATE INDEX IF NOT EXISTS video_fingerprint_bands_video_id_idx ON public.video_fingerprint_bands (video_id);
+"""
+
+
+UPSERT_VIDEO_FINGERPRINT_QUERY = """--sql
+    INSERT INTO public.video_fingerprints (video_id, duration, audio_hash, audio_frames, frame_hashes)
+    VALUES (%(video_id)s, %(duration)s, %(audio_hash)s, %(audio_frames)s, %(frame_hashes)s)
+    ON CONFLICT (video_id) DO UPDATE SET
+        duration = EXCLUDED.duration,
+        audio_hash = EXCLUDED.audio_hash,
+        audio_frames = EXCLUDED.audio_frames,
+        frame_hashes = EXCLUDED.frame_hashes,
+        created_at = CURRENT_TIMESTAMP;
+    DELETE FROM public.video_fingerprint_bands WHERE video_id = %(video_id)s;
+    INSERT INTO public.video_fingerprint_bands (kind, band, value, video_id)
+    SELECT kind, band, value, %(video_id)s
+    FROM unnest(%(kinds)s::SMALLINT[], %(bands)s::SMALLINT[], %(values)s::SMALLINT[]) AS b(kind, band, value)
+    ON CONFLICT DO NOTHING;
+"""
+
+
+# Completed videos sharing the most band values with the query fingerprint
+FIND_FINGERPRINT_CANDIDATES_QUERY = """--sql
+    SELECT f.video_id, f.duration, f.audio_hash, f.audio_frames, f.frame_hashes
+    FROM (
+        SELECT b.video_id, COUNT(*) AS shared_bands
+        FROM public.video_fingerprint_bands b
+        JOIN unnest(%(kinds)s::SMALLINT[], %(bands)s::SMALLINT[], %(values)s::SMALLINT[]) AS q(kind, band, value)
+          ON b.kind = q.kind AND b.band = q.band AND b.value = q.value
+        WHERE b.video_id <> %(video_id)s
+        GROUP BY b.video_id
+        ORDER BY shared_bands DESC
+        LIMIT %(limit)s
+    ) candidates
+    JOIN public.video_fingerprints f ON f.video_id = candidates.video_id
+    JOIN public.video_features vf ON vf.video_id = candidates.video_id
+    WHERE vf.enrichment_status = 'completed'
+    ORDER BY candidates.shared_bands DESC;
+"""
+
+
+# Copies the enrichment of a near-duplicate, duplicate_of always points at the video that was actually analysed
+COPY_DUPLICATE_ENRICHMENT_QUERY = """--sql
+    INSERT INTO video_features (
+        video_id, transcript, detected_language, enrichment_status, last_enriched_at,
+        llm_summary, llm_identified_subjects, llm_overall_alignment, llm_model_name,
+        final_alignment, deterministic_alignment, alignment_conflict,
+        text_sentiment_positive, text_sentiment_negative, text_sentiment_neutral, polarity,
+        speech_ratio, whisper_model_name, sentiment_timeline, duplicate_of
+    )
+    SELECT
+        %(video_id)s, transcript, detected_language, 'completed', CURRENT_TIMESTAMP,
+        llm_summary, llm_identified_subjects, llm_overall_alignment, llm_model_name,
+        final_alignment, deterministic_alignment, alignment_conflict,
+        text_sentiment_positive, text_sentiment_negative, text_sentiment_neutral, polarity,
+        speech_ratio, whisper_model_name, sentiment_timeline, COALESCE(duplicate_of, video_id)
+    FROM video_features
+    WHERE video_id = %(source_video_id)s AND enrichment_status = 'completed'
+    ON CONFLICT (video_id) DO UPDATE SET
+        transcript = EXCLUDED.transcript,
+        detected_language = EXCLUDED.detected_language,
+        enrichment_status = 'completed',
+        last_enriched_at = CURRENT_TIMESTAMP,
+        llm_summary = EXCLUDED.llm_summary,
+        llm_identified_subjects = EXCLUDED.llm_identified_subjects,
+        llm_overall_alignment = EXCLUDED.llm_overall_alignment,
+        llm_model_name = EXCLUDED.llm_model_name,
+        final_alignment = EXCLUDED.final_alignment,
+        deterministic_alignment = EXCLUDED.deterministic_alignment,
+        alignment_conflict = EXCLUDED.alignment_conflict,
+        text_sentiment_positive = EXCLUDED.text_sentiment_positive,
+        text_sentiment_negative = EXCLUDED.text_sentiment_negative,
+        text_sentiment_neutral = EXCLUDED.text_sentiment_neutral,
+        polarity = EXCLUDED.polarity,
+        speech_ratio = EXCLUDED.speech_ratio,
+        whisper_model_name = EXCLUDED.whisper_model_name,
+        sentiment_timeline = EXCLUDED.sentiment_timeline,
+        duplicate_of = EXCLUDED.duplicate_of;
+"""
@@ -0,0 +1,138 @@
+import gc
+import os
+import signal
+import time
+
+from utils import vxlog
+
+# Seconds the children get to finish their current videos after a SIGTERM before they are killed
+SUPERVISOR_GRACE_SECONDS = float(os.getenv("SUPERVISOR_GRACE_SECONDS", "300"))
+# A child that dies sooner than this after starting is restarted with an increasing delay
+SUPERVISOR_MIN_UPTIME_SECONDS = float(os.getenv("SUPERVISOR_MIN_UPTIME_SECONDS", "30"))
+SUPERVISOR_MAX_BACKOFF_SECONDS = float(os.getenv("SUPERVISOR_MAX_BACKOFF_SECONDS", "60"))
+
+
+class _Child:
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.pid = None
+        self.started_at = 0.0
+        self.failures = 0
+        # Monotonic time the crashed child is started again at, the main loop keeps reaping until then
+        self.restart_at = None
+
+
+class Supervisor:
+    """
+    Pre-forking supervisor. Everything loaded before run() (sentiment models, the Gemini client)
+    is shared with the children copy-on-write. Crashed children are restarted, on SIGTERM/SIGINT
+    the children are asked to drain and are killed if they outlive the grace period.
+    """
+
+    def __init__(self, worker_count: int, child_main):
+        self.worker_count = worker_count
+        self.child_main = child_main
+        self.children = [_Child(slot) for slot in range(worker_count)]
+        self._stopping = False
+        self._stop_requested_at = None
+
+    def run(self):
+        # Move everything allocated so far into the permanent generation, otherwise the garbage
+        # collector touches the shared objects in every child and the pages get copied anyway
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        for child in self.children:
+            self._spawn(child)
+
+        vxlog.info(f"Supervisor {os.getpid()} started {self.worker_count} workers")
+
+        while any(child.pid or child.restart_at is not None for child in self.children):
+            self._reap()
+            self._restart_due()
+
+            if self._stopping and time.monotonic() - self._stop_requested_at > SUPERVISOR_GRACE_SECONDS:
+                for child in self.children:
+                    if child.pid:
+                        vxlog.warning(f"Worker {child.slot} (pid {child.pid}) did not drain in time, killing it")
+                        self._signal(child, signal.SIGKILL)
+                self._stop_requested_at = float("inf")
+
+            time.sleep(0.5)
+
+        vxlog.info("All workers stopped, supervisor exiting")
+
+    def _spawn(self, child: _Child):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.child_main(child.slot)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 0
+            except BaseException as e:
+                vxlog.error(f"Worker {child.slot} crashed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        child.pid = pid
+        child.started_at = time.monotonic()
+        vxlog.info(f"Started worker {child.slot} with pid {pid}")
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            child = next((c for c in self.children if c.pid == pid), None)
+            if child is None:
+                continue
+            child.pid = None
+
+            exit_code = os.waitstatus_to_exitcode(status)
+            if self._stopping:
+                vxlog.info(f"Worker {child.slot} exited with code {exit_code}")
+                continue
+
+            if time.monotonic() - child.started_at < SUPERVISOR_MIN_UPTIME_SECONDS:
+                child.failures += 1
+            else:
+                child.failures = 0
+
+            backoff = min(SUPERVISOR_MAX_BACKOFF_SECONDS, 2 ** child.failures - 1)
+            vxlog.warning(f"Worker {child.slot} exited with code {exit_code}, restarting in {backoff}s")
+            child.restart_at = time.monotonic() + backoff
+
+    def _restart_due(self):
+        now = time.monotonic()
+        for child in self.children:
+            if child.restart_at is not None and now >= child.restart_at:
+                child.restart_at = None
+                self._spawn(child)
+
+    def _request_stop(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        self._stop_requested_at = time.monotonic()
+        vxlog.info(f"Received signal {signum}, draining workers")
+        for child in self.children:
+            child.restart_at = None
+            self._signal(child, signal.SIGTERM)
+
+    def _signal(self, child: _Child, signum):
+        if child.pid:
+            try:
+                os.kill(child.pid, signum)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,4 @@
+import os
+
+# The Gemini client is created at import time and needs a key, tests never reach the real API
+os.environ.setdefault("GEMINI_API_KEY", "test")
@@ -0,0 +1,29 @@
+from utils.aho_corasick import AhoCorasick
+from AlignmentCalculator import prescan
+
+
+def test_finds_overlapping_and_nested_patterns():
+    matcher = AhoCorasick({"he": "he", "she": "she", "his": "his", "hers": "hers"})
+
+    matches = sorted(matcher.iter_matches("ushers"))
+
+    assert matches == [(1, 4, "she"), (2, 4, "he"), (2, 6, "hers")]
+
+
+def test_failure_links_recover_after_a_partial_match():
+    matcher = AhoCorasick({"abcd": 1, "bce": 2})
+
+    assert matcher.find_all("abce") == {2}
+    assert matcher.find_all("xabcdx") == {1}
+    assert matcher.find_all("") == set()
+
+
+def test_empty_patterns_are_ignored():
+    assert AhoCorasick({"": "empty"}).find_all("anything") == set()
+
+
+def test_prescan_matches_whole_words_without_diacritics():
+    matcher = AhoCorasick({prescan.normalize("Ion Țiriac"): "ion tiriac"})
+
+    assert matcher.find_all(prescan.normalize("Interviu cu ION TIRIAC, azi")) == {"ion tiriac"}
+    assert matcher.find_all(prescan.normalize("ion tiriacul")) == set()
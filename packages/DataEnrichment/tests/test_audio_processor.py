@@ -0,0 +1,71 @@
+import numpy as np
+
+import AudioProcessor
+from AudioProcessor import vad
+
+
+def _transcribe(audio, model_name):
+    return {"transcript": "", "language": "ro", "segments": [], "model": model_name}
+
+
+def test_low_speech_clips_are_still_transcribed_by_default(monkeypatch):
+    monkeypatch.setattr(AudioProcessor, "transcribe", _transcribe)
+    monkeypatch.setattr(AudioProcessor.SentimentAnalyzer, "get_sentiment_batch", lambda items: [dict(AudioProcessor.NO_SENTIMENT) for _ in items])
+
+    result = AudioProcessor.process(np.zeros(16000 * 5, dtype=np.float32))
+
+    assert result["speech_ratio"] < vad.VAD_MIN_SPEECH_RATIO
+    assert result["whisper_model"] == AudioProcessor.DEFAULT_MODEL_NAME
+
+
+def test_low_speech_clips_are_skipped_when_enabled(monkeypatch):
+    monkeypatch.setattr(vad, "VAD_SKIP_LOW_SPEECH", True)
+    monkeypatch.setattr(AudioProcessor, "transcribe", _transcribe)
+
+    result = AudioProcessor.process(np.zeros(16000 * 5, dtype=np.float32))
+
+    assert result["whisper_model"] is None
+    assert result["transcript"] == ""
+
+
+# Voiced syllables (150 Hz harmonics, 4 per second) under a loud bass line
+def _speech_over_music(seconds: int) -> np.ndarray:
+    t = np.arange(seconds * 16000) / 16000
+    voice = sum(np.sin(2 * np.pi * 150 * harmonic * t) / harmonic for harmonic in range(1, 20))
+    syllables = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)
+    bass = 0.8 * np.sin(2 * np.pi * 55 * t) + 0.4 * np.sin(2 * np.pi * 110 * t)
+    return (0.05 * voice * syllables + bass).astype(np.float32)
+
+
+def _transcribed_lengths(monkeypatch) -> list:
+    lengths = []
+
+    def transcribe(audio, model_name):
+        lengths.append(len(audio))
+        return _transcribe(audio, model_name)
+
+    monkeypatch.setattr(AudioProcessor, "transcribe", transcribe)
+    monkeypatch.setattr(AudioProcessor.SentimentAnalyzer, "get_sentiment_batch", lambda items: [dict(AudioProcessor.NO_SENTIMENT) for _ in items])
+    return lengths
+
+
+def test_speech_over_music_reaches_whisper_whole(monkeypatch):
+    lengths = _transcribed_lengths(monkeypatch)
+    pcm = _speech_over_music(30)
+
+    result = AudioProcessor.process(pcm)
+
+    # The VAD does not see the speech under the music
+    assert result["speech_ratio"] < vad.VAD_MIN_SPEECH_RATIO
+    assert lengths == [len(pcm)]
+
+
+def test_trimming_keeps_the_audio_whole_when_it_would_remove_most_of_it(monkeypatch):
+    monkeypatch.setattr(vad, "VAD_TRIM_SILENCE", True)
+    monkeypatch.setattr(vad, "VAD_MIN_SPEECH_RATIO", 0.0)
+    lengths = _transcribed_lengths(monkeypatch)
+    pcm = _speech_over_music(30)
+
+    AudioProcessor.process(pcm)
+
+    assert lengths == [len(pcm)]
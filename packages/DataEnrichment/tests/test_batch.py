@@ -0,0 +1,140 @@
+import glob
+import importlib
+import json
+import os
+import threading
+
+import pytest
+
+import batch
+from batch import _BatchState
+from utils import kv_cache
+from utils.media_cache import PIN_MARKER
+from VideoProcessor.gemini import standin
+from worker import EnrichmentJob
+
+# VideoProcessor re-exports the processor instance under the module's name
+gemini_module = importlib.import_module("VideoProcessor.gemini")
+
+
+def _prepared_job(video_id: str) -> EnrichmentJob:
+    job = EnrichmentJob(video_id)
+    job.video_path = f"/tmp/video/{video_id}.mp4"
+    job.transcript = "salut"
+    job.prescan_hits = {"b", "a"}
+    return job
+
+
+def test_status_changes_survive_a_crash_without_a_checkpoint(tmp_path):
+    path = str(tmp_path / "backfill.json")
+    state = _BatchState(path)
+    state.set_status("1", "prepared", _prepared_job("1"))
+    state.set_status("2", "failed")
+
+    # Only the journal was written
+    assert not os.path.exists(path)
+    with open(state.journal_path, "a") as f:
+        f.write('{"video_id": "3", "sta')
+
+    resumed = _BatchState(path)
+    assert resumed.videos["1"]["status"] == "prepared"
+    assert resumed.videos["1"]["job"]["prescan_hits"] == ["a", "b"]
+    assert resumed.videos["2"]["status"] == "failed"
+    assert "3" not in resumed.videos
+
+
+def test_checkpoint_starts_a_new_journal(tmp_path):
+    path = str(tmp_path / "backfill.json")
+    state = _BatchState(path)
+    state.set_status("1", "prepared", _prepared_job("1"))
+    state.save()
+    state.videos["1"]["status"] = "submitted"
+    state.save()
+
+    # A journal left behind by a crash during the checkpoint is not replayed over the newer state
+    with open(f"{path}.journal-0", "w") as f:
+        f.write(json.dumps({"video_id": "1", "status": "prepared"}) + "\n")
+
+    assert _BatchState(path).videos["1"]["status"] == "submitted"
+    assert not os.path.exists(f"{path}.journal-0")
+
+
+class _Request:
+    def __init__(self, size: int):
+        self.size = size
+
+    def model_dump_json(self, exclude_none: bool = False) -> str:
+        return "x" * self.size
+
+
+def test_jobs_are_split_by_request_bytes(tmp_path, monkeypatch):
+    state = _BatchState(str(tmp_path / "backfill.json"))
+    for video_id in "1234":
+        state.set_status(video_id, "prepared", _prepared_job(video_id))
+
+    sizes = {"1": 400, "2": 400, "3": 400, "4": 2000}
+    monkeypatch.setattr(batch, "GEMINI_BATCH_MAX_BYTES", 1000)
+    monkeypatch.setattr(batch.VideoProcessor, "batch_request", lambda video_path, video_id, *args: _Request(sizes[video_id]))
+    submitted = []
+    monkeypatch.setattr(batch.gemini, "submit_batch", lambda requests, display_name: submitted.append(len(requests)) or display_name)
+    failed = []
+    monkeypatch.setattr(batch, "_fail", lambda job, state, db_conn, error: failed.append(job.video_id))
+
+    batch._submit(state, None, "backfill")
+
+    assert submitted == [2, 1]
+    assert failed == ["4"]
+    assert [entry["video_ids"] for entry in state.batches] == [["1", "2"], ["3"]]
+
+
+@pytest.fixture
+def processor(tmp_path, monkeypatch):
+    httpd = standin.serve(port=0, batch_seconds=0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(kv_cache, "kv_cache_dir", str(tmp_path / "cache"))
+    monkeypatch.setattr(gemini_module, "GEMINI_BASE_URL", f"http://127.0.0.1:{httpd.server_address[1]}")
+    monkeypatch.setattr(gemini_module, "GEMINI_FILES_API", True)
+    yield gemini_module._GeminiProcessor()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_backfill_is_submitted_polled_and_ingested_through_the_standin(processor, tmp_path, monkeypatch):
+    media_dir = tmp_path / "media"
+    media_dir.mkdir()
+    pinned_while_preparing = []
+
+    def prepare(job, db_conn):
+        pinned_while_preparing.append(len(glob.glob(str(media_dir / f"*{PIN_MARKER}*"))))
+        job.video_path = str(media_dir / f"{job.video_id}.mp4")
+        with open(job.video_path, "wb") as f:
+            f.write(b"\x00\x00\x00\x18ftypmp42" + job.video_id.encode() * 512)
+        job.transcript = f"transcript {job.video_id}"
+        job.text_sentiment_analysis = {"positive": 0.1, "negative": 0.2, "neutral": 0.7}
+        job.description = "description"
+        job.prescan_hits = set()
+        return True
+
+    stored = {}
+
+    def store(job, db_conn):
+        job.status = "failed" if job.error is not None else "completed"
+        stored[job.video_id] = job.analysis_result_json
+
+    monkeypatch.setattr(batch, "_prepare", prepare)
+    monkeypatch.setattr(batch, "store_step", store)
+    monkeypatch.setattr(batch, "gemini", processor)
+    monkeypatch.setattr(batch.VideoProcessor, "gemini", processor)
+    monkeypatch.setattr(batch.VideoProcessor, "_keyframes", lambda video_path, video_id: None)
+    monkeypatch.setattr(batch, "GEMINI_BATCH_MAX_REQUESTS", 2)
+    state_path = str(tmp_path / "backfill.json")
+
+    batch.run_batch(["1", "2", "3", "4", "5"], None, state_path=state_path, poll_seconds=0)
+
+    assert sorted(stored) == ["1", "2", "3", "4", "5"]
+    assert all(result["summary"] for result in stored.values())
+    # Every chunk was submitted and unpinned before the next one was prepared
+    assert pinned_while_preparing == [0, 1, 0, 1, 0]
+    assert not glob.glob(str(media_dir / f"*{PIN_MARKER}*"))
+    assert not os.path.exists(state_path)
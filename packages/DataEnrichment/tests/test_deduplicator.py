@@ -0,0 +1,107 @@
+import numpy as np
+
+import Deduplicator
+from Deduplicator import fingerprint
+
+SAMPLE_RATE = 16000
+FRAMES = [0x0F0F_3C3C_5A5A_A5A5, 0x1234_5678_9ABC_DEF0, 0x7E81_7E81_33CC_33CC]
+AUDIO = 0x55AA_55AA_0FF0_F00F
+AUDIO_FRAMES = np.random.default_rng(0).integers(0, 1 << 32, 900, dtype=np.uint32)
+# Formants of the vowels the synthetic speaker says
+VOWELS = [(730, 1090, 2440), (270, 2290, 3010), (300, 870, 2240), (530, 1840, 2480), (570, 840, 2410)]
+
+
+def _fingerprint(audio_hash=AUDIO, frame_hashes=FRAMES, duration=30.0, audio_frames=AUDIO_FRAMES) -> dict:
+    return {"duration": duration, "audio_hash": audio_hash, "audio_frames": audio_frames, "frame_hashes": list(frame_hashes)}
+
+
+# Syllables of random vowels and lengths in a fixed voice (pitch and formants), the seed picks what is said
+def _speech(seed: int, seconds: float = 10.0, f0: float = 120.0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    parts, length = [], 0
+    while length < seconds * SAMPLE_RATE:
+        formants = VOWELS[rng.integers(len(VOWELS))]
+        t = np.arange(int(rng.uniform(0.1, 0.3) * SAMPLE_RATE)) / SAMPLE_RATE
+        phase = 2 * np.pi * np.cumsum(f0 * (1 + 0.05 * np.sin(2 * np.pi * 2 * t))) / SAMPLE_RATE
+        syllable = sum(
+            (sum(np.exp(-((f0 * harmonic - formant) / 90.0) ** 2) for formant in formants) + 0.05) / harmonic * np.sin(harmonic * phase)
+            for harmonic in range(1, 30)
+        ) * np.hanning(len(t))
+        parts += [syllable, np.zeros(int(rng.uniform(0.02, 0.12) * SAMPLE_RATE))]
+        length += len(t)
+    audio = np.concatenate(parts)[:int(seconds * SAMPLE_RATE)]
+    return (0.1 * audio / np.abs(audio).max()).astype(np.float32)
+
+
+def _audio_fingerprint(pcm: np.ndarray) -> dict:
+    return _fingerprint(
+        audio_hash=fingerprint.audio_hash(pcm),
+        audio_frames=fingerprint.audio_frames(pcm),
+        duration=len(pcm) / SAMPLE_RATE,
+    )
+
+
+def test_matching_frames_and_audio_are_a_duplicate():
+    # Re-encoding flips a couple of bits
+    candidate = _fingerprint(AUDIO ^ 0b11, [value ^ 0b101 for value in FRAMES])
+    assert Deduplicator._is_duplicate(_fingerprint(), candidate)
+
+
+def test_same_voice_saying_something_else_is_not_a_duplicate():
+    # A talking-head creator, same face in the frames and same voice, in two different videos. The
+    # 64 bit hash only sees the voice, give both the same one so the sub-fingerprints have to decide
+    query, candidate = _audio_fingerprint(_speech(1)), _audio_fingerprint(_speech(2))
+    candidate["audio_hash"] = query["audio_hash"]
+
+    assert not Deduplicator._is_duplicate(query, candidate)
+
+
+def test_reencoded_speech_is_a_duplicate():
+    speech = _speech(1)
+    # Quieter, noisier and with a quarter second trimmed off the start
+    reencoded = 0.5 * speech[4000:] + 0.002 * np.random.default_rng(1).standard_normal(len(speech) - 4000)
+
+    assert Deduplicator._is_duplicate(_audio_fingerprint(speech), _audio_fingerprint(reencoded.astype(np.float32)))
+
+
+def test_audio_without_sub_fingerprints_is_not_a_duplicate():
+    # Rows fingerprinted before the sub-fingerprints existed
+    assert not Deduplicator._is_duplicate(_fingerprint(), _fingerprint(audio_frames=None))
+
+
+def test_shared_sound_with_different_frames_is_not_a_duplicate():
+    other_frames = [value ^ 0xFFFF_0000_FFFF_0000 for value in FRAMES]
+    assert not Deduplicator._is_duplicate(_fingerprint(), _fingerprint(frame_hashes=other_frames))
+
+
+def test_audio_alone_is_not_a_duplicate():
+    assert not Deduplicator._is_duplicate(_fingerprint(frame_hashes=[]), _fingerprint(frame_hashes=[]))
+
+
+def test_silent_clips_are_matched_on_frames_only():
+    # Rows stored before silent audio stopped being hashed still carry 0
+    assert Deduplicator._is_duplicate(_fingerprint(audio_hash=0), _fingerprint(audio_hash=0))
+    assert not Deduplicator._is_duplicate(_fingerprint(audio_hash=0, frame_hashes=[0, 0, 0]), _fingerprint(audio_hash=0, frame_hashes=[0, 0, 0]))
+
+
+def test_silence_has_no_audio_hash():
+    assert fingerprint.audio_hash(np.zeros(16000 * 10, dtype=np.float32)) is None
+
+
+def test_bands_split_every_usable_hash_into_bytes():
+    kinds, bands, values = Deduplicator._bands(_fingerprint(frame_hashes=[FRAMES[0], 0, FRAMES[1]]))
+
+    # The audio hash and two frames, the flat second frame is not indexed
+    assert sorted(set(kinds)) == [0, 1, 3]
+    assert len(kinds) == len(bands) == len(values) == 3 * 8
+    audio_bytes = [value for kind, value in zip(kinds, values) if kind == 0]
+    assert audio_bytes == [(AUDIO >> (8 * band)) & 0xFF for band in range(8)]
+
+
+def test_near_duplicates_share_a_band():
+    query = Deduplicator._bands(_fingerprint())
+    candidate = Deduplicator._bands(_fingerprint(AUDIO ^ 0x0101_0101_0101_0100, [value ^ 0b1 for value in FRAMES]))
+
+    shared = set(zip(*query)) & set(zip(*candidate))
+    # Seven flipped bits in the audio hash leave one audio band intact
+    assert (0, 0, AUDIO & 0xFF) in shared
@@ -0,0 +1,80 @@
+import importlib
+import threading
+
+import pytest
+import requests
+
+from utils import kv_cache
+from utils.media_cache import file_sha256
+from VideoProcessor.gemini import standin
+
+# VideoProcessor re-exports the processor instance under the module's name
+gemini_module = importlib.import_module("VideoProcessor.gemini")
+
+
+@pytest.fixture
+def server():
+    httpd = standin.serve(port=0, batch_seconds=0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def processor(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(kv_cache, "kv_cache_dir", str(tmp_path / "cache"))
+    monkeypatch.setattr(gemini_module, "GEMINI_BASE_URL", server)
+    monkeypatch.setattr(gemini_module, "GEMINI_FILES_API", True)
+    monkeypatch.setattr(gemini_module, "GEMINI_RESPONSE_CACHE", False)
+    return gemini_module._GeminiProcessor()
+
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"\x00\x00\x00\x18ftypmp42" + bytes(range(256)) * 64)
+    return str(path)
+
+
+def _stats(server: str) -> dict:
+    return requests.get(f"{server}/standin/stats", timeout=5).json()
+
+
+def _analyze(processor, video_path: str):
+    return processor.analyze(video_path, "transcript", {"positive": 0.1, "negative": 0.2, "neutral": 0.7}, "description")
+
+
+def test_video_is_uploaded_once_and_reused(server, processor, video_path):
+    assert _analyze(processor, video_path) is not None
+    assert _analyze(processor, video_path) is not None
+
+    stats = _stats(server)
+    assert stats["uploads_finished"] == 1
+    assert stats["generate_requests"] == 2
+
+
+def test_expired_file_falls_back_to_inline_bytes(server, processor, video_path):
+    assert _analyze(processor, video_path) is not None
+    handle = processor.file_handles.get(f"{processor._files_scope}:{file_sha256(video_path)}")
+    processor.client.files.delete(name=handle["name"])
+
+    # The stale handle is rejected with 404, the retry sends the bytes and forgets the handle
+    assert _analyze(processor, video_path) is not None
+    stats = _stats(server)
+    assert stats["uploads_finished"] == 1
+    assert stats["generate_requests"] == 3
+
+    # The next analysis uploads again
+    assert _analyze(processor, video_path) is not None
+    assert _stats(server)["uploads_finished"] == 2
+
+
+def test_batch_requests_never_inline_the_video(processor, video_path, monkeypatch):
+    def failing_upload(video_path, content_hash):
+        raise RuntimeError("upload failed")
+
+    monkeypatch.setattr(processor, "_upload", failing_upload)
+    with pytest.raises(RuntimeError):
+        processor.batch_request("1", video_path, "transcript", {}, "description")
@@ -0,0 +1,35 @@
+import numpy as np
+
+from VideoProcessor.keyframes import _select
+
+BINS = 16
+
+
+def _scenes(lengths: list) -> np.ndarray:
+    # Every scene fills a different histogram bin
+    histograms = []
+    for scene, length in enumerate(lengths):
+        histogram = np.zeros(BINS, dtype=np.float32)
+        histogram[scene % BINS] = 1.0
+        histograms += [histogram] * length
+    return np.array(histograms)
+
+
+def test_one_frame_from_the_middle_of_every_scene():
+    assert _select(_scenes([4, 6, 2]), max_count=12, min_count=1, threshold=0.35) == [1, 6, 10]
+
+
+def test_static_video_gets_evenly_spread_frames():
+    assert _select(_scenes([20]), max_count=12, min_count=3, threshold=0.35) == [0, 9, 10, 19]
+
+
+def test_keeps_the_hardest_cuts_when_there_are_too_many_scenes():
+    histograms = _scenes([2] * 8)
+    # A soft cut between the first two scenes
+    histograms[2:4] = 0.7 * histograms[0] + 0.3 * histograms[2]
+
+    positions = _select(histograms, max_count=4, min_count=1, threshold=0.2)
+
+    assert len(positions) == 4
+    assert positions == sorted(positions)
+    assert positions[0] >= 2
@@ -0,0 +1,86 @@
+import os
+import subprocess
+import sys
+import time
+
+from utils import media_cache as media_cache_module
+from utils.media_cache import _MediaCache
+
+
+def _cached_file(cache: _MediaCache, name: str) -> str:
+    path = cache.path("video", name)
+    with cache.atomic_write(path) as partial_path:
+        with open(partial_path, "wb") as f:
+            f.write(b"x" * 1024)
+    return path
+
+
+def test_evict_keeps_files_pinned_by_another_process(tmp_path):
+    cache = _MediaCache(str(tmp_path))
+    path = _cached_file(cache, "1.mp4")
+
+    # A pin held by a process that is still running
+    holder = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        with open(f"{path}{media_cache_module.PIN_MARKER}{holder.pid}", "w"):
+            pass
+        cache.evict(max_bytes=0)
+        assert os.path.exists(path)
+    finally:
+        holder.kill()
+        holder.wait()
+
+    # Its marker is stale once the process is gone
+    cache.evict(max_bytes=0)
+    assert not os.path.exists(path)
+    assert os.listdir(os.path.dirname(path)) == []
+
+
+def test_named_pins_expire(tmp_path, monkeypatch):
+    cache = _MediaCache(str(tmp_path))
+    path = _cached_file(cache, "2.mp4")
+    cache.pin(path, holder="batch-backfill")
+
+    cache.evict(max_bytes=0)
+    assert os.path.exists(path)
+
+    monkeypatch.setattr(media_cache_module, "MEDIA_CACHE_PIN_HOURS", 1)
+    marker = f"{path}{media_cache_module.PIN_MARKER}batch-backfill"
+    old = time.time() - 2 * 3600
+    os.utime(marker, (old, old))
+    cache.evict(max_bytes=0)
+    assert not os.path.exists(path)
+
+
+def test_marker_is_removed_with_the_last_unpin(tmp_path):
+    cache = _MediaCache(str(tmp_path))
+    path = _cached_file(cache, "3.mp4")
+    marker = f"{path}{media_cache_module.PIN_MARKER}{os.getpid()}"
+
+    cache.pin(path)
+    cache.pin(path)
+    cache.unpin(path)
+    assert os.path.exists(marker)
+    cache.unpin(path)
+    assert not os.path.exists(marker)
+
+
+def test_lookup_during_a_commit_keeps_the_committed_file(tmp_path, monkeypatch):
+    cache = _MediaCache(str(tmp_path))
+    path = cache.path("video", "1.mp4")
+    replace = os.replace
+    lookups = []
+
+    # Another process looks the file up between every step of the commit
+    def replace_and_look_up(source, destination):
+        lookups.append(cache.get(path))
+        replace(source, destination)
+        lookups.append(cache.get(path))
+
+    monkeypatch.setattr(media_cache_module.os, "replace", replace_and_look_up)
+    with cache.atomic_write(path) as partial_path:
+        with open(partial_path, "wb") as f:
+            f.write(b"x" * 1024)
+
+    assert lookups == [None, None, None, path]
+    assert cache.get(path) == path
@@ -0,0 +1,43 @@
+import numpy as np
+
+import AudioProcessor
+from AudioProcessor import model_policy
+from AudioProcessor.model_policy import _ModelPolicy
+
+TIERS = "large.bin:0.6,medium.bin:0.3,small.bin:0.1"
+
+
+def test_trusted_language_is_not_escalated():
+    policy = _ModelPolicy(TIERS)
+    assert "ro" in model_policy.WHISPER_SMALL_MODEL_LANGS
+    assert policy.escalate("small.bin", "ro", 60, 6) is None
+
+
+def test_escalation_stays_within_the_slo(monkeypatch):
+    monkeypatch.setattr(model_policy, "WHISPER_LATENCY_SLO_SECONDS", 100)
+    policy = _ModelPolicy(TIERS)
+
+    assert policy.escalate("small.bin", "hu", 60, 6) == "medium.bin"
+    # 60s of audio on medium takes about 18s, 90s were already spent
+    assert policy.escalate("small.bin", "hu", 60, 90) is None
+    assert policy.escalate("large.bin", "hu", 60, 6) is None
+
+
+def test_unknown_language_is_escalated_once(monkeypatch):
+    monkeypatch.setattr(AudioProcessor, "WHISPER_ADAPTIVE_MODEL", True)
+    monkeypatch.setattr(AudioProcessor, "ModelPolicy", _ModelPolicy(TIERS))
+    monkeypatch.setattr(AudioProcessor.transcriber, "warm_up", lambda pcm, model_name: None)
+
+    calls = []
+
+    def transcribe(audio, model_name):
+        calls.append(model_name)
+        return {"transcript": "", "language": "hu", "segments": [], "model": model_name}
+
+    monkeypatch.setattr(AudioProcessor, "transcribe", transcribe)
+    monkeypatch.setattr(AudioProcessor.ModelPolicy, "select", lambda duration: "small.bin")
+
+    transcription, model_name = AudioProcessor._transcribe_with_policy(np.zeros(16000 * 30, dtype=np.float32))
+
+    assert calls == ["small.bin", "medium.bin"]
+    assert model_name == "medium.bin"
@@ -0,0 +1,80 @@
+import pipeline
+from pipeline import Pipeline, Stage
+
+
+class Item:
+    def __init__(self, name: str):
+        self.name = name
+        self.error = None
+
+
+class Connection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _run(stages: list, items: list, connection_factory=None) -> list:
+    done = []
+    runner = Pipeline(stages, connection_factory=connection_factory, on_done=done.append)
+    runner.start()
+    for item in items:
+        runner.submit(item)
+    runner.close()
+    return done
+
+
+def test_failed_final_stage_skips_on_done():
+    def store(item, db_conn):
+        if item.name == "bad":
+            raise RuntimeError("store failed")
+
+    good, bad = Item("good"), Item("bad")
+    done = _run([Stage("store", store, handles_errors=True)], [good, bad])
+
+    assert done == [good]
+    assert isinstance(bad.error, RuntimeError)
+
+
+def test_errors_reach_stages_that_handle_them():
+    def download(item, db_conn):
+        raise RuntimeError("download failed")
+
+    stored = []
+    item = Item("a")
+    done = _run([Stage("download", download), Stage("store", lambda item, db_conn: stored.append(item), handles_errors=True)], [item])
+
+    assert stored == [item] and done == [item]
+
+
+def test_connection_is_replaced_after_a_failure():
+    connections = []
+
+    def connect():
+        connections.append(Connection())
+        return connections[-1]
+
+    def store(item, db_conn):
+        if item.name == "bad":
+            raise RuntimeError("connection lost")
+
+    done = _run([Stage("store", store, needs_db=True, handles_errors=True)], [Item("bad"), Item("good")], connect)
+
+    assert [item.name for item in done] == ["good"]
+    assert len(connections) == 2 and connections[0].closed
+
+
+def test_unreachable_database_does_not_block_the_pipeline(monkeypatch):
+    monkeypatch.setattr(pipeline, "PIPELINE_DB_CONNECT_ATTEMPTS", 1)
+
+    def connect():
+        raise ConnectionError("database down")
+
+    items = [Item(str(index)) for index in range(10)]
+    stage = Stage("store", lambda item, db_conn: None, queue_size=1, needs_db=True, handles_errors=True)
+    done = _run([stage], items, connect)
+
+    assert done == []
+    assert all(isinstance(item.error, ConnectionError) for item in items)
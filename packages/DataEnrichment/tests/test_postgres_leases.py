@@ -0,0 +1,209 @@
+import pytest
+
+import sqlQueries
+from queues import postgres_leases
+from queues.postgres_leases import PostgresLeaseQueue
+
+LEASE_SECONDS = 600
+
+
+class _Database:
+    """
+    The videos, video_features and enrichment_leases tables in memory, every lease query is applied
+    the way the SQL in sqlQueries does it. now stands in for CURRENT_TIMESTAMP.
+    """
+
+    def __init__(self, video_ids: list):
+        self.now = 0.0
+        self.videos = list(video_ids)
+        self.statuses = {}
+        self.leases = {}
+
+    def _expired(self, lease: dict) -> bool:
+        return lease["leased_until"] is None or lease["leased_until"] < self.now
+
+    def execute(self, query: str, params: dict):
+        if query == sqlQueries.CLAIM_ENRICHMENT_LEASES_QUERY:
+            claimed = []
+            for video_id in self.videos:
+                status = self.statuses.get(video_id)
+                lease = self.leases.get(video_id)
+                if status is not None and status not in params["retry_statuses"]:
+                    continue
+                if lease is not None and (not self._expired(lease) or lease["attempts"] >= params["max_attempts"]):
+                    continue
+                attempts = lease["attempts"] + 1 if lease else 1
+                self.leases[video_id] = {"worker_id": params["worker_id"], "leased_until": self.now + params["lease_seconds"], "attempts": attempts}
+                claimed.append((video_id,))
+                if len(claimed) == params["batch_size"]:
+                    break
+            return claimed
+        if query == sqlQueries.RENEW_ENRICHMENT_LEASES_QUERY:
+            for lease in self.leases.values():
+                if lease["worker_id"] == params["worker_id"] and lease["leased_until"] is not None:
+                    lease["leased_until"] = self.now + params["lease_seconds"]
+            return []
+        if query == sqlQueries.RELEASE_ENRICHMENT_LEASE_QUERY:
+            lease = self.leases.get(params["video_id"])
+            if lease and lease["worker_id"] == params["worker_id"]:
+                lease.update(leased_until=None, worker_id=None, attempts=0)
+            return []
+        if query == sqlQueries.GIVE_UP_EXHAUSTED_LEASES_QUERY:
+            given_up = []
+            for video_id, lease in self.leases.items():
+                if lease["leased_until"] is not None and lease["leased_until"] < self.now and lease["attempts"] >= params["max_attempts"]:
+                    lease["leased_until"] = None
+                    given_up.append((video_id, lease["attempts"]))
+            return given_up
+        raise AssertionError(f"Unexpected query {query}")
+
+
+class _Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        if self.connection.fail_next:
+            self.connection.fail_next = False
+            raise RuntimeError("connection lost")
+        self.rows = self.connection.database.execute(query, params)
+
+    def fetchall(self):
+        return self.rows
+
+
+class _Connection:
+    def __init__(self, database: _Database):
+        self.database = database
+        self.closed = 0
+        self.fail_next = False
+        self.rollbacks = 0
+
+    def cursor(self):
+        return _Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def database(monkeypatch):
+    monkeypatch.setattr(postgres_leases, "LEASE_SECONDS", LEASE_SECONDS)
+    monkeypatch.setattr(postgres_leases, "LEASE_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(postgres_leases, "LEASE_RETRY_STATUSES", ["failed"])
+    return _Database(["1", "2", "3"])
+
+
+def _queue(database: _Database, worker_id: str) -> PostgresLeaseQueue:
+    queue = PostgresLeaseQueue(lambda: _Connection(database), worker_id)
+    # The heartbeat is driven by the tests
+    queue._heartbeat = object()
+    return queue
+
+
+def _claim(queue: PostgresLeaseQueue, count: int = 3) -> list:
+    queue._stopped.clear()
+    # An empty claim would poll, the test stops it after the first try
+    queue._stopped.wait = lambda timeout: queue._stopped.set()
+    return [video_id for video_id, _receipt in queue.read(count)]
+
+
+def test_leased_videos_are_not_claimed_twice(database):
+    first, second = _queue(database, "a"), _queue(database, "b")
+
+    assert _claim(first, 2) == ["1", "2"]
+    assert _claim(second) == ["3"]
+    assert _claim(second) == []
+
+
+def test_expired_leases_are_claimed_again(database):
+    first, second = _queue(database, "a"), _queue(database, "b")
+    _claim(first)
+
+    database.now += LEASE_SECONDS + 1
+    assert _claim(second) == ["1", "2", "3"]
+    assert database.leases["1"] == {"worker_id": "b", "leased_until": database.now + LEASE_SECONDS, "attempts": 2}
+
+
+def test_renewed_leases_do_not_expire(database):
+    first, second = _queue(database, "a"), _queue(database, "b")
+    _claim(first)
+
+    database.now += LEASE_SECONDS - 1
+    first._execute(sqlQueries.RENEW_ENRICHMENT_LEASES_QUERY, {"worker_id": "a", "lease_seconds": LEASE_SECONDS})
+    database.now += LEASE_SECONDS - 1
+    assert _claim(second) == []
+
+
+def test_released_failures_are_retried_without_running_out_of_attempts(database):
+    queue = _queue(database, "a")
+
+    # Failing more often than LEASE_MAX_ATTEMPTS, every failure is stored and released
+    for _ in range(4):
+        assert _claim(queue, 1) == ["1"]
+        database.statuses["1"] = "failed"
+        queue.ack("1")
+        assert database.leases["1"]["attempts"] == 0
+
+    database.statuses["1"] = "completed"
+    queue.ack("1")
+    assert _claim(queue, 1) == ["2"]
+
+
+def test_only_the_holder_releases_a_lease(database):
+    first, second = _queue(database, "a"), _queue(database, "b")
+    _claim(first, 1)
+
+    second.ack("1")
+    assert database.leases["1"]["worker_id"] == "a"
+
+
+def test_exhausted_leases_are_given_up_and_logged_once(database, monkeypatch):
+    errors = []
+    monkeypatch.setattr(postgres_leases.vxlog, "error", errors.append)
+    queue = _queue(database, "a")
+
+    # The worker dies on video 1 twice
+    for _ in range(2):
+        assert _claim(queue, 1) == ["1"]
+        database.now += LEASE_SECONDS + 1
+
+    assert _claim(queue, 1) == ["2"]
+    assert errors == ["Giving up on 1, its lease expired 2 times without being released"]
+    assert database.leases["1"]["leased_until"] is None
+
+    database.now += LEASE_SECONDS + 1
+    assert _claim(queue, 3) == ["2", "3"]
+    assert len(errors) == 1
+
+
+def test_lost_connection_is_rolled_back_and_replaced(database):
+    connections = []
+
+    def connect():
+        connections.append(_Connection(database))
+        return connections[-1]
+
+    queue = PostgresLeaseQueue(connect, "a")
+    queue._execute(sqlQueries.RENEW_ENRICHMENT_LEASES_QUERY, {"worker_id": "a", "lease_seconds": LEASE_SECONDS})
+    connections[0].fail_next = True
+    with pytest.raises(RuntimeError):
+        queue._execute(sqlQueries.RENEW_ENRICHMENT_LEASES_QUERY, {"worker_id": "a", "lease_seconds": LEASE_SECONDS})
+    assert connections[0].rollbacks == 1
+
+    connections[0].closed = 1
+    queue._execute(sqlQueries.RENEW_ENRICHMENT_LEASES_QUERY, {"worker_id": "a", "lease_seconds": LEASE_SECONDS})
+    assert len(connections) == 2
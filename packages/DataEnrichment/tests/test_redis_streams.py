@@ -0,0 +1,143 @@
+import pytest
+import redis
+
+from queues import redis_streams
+from queues.redis_streams import RedisStreamQueue
+
+CLAIM_IDLE_MS = 1000
+
+
+class _Redis:
+    """
+    One stream with one consumer group in memory: the entries, the last delivered id and the
+    pending entries list with owner, delivery time and delivery count. now_ms is the server clock.
+    """
+
+    def __init__(self):
+        self.now_ms = 0
+        self.entries = {}
+        self.streams = {}
+        self.delivered = 0
+        self.pending = {}
+        self.group_created = False
+
+    def add(self, video_id: str) -> str:
+        message_id = f"{len(self.entries) + 1}-0"
+        self.entries[message_id] = {"video_id": video_id}
+        return message_id
+
+    def xgroup_create(self, stream, group, id="$", mkstream=False):
+        if self.group_created:
+            raise redis.exceptions.ResponseError("BUSYGROUP Consumer Group name already exists")
+        self.group_created = True
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        ids = list(self.entries)[self.delivered:self.delivered + count]
+        self.delivered += len(ids)
+        for message_id in ids:
+            self.pending[message_id] = {"consumer": consumer, "delivered_at": self.now_ms, "times_delivered": 1}
+        return [[redis_streams.ENRICHMENT_STREAM, [(message_id, self.entries[message_id]) for message_id in ids]]] if ids else []
+
+    def xpending_range(self, stream, group, min, max, count, idle=None):
+        return [
+            {"message_id": message_id, "consumer": entry["consumer"], "time_since_delivered": self.now_ms - entry["delivered_at"], "times_delivered": entry["times_delivered"]}
+            for message_id, entry in self.pending.items()
+            if self.now_ms - entry["delivered_at"] >= (idle or 0)
+        ][:count]
+
+    def xclaim(self, stream, group, consumer, min_idle_time, message_ids):
+        claimed = []
+        for message_id in message_ids:
+            entry = self.pending.get(message_id)
+            if entry is None or self.now_ms - entry["delivered_at"] < min_idle_time:
+                continue
+            entry.update(consumer=consumer, delivered_at=self.now_ms, times_delivered=entry["times_delivered"] + 1)
+            # Trimmed entries come back without fields
+            claimed.append((message_id, self.entries.get(message_id)))
+        return claimed
+
+    def xack(self, stream, group, *message_ids):
+        return sum(self.pending.pop(message_id, None) is not None for message_id in message_ids)
+
+    def xadd(self, stream, fields):
+        self.streams.setdefault(stream, []).append(fields)
+
+    def xinfo_groups(self, stream):
+        return [{"name": redis_streams.ENRICHMENT_CONSUMER_GROUP, "lag": len(self.entries) - self.delivered, "pending": len(self.pending)}]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(redis_streams, "STREAM_CLAIM_IDLE_MS", CLAIM_IDLE_MS)
+    monkeypatch.setattr(redis_streams, "STREAM_MAX_DELIVERIES", 3)
+    return _Redis()
+
+
+def test_acked_entries_leave_the_pending_list(client):
+    queue = RedisStreamQueue(client, "a")
+    first, second = client.add("v1"), client.add("v2")
+
+    assert queue.read(count=2) == [(first, "v1"), (second, "v2")]
+    assert queue.depth() == 2
+    queue.ack(first)
+    assert list(client.pending) == [second]
+    assert queue.depth() == 1
+
+
+def test_entries_of_a_crashed_consumer_are_reclaimed_first(client):
+    crashed, live = RedisStreamQueue(client, "crashed"), RedisStreamQueue(client, "live")
+    stalled = client.add("v1")
+    crashed.read()
+    fresh = client.add("v2")
+
+    # Not idle long enough, the consumer may still be working on it
+    client.now_ms += CLAIM_IDLE_MS - 1
+    assert live.read() == [(fresh, "v2")]
+
+    client.now_ms += 1
+    assert live.read() == [(stalled, "v1")]
+    assert client.pending[stalled]["consumer"] == "live"
+    assert client.pending[stalled]["times_delivered"] == 2
+
+
+def test_entries_delivered_too_often_are_dead_lettered(client):
+    queue = RedisStreamQueue(client, "a")
+    message_id = client.add("v1")
+    queue.read()
+
+    # Delivered a second and a third time, the consumer crashes every time
+    for _ in range(2):
+        client.now_ms += CLAIM_IDLE_MS
+        assert queue.read() == [(message_id, "v1")]
+
+    client.now_ms += CLAIM_IDLE_MS
+    assert queue.read() == []
+    assert client.streams[redis_streams.ENRICHMENT_DEAD_LETTER_STREAM] == [
+        {"video_id": "v1", "message_id": message_id, "reason": "delivered 3 times without an ack"}
+    ]
+    assert message_id not in client.pending
+
+
+def test_trimmed_pending_entries_are_acked_and_skipped(client):
+    queue = RedisStreamQueue(client, "a")
+    trimmed, kept = client.add("v1"), client.add("v2")
+    queue.read(count=2)
+    del client.entries[trimmed]
+
+    client.now_ms += CLAIM_IDLE_MS
+    assert queue.read(count=2) == [(kept, "v2")]
+    assert list(client.pending) == [kept]
+    assert redis_streams.ENRICHMENT_DEAD_LETTER_STREAM not in client.streams
+
+
+def test_existing_group_is_reused(client):
+    queue = RedisStreamQueue(client, "a")
+    queue.ensure_group()
+    queue.ensure_group()
+
+    def wrong_type(*args, **kwargs):
+        raise redis.exceptions.ResponseError("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+    client.xgroup_create = wrong_type
+    with pytest.raises(redis.exceptions.ResponseError):
+        queue.ensure_group()
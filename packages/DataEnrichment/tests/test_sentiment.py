@@ -0,0 +1,84 @@
+import types
+
+import numpy as np
+import pytest
+import torch
+
+from AudioProcessor import model_manager, sentiment
+from AudioProcessor.sentiment import SentimentAnalyzer, _aggregate_windows
+
+WINDOW = 4
+
+
+class _Tokenizer:
+    """Word tokenizer cutting texts into windows of WINDOW words without overlap"""
+
+    def __call__(self, texts, **kwargs):
+        encoded = {"input_ids": [], "attention_mask": [], "overflow_to_sample_mapping": []}
+        for index, text in enumerate(texts):
+            words = [len(word) for word in text.split()] or [0]
+            for start in range(0, len(words), WINDOW):
+                window = words[start:start + WINDOW]
+                encoded["input_ids"].append(window)
+                encoded["attention_mask"].append([1] * len(window))
+                encoded["overflow_to_sample_mapping"].append(index)
+        return encoded
+
+    def pad(self, features, return_tensors=None):
+        length = max(len(ids) for ids in features["input_ids"])
+        return {key: torch.tensor([values + [0] * (length - len(values)) for values in features[key]]) for key in features}
+
+
+class _Model:
+    def __init__(self):
+        self.batch_sizes = []
+
+    # Positive for windows of long words, negative for short ones
+    def __call__(self, input_ids, attention_mask):
+        self.batch_sizes.append(len(input_ids))
+        mean_length = (input_ids * attention_mask).sum(dim=1) / attention_mask.sum(dim=1)
+        return types.SimpleNamespace(logits=torch.stack([mean_length - 3, 3 - mean_length], dim=1).float())
+
+
+def test_window_scores_are_averaged_by_token_count():
+    window_scores = np.array([[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]])
+    window_to_text = np.array([0, 0, 1])
+
+    scores = _aggregate_windows(window_scores, window_to_text, np.array([300, 100, 10]), text_count=2)
+
+    assert scores[0] == pytest.approx([0.75, 0.25])
+    assert scores[1] == pytest.approx([0.5, 0.5])
+
+
+def test_batches_are_capped_by_windows(monkeypatch):
+    monkeypatch.setattr(sentiment, "SENTIMENT_BATCH_SIZE", 3)
+    model = _Model()
+    texts = ["a " * 40, "longer words only", "tiny"]
+
+    scores = SentimentAnalyzer._score_windows(model, _Tokenizer(), texts)
+
+    # 10 + 1 + 1 windows
+    assert sum(model.batch_sizes) == 12
+    assert max(model.batch_sizes) == 3
+    assert scores[0][1] > 0.9 and scores[1][0] > 0.5
+
+
+class _SizedModel:
+    def __init__(self, size: int):
+        self.path = None
+        self.size = size
+
+
+def test_eviction_logs_the_usage_of_every_model(monkeypatch):
+    monkeypatch.setattr(model_manager, "model_size", lambda model: model.size)
+    logged = []
+    monkeypatch.setattr(model_manager.vxlog, "info", logged.append)
+
+    manager = model_manager._ModelManager(budget_mb=1)
+    manager.put("en", _SizedModel(600 * 1024), None)
+    manager.record_use("en", "en", 3)
+    manager.put("ro", _SizedModel(600 * 1024), None)
+
+    assert "en" not in manager
+    assert manager.usage_stats()["en"] == {"requests": 1, "texts": 3, "loads": 1, "evictions": 1, "languages": {"en": 3}}
+    assert any(line.startswith("Sentiment model en: 1 requests, 3 texts (en: 3)") for line in logged)
@@ -0,0 +1,84 @@
+import supervisor
+from supervisor import Supervisor
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        raise AssertionError("The supervisor must not block while a worker waits for its restart")
+
+
+def _supervisor(monkeypatch, exits: list) -> tuple:
+    clock = _Clock()
+    monkeypatch.setattr(supervisor.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(supervisor.time, "sleep", clock.sleep)
+
+    # waitpid returns the queued exits once, then reports that no child changed state
+    def waitpid(pid, options):
+        return exits.pop(0) if exits else (0, 0)
+
+    monkeypatch.setattr(supervisor.os, "waitpid", waitpid)
+    monkeypatch.setattr(supervisor.os, "waitstatus_to_exitcode", lambda status: status)
+
+    instance = Supervisor(2, child_main=None)
+    spawned = []
+
+    def spawn(child):
+        child.pid = 1000 + len(spawned)
+        child.started_at = clock.now
+        spawned.append(child.slot)
+
+    monkeypatch.setattr(instance, "_spawn", spawn)
+    for child in instance.children:
+        instance._spawn(child)
+    return instance, clock, spawned
+
+
+def test_crashed_worker_is_restarted_after_its_backoff_without_blocking(monkeypatch):
+    exits = []
+    instance, clock, spawned = _supervisor(monkeypatch, exits)
+
+    # Worker 0 crashes right after starting, the first restart waits 1 second and the second 3
+    exits.append((1000, 1))
+    instance._reap()
+    instance._restart_due()
+    assert spawned == [0, 1]
+    assert instance.children[0].restart_at == clock.now + 1
+
+    clock.now += 1
+    instance._restart_due()
+    assert spawned == [0, 1, 0]
+
+    exits.append((1002, 1))
+    instance._reap()
+    assert instance.children[0].restart_at == clock.now + 3
+
+    # Worker 1 is still reaped while worker 0 waits
+    exits.append((1001, 1))
+    instance._reap()
+    clock.now += 1
+    instance._restart_due()
+    assert spawned == [0, 1, 0, 1]
+
+    clock.now += 2
+    instance._restart_due()
+    assert spawned == [0, 1, 0, 1, 0]
+    assert instance.children[0].restart_at is None
+
+
+def test_pending_restarts_are_dropped_on_stop(monkeypatch):
+    exits = [(1000, 1)]
+    instance, clock, spawned = _supervisor(monkeypatch, exits)
+    monkeypatch.setattr(instance, "_signal", lambda child, signum: None)
+    instance._reap()
+
+    instance._request_stop(15, None)
+    clock.now += 60
+    instance._restart_due()
+    assert spawned == [0, 1]
+    assert all(child.restart_at is None for child in instance.children)
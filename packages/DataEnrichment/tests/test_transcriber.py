@@ -0,0 +1,27 @@
+from AudioProcessor.transcriber import stitch_chunks
+
+
+def _result(language: str, segments: list) -> dict:
+    return {"language": language, "segments": [{"start": start, "end": end, "text": text} for start, end, text in segments]}
+
+
+def test_stitch_shifts_segments_by_the_chunk_offsets():
+    results = [
+        _result("ro", [(0.0, 2.0, "Bună ziua"), (2.0, 4.0, "")]),
+        _result("ro", [(1.0, 3.0, "la toată lumea")]),
+    ]
+
+    stitched = stitch_chunks(results, offsets=[0.0, 60.0], durations=[60.0, 30.0])
+
+    assert [(segment["start"], segment["end"]) for segment in stitched["segments"]] == [(0.0, 2.0), (2.0, 4.0), (61.0, 63.0)]
+    assert stitched["transcript"] == "Bună ziua\nla toată lumea"
+    assert stitched["language"] == "ro"
+
+
+def test_stitch_picks_the_language_of_most_of_the_audio():
+    results = [_result("en", []), _result("ro", []), _result("unknown", []), _result("ro", [])]
+
+    stitched = stitch_chunks(results, offsets=[0, 60, 120, 180], durations=[60, 40, 100, 30])
+
+    assert stitched["language"] == "ro"
+    assert stitch_chunks([_result("unknown", [])], [0], [60])["language"] == "unknown"
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from AudioProcessor import vad
+from AudioProcessor.pcm import SAMPLE_RATE
+
+FRAMES_PER_SECOND = 1000 / vad.VAD_FRAME_MS
+FRAME_LENGTH = SAMPLE_RATE * vad.VAD_FRAME_MS // 1000
+
+
+def _mask(seconds: int, silences: list) -> np.ndarray:
+    mask = np.ones(int(seconds * FRAMES_PER_SECOND), dtype=bool)
+    for start, end in silences:
+        mask[int(start * FRAMES_PER_SECOND):int(end * FRAMES_PER_SECOND)] = False
+    return mask
+
+
+def _signal(parts: list) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    pieces = []
+    for kind, seconds in parts:
+        t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+        if kind == "speech":
+            pieces.append(0.3 * np.sin(2 * np.pi * 500 * t) + 0.2 * np.sin(2 * np.pi * 1300 * t))
+        elif kind == "bass":
+            pieces.append(0.5 * np.sin(2 * np.pi * 80 * t))
+        else:
+            pieces.append(1e-4 * rng.standard_normal(len(t)))
+    return np.concatenate(pieces).astype(np.float32)
+
+
+def test_speech_mask_finds_speech_band_energy():
+    mask = vad.speech_mask(_signal([("silence", 2), ("speech", 2), ("silence", 2)]))
+    seconds = np.arange(len(mask)) / FRAMES_PER_SECOND
+
+    assert mask[(seconds > 2.5) & (seconds < 3.5)].all()
+    assert not mask[seconds < 1.5].any()
+    assert not mask[seconds > 4.5].any()
+
+
+def test_speech_mask_ignores_loud_low_frequencies():
+    mask = vad.speech_mask(_signal([("silence", 2), ("bass", 2)]))
+    assert vad.speech_ratio(mask) == 0.0
+
+
+def test_trim_silence_shortens_long_silences_only():
+    pcm = _signal([("speech", 1), ("silence", 5), ("speech", 1)])
+    mask = vad.speech_mask(pcm)
+    trimmed, regions = vad.trim_silence(pcm, mask)
+
+    max_silence = vad.VAD_MAX_SILENCE_MS / 1000
+    hangover = 2 * vad.VAD_HANGOVER_MS / 1000
+    assert len(trimmed) / SAMPLE_RATE == pytest.approx(2 + max_silence + hangover, abs=0.1)
+    assert len(regions) == 2
+    assert sum(length for _start, _original, length in regions) == len(trimmed)
+
+
+def test_to_original_time_maps_across_the_removed_silence():
+    pcm = _signal([("speech", 1), ("silence", 5), ("speech", 1)])
+    trimmed, regions = vad.trim_silence(pcm, vad.speech_mask(pcm))
+
+    assert vad.to_original_time(0.5, regions) == pytest.approx(0.5)
+    # The last second of the trimmed audio is the last second of the original
+    trimmed_seconds = len(trimmed) / SAMPLE_RATE
+    assert vad.to_original_time(trimmed_seconds - 0.5, regions) == pytest.approx(6.5, abs=0.05)
+    assert vad.to_original_time(trimmed_seconds + 10, regions) == pytest.approx(len(pcm) / SAMPLE_RATE)
+    assert vad.to_original_time(1.5, []) == 1.5
+
+
+def test_split_points_cut_in_silence_near_target():
+    mask = _mask(180, [(58, 61), (121, 124)])
+    points = vad.split_points(mask, len(mask) * FRAME_LENGTH, 60)
+
+    assert len(points) == 2
+    assert 58 < points[0] / SAMPLE_RATE < 61
+    assert 121 < points[1] / SAMPLE_RATE < 124
+
+
+def test_split_points_long_silent_run_moves_forward():
+    # The center of the 150 s silence lies behind the first cut, choosing it again would never end
+    mask = _mask(300, [(100, 250)])
+    total_samples = len(mask) * FRAME_LENGTH
+    points = vad.split_points(mask, total_samples, 60)
+
+    assert points == sorted(set(points))
+    assert all(0 < point < total_samples for point in points)
+    gaps = np.diff([0] + points) / SAMPLE_RATE
+    assert gaps.min() > 10
+
+
+def test_split_points_rejects_search_window_longer_than_target():
+    with pytest.raises(ValueError):
+        vad.split_points(_mask(300, []), 300 * SAMPLE_RATE, 10, search_seconds=10)
@@ -0,0 +1,26 @@
+import threading
+import time
+
+from AudioProcessor import whisper_server
+
+
+def test_concurrent_callers_share_one_server(monkeypatch):
+    created = []
+
+    class _Server:
+        def __init__(self, model_name: str, port: int):
+            # Slow enough for the other threads to reach get_server meanwhile
+            time.sleep(0.05)
+            created.append(model_name)
+
+    monkeypatch.setattr(whisper_server, "_WhisperServer", _Server)
+    monkeypatch.setattr(whisper_server, "_servers", {})
+    servers = []
+    threads = [threading.Thread(target=lambda: servers.append(whisper_server.get_server("base"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert created == ["base"]
+    assert len({id(server) for server in servers}) == 1
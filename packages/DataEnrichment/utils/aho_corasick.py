@@ -0,0 +1,62 @@
+from collections import deque
+
+
+class AhoCorasick:
+    """
+    Multi-pattern string matcher. Finds every occurrence of every pattern in one pass over the text,
+    so the scan cost does not grow with the number of patterns.
+    patterns maps each pattern string to the value reported when it matches.
+    """
+
+    def __init__(self, patterns: dict):
+        # Trie nodes, node 0 is the root
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for pattern, value in patterns.items():
+            if pattern:
+                self._add(pattern, value)
+        self._build_failure_links()
+
+    def _add(self, pattern: str, value):
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append((len(pattern), value))
+
+    # Breadth first, so the failure link of a node always points at an already finished shallower node.
+    # The children of the root keep their failure link to the root
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                # A node also matches everything its failure link matches
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    # Yields (start, end, value) for every match, end is exclusive
+    def iter_matches(self, text: str):
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, value in self._output[node]:
+                yield index + 1 - length, index + 1, value
+
+    def find_all(self, text: str) -> set:
+        return {value for _start, _end, value in self.iter_matches(text)}
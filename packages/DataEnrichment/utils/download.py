@@ -1,14 +1,37 @@
 import subprocess
 import os
+import threading
 import requests
+import numpy as np
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 from dotenv import load_dotenv
 from utils import vxlog
+from utils.media_cache import media_cache
+from AudioProcessor.pcm import from_s16le
 load_dotenv()
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 audio_output_dir = os.path.abspath(os.path.join(script_dir, "../tmp/audio"))
 video_output_dir = os.path.abspath(os.path.join(script_dir, "../tmp/video"))
+proxy_output_dir = os.path.abspath(os.path.join(script_dir, "../tmp/proxy"))
+
+# Files in these directories are managed by utils.media_cache, they are written atomically and
+# only reused when their manifest matches
+
+# Pipe the MP4 into ffmpeg while it downloads instead of waiting for the whole file
+STREAMING_DOWNLOAD = os.getenv("STREAMING_DOWNLOAD", "false").lower() in ("1", "true", "yes")
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+
+# Small re-encode of the video written by the same ffmpeg run as the audio, sent to Gemini instead of the original
+ANALYSIS_PROXY = os.getenv("ANALYSIS_PROXY", "true").lower() in ("1", "true", "yes")
+# Shorter side of the proxy in pixels, videos already smaller are not upscaled
+ANALYSIS_PROXY_SIZE = int(os.getenv("ANALYSIS_PROXY_SIZE", "360"))
+# Gemini samples videos at 1 frame per second
+ANALYSIS_PROXY_FPS = float(os.getenv("ANALYSIS_PROXY_FPS", "1"))
+ANALYSIS_PROXY_CRF = int(os.getenv("ANALYSIS_PROXY_CRF", "32"))
+
+# Reused between downloads so the TLS connections to RapidAPI and the CDN are kept alive
+_http = requests.Session()
 
 class VideoUnavailableError(Exception):
     pass
@@ -16,8 +39,8 @@ class VideoUnavailableError(Exception):
 class RapidAPITiktokDownloaderError(Exception):
     pass
 
-# Uses a rapid api tiktok downloader instead of the youtubeDL
-def tiktok_api_video(video_id: str):
+# Asks the RapidAPI downloader for the direct MP4 url of a video
+def _resolve_mp4_url(video_id: str) -> str:
     api_url = 'https://tiktok-video-downloader-api.p.rapidapi.com/media'
 
     video_page = f'https://www.tiktok.com/@placeholder/video/{video_id}'
@@ -27,7 +50,7 @@ def tiktok_api_video(video_id: str):
         'x-rapidapi-host': 'tiktok-video-downloader-api.p.rapidapi.com'
     }
 
-    resp = requests.get(api_url, headers=headers, params=query, timeout=20)
+    resp = _http.get(api_url, headers=headers, params=query, timeout=20)
     resp.raise_for_status()
 
     try:
@@ -47,23 +70,217 @@ def tiktok_api_video(video_id: str):
     except (KeyError, TypeError, ValueError):
         raise RuntimeError('Failed to get downloadUrl from RapidAPI response')
 
+    return mp4_url
+
+
+# Uses a rapid api tiktok downloader instead of the youtubeDL
+def tiktok_api_video(video_id: str):
+    mp4_url = _resolve_mp4_url(video_id)
+
     local_path = os.path.join(video_output_dir, f"{video_id}.mp4")
     os.makedirs(os.path.dirname(local_path), exist_ok=True)
 
     vxlog.info(f"Downloading MP4 for {video_id} → {local_path}")
-    with requests.get(mp4_url, stream=True, timeout=30) as dl:
+    with _http.get(mp4_url, stream=True, timeout=30) as dl:
         dl.raise_for_status()
-        with open(local_path, 'wb') as f:
-            for chunk in dl.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        with media_cache.atomic_write(local_path) as partial_path:
+            with open(partial_path, 'wb') as f:
+                for chunk in dl.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
 
     return local_path
 
 
+def proxy_path_for(video_id: str):
+    if not ANALYSIS_PROXY:
+        return None
+    return os.path.join(proxy_output_dir, f"{video_id}.mp4")
+
+
+# Output options of the analysis proxy, the first video stream and the audio if there is one
+def _proxy_output_args(proxy_path: str):
+    scale = f"min(1,{ANALYSIS_PROXY_SIZE}/min(iw,ih))"
+    return [
+        '-map', '0:v:0',
+        '-map', '0:a:0?',
+        '-vf', f"scale='trunc({scale}*iw/2)*2':'trunc({scale}*ih/2)*2',fps={ANALYSIS_PROXY_FPS:g}",
+        '-c:v', 'libx264',
+        '-preset', 'veryfast',
+        '-crf', str(ANALYSIS_PROXY_CRF),
+        '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac',
+        '-b:a', '48k',
+        '-ac', '1',
+        '-movflags', '+faststart',
+        proxy_path,
+    ]
+
+
+# ffmpeg command that extracts 16 kHz mono audio, either to a WAV file or as raw PCM to stdout.
+# With proxy_path the same decode also writes the analysis proxy as a second output
+def _audio_extraction_command(input_path: str, audio_path: str = None, proxy_path: str = None):
+    command = [
+        'ffmpeg',
+        '-y',
+        '-i', input_path,
+    ]
+    if proxy_path:
+        command += _proxy_output_args(proxy_path)
+    command += [
+        '-vn', # no video
+        '-acodec', 'pcm_s16le', # wav format
+        '-ar', '16000',
+        '-ac', '1', # mono channel
+    ]
+    if audio_path:
+        return command + [audio_path]
+    return command + ['-f', 's16le', 'pipe:1']
+
+
+def _drain(stream, sink: list):
+    sink.append(stream.read())
+
+
+# Runs the extraction with the proxy as a second output. When that fails (e.g. the file has no video
+# stream) the audio is extracted alone, the proxy is only a smaller copy of the video and not required
+def _run_extraction(input_path: str, audio_path: str = None, proxy_path: str = None):
+    if proxy_path:
+        os.makedirs(os.path.dirname(proxy_path), exist_ok=True)
+        proxy_partial_path = media_cache.partial_path(proxy_path)
+        try:
+            process = subprocess.run(_audio_extraction_command(input_path, audio_path, proxy_partial_path), check=True, capture_output=True)
+            media_cache.commit(proxy_partial_path, proxy_path)
+            return process
+        except subprocess.CalledProcessError as e:
+            vxlog.warning(f"Could not write the analysis proxy for {input_path}, extracting the audio alone: {e.stderr.decode(errors='replace')[-500:]}")
+        finally:
+            if os.path.exists(proxy_partial_path):
+                os.remove(proxy_partial_path)
+
+    return subprocess.run(_audio_extraction_command(input_path, audio_path), check=True, capture_output=True)
+
+
+# Returns the proxy path when a complete proxy is cached
+def _cached_proxy(proxy_path: str):
+    if proxy_path and media_cache.get(proxy_path):
+        return proxy_path
+    return None
+
+
+# Downloads the MP4 into the video cache and pipes the same bytes into ffmpeg, so the audio
+# extraction (and the analysis proxy) runs while the download is still in progress. Returns (video_path, pcm or None)
+def tiktok_api_video_streaming(video_id: str, audio_path: str = None, proxy_path: str = None):
+    mp4_url = _resolve_mp4_url(video_id)
+
+    local_path = os.path.join(video_output_dir, f"{video_id}.mp4")
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+    # The audio file is written by ffmpeg, it only gets committed to the cache after ffmpeg succeeded
+    audio_partial_path = media_cache.partial_path(audio_path) if audio_path else None
+    proxy_partial_path = media_cache.partial_path(proxy_path) if proxy_path else None
+    if proxy_path:
+        os.makedirs(os.path.dirname(proxy_path), exist_ok=True)
+
+    ffmpeg = subprocess.Popen(
+        _audio_extraction_command('pipe:0', audio_partial_path, proxy_partial_path),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    # Both outputs are drained in the background, otherwise a full pipe would stall ffmpeg and the download
+    stdout, stderr = [], []
+    readers = [
+        threading.Thread(target=_drain, args=(ffmpeg.stdout, stdout), daemon=True),
+        threading.Thread(target=_drain, args=(ffmpeg.stderr, stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    ffmpeg_alive = True
+    try:
+        vxlog.info(f"Streaming MP4 for {video_id} → {local_path} and ffmpeg")
+        with _http.get(mp4_url, stream=True, timeout=30) as dl:
+            dl.raise_for_status()
+            with media_cache.atomic_write(local_path) as partial_path:
+                with open(partial_path, 'wb') as f:
+                    for chunk in dl.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if not chunk:
+                            continue
+                        f.write(chunk)
+                        if ffmpeg_alive:
+                            try:
+                                ffmpeg.stdin.write(chunk)
+                            except BrokenPipeError:
+                                # ffmpeg gave up on the stream, keep downloading and decode the file afterwards
+                                ffmpeg_alive = False
+    except Exception:
+        _remove_partials(audio_partial_path, proxy_partial_path)
+        raise
+    finally:
+        try:
+            ffmpeg.stdin.close()
+        except BrokenPipeError:
+            pass
+        ffmpeg.wait()
+        for reader in readers:
+            reader.join()
+
+    if ffmpeg.returncode != 0:
+        _remove_partials(audio_partial_path, proxy_partial_path)
+
+        # MP4s with the moov atom at the end cannot be decoded from a pipe
+        vxlog.warning(f"Streaming audio extraction failed for {video_id}, decoding the downloaded file instead: {stderr[0].decode(errors='replace')[-500:]}")
+        if audio_path:
+            extract_audio(local_path, audio_path, proxy_path)
+            return local_path, None
+        return local_path, extract_pcm(local_path, proxy_path)
+
+    if proxy_path:
+        media_cache.commit(proxy_partial_path, proxy_path)
+
+    if audio_path:
+        media_cache.commit(audio_partial_path, audio_path)
+        vxlog.info(f"Successfully extracted audio to: {audio_path}")
+        return local_path, None
+
+    pcm = from_s16le(stdout[0])
+    vxlog.info(f"Successfully extracted {len(pcm) / 16000:.1f}s of audio into memory")
+    return local_path, pcm
+
+
+def _remove_partials(*paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def extract_audio(video_path: str, audio_path: str, proxy_path: str = None):
+    os.makedirs(os.path.dirname(audio_path), exist_ok=True)
+    try:
+        with media_cache.atomic_write(audio_path) as partial_path:
+            _run_extraction(video_path, partial_path, proxy_path)
+        vxlog.info(f"Successfully extracted audio to: {audio_path}")
+    except subprocess.CalledProcessError as e:
+        vxlog.error(f"Failed to extract audio with FFmpeg: {e.stderr.decode(errors='replace')}")
+        raise
+
+
+# Only the proxy, for videos whose audio was already extracted before the proxy existed
+def extract_proxy(video_path: str, proxy_path: str):
+    os.makedirs(os.path.dirname(proxy_path), exist_ok=True)
+    try:
+        with media_cache.atomic_write(proxy_path) as partial_path:
+            subprocess.run(['ffmpeg', '-y', '-i', video_path] + _proxy_output_args(partial_path), check=True, capture_output=True)
+        vxlog.info(f"Successfully wrote the analysis proxy to: {proxy_path}")
+    except subprocess.CalledProcessError as e:
+        vxlog.warning(f"Could not write the analysis proxy for {video_path}: {e.stderr.decode(errors='replace')[-500:]}")
+
+
 def tiktok_full(video_id: str):
     video_url = f"https://www.tiktok.com/@placeholder/video/{video_id}"
-    
+
     try:
         # My ip got banned so i cant use youtubeDL to download the mp4
 
@@ -84,37 +301,73 @@ def tiktok_full(video_id: str):
         #     else:
         #         vxlog.info(f"Video {video_id} is already downloaded to {video_path}. Skipping")
 
-        
         video_path = os.path.join(video_output_dir, f"{video_id}.mp4")
-        if not os.path.exists(video_path):
+        audio_path = os.path.join(audio_output_dir, f"{video_id}.wav")
+        proxy_path = proxy_path_for(video_id)
+
+        video_cached = media_cache.get(video_path) is not None
+
+        if not video_cached and STREAMING_DOWNLOAD:
+            # Download and audio extraction overlap
+            os.makedirs(audio_output_dir, exist_ok=True)
+            video_path, _ = tiktok_api_video_streaming(video_id, audio_path, proxy_path)
+            return video_url, video_path, audio_path, _cached_proxy(proxy_path)
+
+        if not video_cached:
             # Fetch video via RapidAPI helper
             video_path = tiktok_api_video(video_id)
-    
-        # Extract audio from the local file
-        audio_path = os.path.join(audio_output_dir, f"{video_id}.wav")
-        
-        if not os.path.exists(audio_path):
-            command = [
-                'ffmpeg',
-                '-i', video_path,
-                '-vn', # no video
-                '-acodec', 'pcm_s16le', # wav format
-                '-ar', '16000', 
-                '-ac', '1', # mono channel
-                audio_path
-            ]
-            
-            try:
-                subprocess.run(command, check=True, capture_output=True, text=True)
-                vxlog.info(f"Successfully extracted audio to: {audio_path}")
-            except subprocess.CalledProcessError as e:
-                vxlog.error(f"Failed to extract audio with FFmpeg: {e.stderr}")
-                raise
+
+        missing_proxy_path = proxy_path if proxy_path and not media_cache.get(proxy_path) else None
+
+        # Extract audio (and the proxy) from the local file
+        if not media_cache.get(audio_path):
+            extract_audio(video_path, audio_path, missing_proxy_path)
         else:
             vxlog.info(f"Audio {video_id} is already downloaded. Skipping")
-        
-        return video_url, video_path, audio_path
+            if missing_proxy_path:
+                extract_proxy(video_path, missing_proxy_path)
+
+        return video_url, video_path, audio_path, _cached_proxy(proxy_path)
+
+    except Exception as e:
+        vxlog.error(f"Failed during download/extraction for video_id: {video_id}: {e}")
+        raise
+
+
+# Decodes the audio track straight to 16 kHz mono float32 samples in memory, no WAV is written
+def extract_pcm(video_path: str, proxy_path: str = None) -> np.ndarray:
+    try:
+        process = _run_extraction(video_path, proxy_path=proxy_path)
+    except subprocess.CalledProcessError as e:
+        vxlog.error(f"Failed to extract audio with FFmpeg: {e.stderr.decode(errors='replace')}")
+        raise
+
+    pcm = from_s16le(process.stdout)
+    vxlog.info(f"Successfully extracted {len(pcm) / 16000:.1f}s of audio into memory")
+    return pcm
+
+
+# Same as tiktok_full but the audio is returned as a PCM buffer instead of a WAV file
+def tiktok_full_pcm(video_id: str):
+    video_url = f"https://www.tiktok.com/@placeholder/video/{video_id}"
+
+    try:
+        video_path = os.path.join(video_output_dir, f"{video_id}.mp4")
+        proxy_path = proxy_path_for(video_id)
+
+        video_cached = media_cache.get(video_path) is not None
+
+        if not video_cached and STREAMING_DOWNLOAD:
+            video_path, pcm = tiktok_api_video_streaming(video_id, proxy_path=proxy_path)
+            return video_url, video_path, pcm, _cached_proxy(proxy_path)
+
+        if not video_cached:
+            video_path = tiktok_api_video(video_id)
+
+        missing_proxy_path = proxy_path if proxy_path and not media_cache.get(proxy_path) else None
+        pcm = extract_pcm(video_path, missing_proxy_path)
+        return video_url, video_path, pcm, _cached_proxy(proxy_path)
 
     except Exception as e:
         vxlog.error(f"Failed during download/extraction for video_id: {video_id}: {e}")
-        raise
\ No newline at end of file
+        raise
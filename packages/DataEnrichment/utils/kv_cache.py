@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils import vxlog
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+kv_cache_dir = os.path.abspath(os.path.join(script_dir, "../tmp/cache"))
+
+# Entries are only trimmed back to max_entries every this many writes
+_EVICT_EVERY = 100
+
+
+class KVCache:
+    """
+    Persistent key -> JSON value cache in a SQLite file under tmp/cache, shared by all worker
+    processes on the host. Entries expire after ttl_seconds and the least recently used ones are
+    dropped above max_entries. Hit and miss counters are kept per process.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl_seconds: float = None):
+        self.name = name
+        self.path = os.path.join(kv_cache_dir, f"{name}.sqlite")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    # SQLite connections can not be shared between threads or across a fork, every thread of every
+    # process opens its own on first use
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        os.makedirs(kv_cache_dir, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL,
+                last_used REAL NOT NULL
+            )
+        """)
+        connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key: str):
+        now = time.time()
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] is not None and row[1] < now:
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            vxlog.warning(f"Cache {self.name} lookup failed: {e}")
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    # ttl_seconds overrides the cache wide TTL for this entry
+    def set(self, key: str, value, ttl_seconds: float = None):
+        now = time.time()
+        ttl_seconds = ttl_seconds if ttl_seconds is not None else self.ttl_seconds
+        expires_at = now + ttl_seconds if ttl_seconds else None
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+        except sqlite3.Error as e:
+            vxlog.warning(f"Cache {self.name} write failed: {e}")
+            return
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % _EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def delete(self, key: str):
+        try:
+            self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            vxlog.warning(f"Cache {self.name} delete failed: {e}")
+
+    def evict(self):
+        try:
+            connection = self._connection()
+            expired = connection.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),)).rowcount
+            # Least recently used entries over the limit
+            overflow = connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            ).rowcount
+        except sqlite3.Error as e:
+            vxlog.warning(f"Cache {self.name} eviction failed: {e}")
+            return
+
+        if expired or overflow:
+            vxlog.info(f"Cache {self.name} evicted {expired} expired and {overflow} least recently used entries. {self.stats()}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from utils import vxlog
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+media_cache_dir = os.path.abspath(os.path.join(script_dir, "../tmp"))
+
+# Disk quota for everything under tmp/video, tmp/audio and tmp/proxy
+MEDIA_CACHE_MAX_BYTES = int(float(os.getenv("MEDIA_CACHE_MAX_MB", "5120")) * 1024 * 1024)
+# Files not used for this long are evicted even when the cache is under quota
+MEDIA_CACHE_MAX_AGE_HOURS = float(os.getenv("MEDIA_CACHE_MAX_AGE_HOURS", "72"))
+# Re-hash files before reuse, otherwise only the size is checked against the manifest
+MEDIA_CACHE_VERIFY_HASH = os.getenv("MEDIA_CACHE_VERIFY_HASH", "false").lower() in ("1", "true", "yes")
+# Pins of named holders (batch backfills) outlive their process and expire after this long
+MEDIA_CACHE_PIN_HOURS = float(os.getenv("MEDIA_CACHE_PIN_HOURS", "48"))
+
+# Subdirectories of tmp/ managed by the cache
+MEDIA_KINDS = ["video", "audio", "proxy"]
+
+MANIFEST_SUFFIX = ".meta.json"
+PARTIAL_MARKER = ".part-"
+PIN_MARKER = ".pin-"
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _MediaCache:
+    """
+    Bounded cache for downloaded videos and extracted audio. Every file has a manifest next to it
+    with its size and sha256, written right before the file is atomically renamed into place, so a
+    file at its final path always has its manifest and a file without one is a leftover that is never
+    reused. The manifest mtime tracks the last use and drives LRU eviction.
+
+    Pins are marker files next to the pinned file, so the eviction of every worker process on the
+    host respects them. A marker of a process holds while that process is alive, a marker of a
+    named holder until it is older than MEDIA_CACHE_PIN_HOURS.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        # Pins per marker in this process, the marker is removed with the last unpin
+        self._pin_counts = Counter()
+        self._lock = threading.Lock()
+
+    def path(self, kind: str, name: str) -> str:
+        directory = os.path.join(self.root, kind)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    # Returns the path when a complete, verified file is cached, removes it when it is not
+    def get(self, path: str):
+        # The file is checked before the manifest, a commit writes them in the opposite order
+        if not os.path.exists(path):
+            return None
+        manifest = self._read_manifest(path)
+        if manifest is None:
+            vxlog.warning(f"Discarding cached file without a manifest: {path}")
+            self.remove(path)
+            return None
+
+        if os.path.getsize(path) != manifest.get("size") or (MEDIA_CACHE_VERIFY_HASH and file_sha256(path) != manifest.get("sha256")):
+            vxlog.warning(f"Discarding corrupt cached file: {path}")
+            self.remove(path)
+            return None
+
+        # Bump the last use for LRU eviction
+        os.utime(path + MANIFEST_SUFFIX)
+        return path
+
+    def content_hash(self, path: str):
+        manifest = self._read_manifest(path)
+        if manifest is None:
+            return None
+        return manifest.get("sha256")
+
+    # Temporary path for a file that is committed to `path` later
+    def partial_path(self, path: str) -> str:
+        root, extension = os.path.splitext(path)
+        # The extension is kept so that ffmpeg can still infer the output format
+        return f"{root}{PARTIAL_MARKER}{os.getpid()}-{threading.get_ident()}{extension}"
+
+    # Yields a temporary path to write to, the file only appears at `path` once the block succeeds
+    @contextmanager
+    def atomic_write(self, path: str):
+        partial_path = self.partial_path(path)
+        try:
+            yield partial_path
+            self.commit(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def commit(self, partial_path: str, path: str):
+        manifest = {
+            "size": os.path.getsize(partial_path),
+            "sha256": file_sha256(partial_path),
+            "created_at": time.time(),
+        }
+        manifest_partial = f"{path}{MANIFEST_SUFFIX}{PARTIAL_MARKER}{os.getpid()}-{threading.get_ident()}"
+        with open(manifest_partial, "w") as f:
+            json.dump(manifest, f)
+
+        # The manifest goes in place before the file, a get() in between finds no file and leaves both alone.
+        # An old file is dropped first so the new manifest never describes it
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        os.replace(manifest_partial, path + MANIFEST_SUFFIX)
+        os.replace(partial_path, path)
+
+    def remove(self, path: str):
+        for candidate in (path, path + MANIFEST_SUFFIX):
+            try:
+                os.remove(candidate)
+            except FileNotFoundError:
+                pass
+
+    # Pinned files belong to jobs in progress and are never evicted. The holder defaults to this process
+    def pin(self, *paths, holder: str = None):
+        with self._lock:
+            for path in paths:
+                if not path:
+                    continue
+                marker = self._pin_marker(path, holder)
+                self._pin_counts[marker] += 1
+                # Touching an existing marker renews the lease of a named holder
+                with open(marker, "a"):
+                    os.utime(marker)
+
+    def unpin(self, *paths, holder: str = None):
+        with self._lock:
+            for path in paths:
+                if not path:
+                    continue
+                marker = self._pin_marker(path, holder)
+                self._pin_counts[marker] -= 1
+                if self._pin_counts[marker] > 0:
+                    continue
+                del self._pin_counts[marker]
+                try:
+                    os.remove(marker)
+                except FileNotFoundError:
+                    pass
+
+    def _pin_marker(self, path: str, holder: str = None) -> str:
+        return f"{path}{PIN_MARKER}{holder or os.getpid()}"
+
+    # Whether a pin marker still holds, stale markers are removed
+    def _pin_holds(self, marker: str, now: float) -> bool:
+        holder = marker.rsplit(PIN_MARKER, 1)[1]
+        if holder.isdigit():
+            held = _process_alive(int(holder))
+        else:
+            try:
+                held = now - os.stat(marker).st_mtime < MEDIA_CACHE_PIN_HOURS * 3600
+            except FileNotFoundError:
+                return False
+        if not held:
+            try:
+                os.remove(marker)
+            except FileNotFoundError:
+                pass
+        return held
+
+    def evict(self, max_bytes: int = MEDIA_CACHE_MAX_BYTES, max_age_hours: float = MEDIA_CACHE_MAX_AGE_HOURS):
+        now = time.time()
+        entries = []
+        total_bytes = 0
+
+        for kind in MEDIA_KINDS:
+            directory = os.path.join(self.root, kind)
+            if not os.path.isdir(directory):
+                continue
+
+            names = os.listdir(directory)
+            pinned = set()
+            for name in names:
+                if PIN_MARKER in name and self._pin_holds(os.path.join(directory, name), now):
+                    pinned.add(name.rsplit(PIN_MARKER, 1)[0])
+
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.endswith(MANIFEST_SUFFIX) or PIN_MARKER in name or name in pinned:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                # Leftovers of writes that crashed
+                if PARTIAL_MARKER in name:
+                    if now - stat.st_mtime > 3600:
+                        self.remove(path)
+                    continue
+
+                manifest_path = path + MANIFEST_SUFFIX
+                last_used = os.stat(manifest_path).st_mtime if os.path.exists(manifest_path) else stat.st_mtime
+                entries.append((last_used, stat.st_size, path))
+                total_bytes += stat.st_size
+
+        entries.sort()
+        evicted, freed = 0, 0
+        for last_used, size, path in entries:
+            expired = now - last_used > max_age_hours * 3600
+            if not expired and total_bytes - freed <= max_bytes:
+                break
+            self.remove(path)
+            evicted += 1
+            freed += size
+
+        if evicted:
+            vxlog.info(f"Evicted {evicted} cached media files ({freed / 1024 / 1024:.1f} MB)")
+
+    def _read_manifest(self, path: str):
+        try:
+            with open(path + MANIFEST_SUFFIX) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+media_cache = _MediaCache(media_cache_dir)
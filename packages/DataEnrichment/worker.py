@@ -1,13 +1,21 @@
-import AudioProcessor, VideoProcessor, db
+import AudioProcessor, VideoProcessor, Deduplicator, db
 import redis
 import os
 import json
+import argparse
+import signal
+import threading
 import AlignmentCalculator
+from AlignmentCalculator import prescan
 
 from utils.get_video_description import get_video_description
 from utils import download
 from utils.download import RapidAPITiktokDownloaderError, VideoUnavailableError
+from utils.media_cache import media_cache
 from VideoProcessor.gemini import GEMINI_MODEL_NAME
+from pipeline import Pipeline, Stage
+from queues import RedisStreamQueue, PostgresLeaseQueue
+from supervisor import Supervisor
 
 import sqlQueries
 from utils import vxlog
@@ -17,112 +25,393 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 ENRICHMENT_QUEUE_CHANNEL = "enrichment_queue"
 
-def process(video_id: str, db_conn):
-    video_path, audio_path = None, None
-    cleanup_files = True 
+# Worker threads per pipeline stage and the size of the queue in front of each stage
+PIPELINE_DOWNLOAD_WORKERS = int(os.getenv("PIPELINE_DOWNLOAD_WORKERS", "2"))
+PIPELINE_AUDIO_WORKERS = int(os.getenv("PIPELINE_AUDIO_WORKERS", "1"))
+PIPELINE_ANALYSIS_WORKERS = int(os.getenv("PIPELINE_ANALYSIS_WORKERS", "2"))
+PIPELINE_STORE_WORKERS = int(os.getenv("PIPELINE_STORE_WORKERS", "1"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+
+# Decode the audio into memory and transcribe from the buffer instead of writing a WAV to tmp/audio
+AUDIO_STREAMING = os.getenv("AUDIO_STREAMING", "false").lower() in ("1", "true", "yes")
+
+# Statuses written to enrichment_data by store_step, only jobs with one of them are acknowledged
+RECORDED_STATUSES = ('completed', 'failed', 'deleted')
+
+# Set on SIGTERM/SIGINT, the consumers stop taking new videos and the current ones are finished
+_shutdown = threading.Event()
+
+
+# Holds the intermediate results of a single video while it moves through the enrichment steps
+class EnrichmentJob:
+    def __init__(self, video_id: str):
+        self.video_id = video_id
+        self.video_path = None
+        # Low resolution copy of the video sent to Gemini, None when it could not be made
+        self.proxy_path = None
+        self.audio_path = None
+        self.audio_pcm = None
+        self.transcript = None
+        self.lang = None
+        self.text_sentiment_analysis = None
+        self.sentiment_timeline = None
+        self.speech_ratio = None
+        self.whisper_model = None
+        # Set when the video is a near-duplicate of an enriched video, its results are copied instead
+        self.duplicate_of = None
+        self.description = None
+        # Knowledge base entries mentioned in the description or transcript
+        self.prescan_hits = None
+        self.analysis_result_json = None
+        self.status = None
+        self.error = None
+        # Queue specific handle used to acknowledge the job once it is done
+        self.receipt = None
+
+    def __repr__(self):
+        return f"EnrichmentJob({self.video_id})"
+
+
+def download_step(job: EnrichmentJob, db_conn=None):
+    vxlog.info("Starting data enrichment process for video_id: %s", job.video_id)
+
+    # Download the video and extract the audio
+    if AUDIO_STREAMING:
+        video_url, job.video_path, job.audio_pcm, job.proxy_path = download.tiktok_full_pcm(job.video_id)
+    else:
+        video_url, job.video_path, job.audio_path, job.proxy_path = download.tiktok_full(job.video_id)
+
+    # Keep the cache eviction of other jobs away from the files while this job uses them
+    media_cache.pin(job.video_path, job.audio_path, job.proxy_path)
+
+
+def fingerprint_step(job: EnrichmentJob, db_conn):
+    if not Deduplicator.DEDUP_ENABLED:
+        return
 
     try:
-        vxlog.info("Starting data enrichment process for video_id: %s", video_id)
+        pcm = job.audio_pcm if job.audio_pcm is not None else AudioProcessor.read_wav(job.audio_path)
+        fingerprint = Deduplicator.compute_fingerprint(pcm, job.video_path)
+        job.duplicate_of = Deduplicator.find_duplicate(db_conn, job.video_id, fingerprint)
+        Deduplicator.register(db_conn, job.video_id, fingerprint)
+    except Exception as e:
+        # Deduplication only saves work, the video is enriched normally when it fails
+        db_conn.rollback()
+        vxlog.warning(f"Fingerprinting failed for video_id: {job.video_id}: {e}")
+
+
+def audio_step(job: EnrichmentJob, db_conn=None):
+    if job.duplicate_of is not None:
+        job.audio_pcm = None
+        return
+
+    audio = job.audio_pcm if job.audio_pcm is not None else job.audio_path
+    audio_result = AudioProcessor.process(audio)
+    job.transcript = audio_result["transcript"]
+    job.lang = audio_result["lang"]
+    job.text_sentiment_analysis = audio_result["sentiment"]
+    job.sentiment_timeline = audio_result["sentiment_timeline"]
+    job.speech_ratio = audio_result["speech_ratio"]
+    job.whisper_model = audio_result["whisper_model"]
+    # The buffer is not needed by the later stages, free it while the job waits in their queues
+    job.audio_pcm = None
 
-        # Download the contentSentyment model
-        video_url, video_path, audio_path = download.tiktok_full(video_id)
 
-        # Run the Processors
-        transcript, lang, text_sentiment_analysis = AudioProcessor.process(audio_path)
+def analysis_step(job: EnrichmentJob, db_conn):
+    if job.duplicate_of is not None:
+        return
 
-        description = get_video_description(video_id, db_conn)
+    job.description = get_video_description(job.video_id, db_conn)
 
-        analysis_result_json = VideoProcessor.process(video_path, video_id, transcript, text_sentiment_analysis, description)
+    job.prescan_hits = prescan.scan(job.description, job.transcript)
+
+    job.analysis_result_json = VideoProcessor.process(job.proxy_path or job.video_path, job.video_id, job.transcript, job.text_sentiment_analysis, job.description, job.prescan_hits, job.video_path)
+
+    if job.analysis_result_json is None:
+        raise RuntimeError(f"Video analysis returned no result for video_id: {job.video_id}")
+
+
+def store_step(job: EnrichmentJob, db_conn):
+    try:
+        if job.error is not None:
+            raise job.error
 
-        positive_sentiment = text_sentiment_analysis["positive"]
-        negative_sentiment = text_sentiment_analysis["negative"]
-        neutral_sentiment = text_sentiment_analysis["neutral"]
+        if job.duplicate_of is not None:
+            if not Deduplicator.copy_enrichment(db_conn, job.video_id, job.duplicate_of):
+                raise RuntimeError(f"Near-duplicate {job.duplicate_of} of {job.video_id} is no longer completed")
+            vxlog.success(f"Copied the enrichment of {job.duplicate_of} to {job.video_id}")
+            job.status = 'completed'
+            return
+
+        positive_sentiment = job.text_sentiment_analysis["positive"]
+        negative_sentiment = job.text_sentiment_analysis["negative"]
+        neutral_sentiment = job.text_sentiment_analysis["neutral"]
 
         polarity = positive_sentiment - negative_sentiment
 
-        llm_summary = analysis_result_json["summary"]
-        identified_subjects = analysis_result_json["identified_subjects"] 
-        llm_overall_alignment = analysis_result_json["overall_alignment"]
+        llm_summary = job.analysis_result_json["summary"]
+        identified_subjects = job.analysis_result_json["identified_subjects"]
+        llm_overall_alignment = job.analysis_result_json["overall_alignment"]
 
         final_alignment, deterministic_alignment, alignment_conflict = AlignmentCalculator.calculate(
-            identified_subjects, 
-            llm_overall_alignment, 
-            alpha=0.5
+            identified_subjects,
+            llm_overall_alignment,
+            alpha=0.5,
+            prescan_hits=job.prescan_hits
         )
 
         # Upload to database
         with db_conn.cursor() as cur:
             cur.execute(sqlQueries.UPDATE_SUCCESSFUL_ENRICHMENT_QUERY,
                 (
-                    video_id, transcript, lang, 'completed',
+                    job.video_id, job.transcript, job.lang, 'completed',
                     llm_summary, json.dumps(identified_subjects), llm_overall_alignment, GEMINI_MODEL_NAME,
                     final_alignment, deterministic_alignment, alignment_conflict,
-                    positive_sentiment, negative_sentiment, neutral_sentiment, polarity
+                    positive_sentiment, negative_sentiment, neutral_sentiment, polarity,
+                    job.speech_ratio, job.whisper_model, job.sentiment_timeline
                 )
             )
             db_conn.commit()
             vxlog.success(f"Successfully committed to database")
+        job.status = 'completed'
 
     # if video is deleted from tiktok set the status to "deleted"
     except VideoUnavailableError as e:
         vxlog.warning(f"{e}")
-        db_conn.rollback()
-        with db_conn.cursor() as cur:
-            cur.execute(sqlQueries.UPDATE_ENRICHMENT_STATUS_ON_FAILURE_QUERY, (video_id, 'deleted'))
-            db_conn.commit()
-        cleanup_files = False  # Skip cleanup to retain files for debugging
-    
+        _record_failure(job, 'deleted', db_conn)
+
     # If the api is down or there are issues with api key
     # except RapidAPITiktokDownloaderError as e:
     #     vxlog.error(f"{e}")
     #     db_conn.rollback()
 
-
     except Exception as e:
-        vxlog.error(f"Enrichment failed for video_id: {video_id} with error: {e}")
-        db_conn.rollback()
-        with db_conn.cursor() as cur:
-            cur.execute(sqlQueries.UPDATE_ENRICHMENT_STATUS_ON_FAILURE_QUERY, (video_id, 'failed'))
-            db_conn.commit()
-        cleanup_files = False  # Skip cleanup to retain files for debugging
+        vxlog.error(f"Enrichment failed for video_id: {job.video_id} with error: {e}")
+        _record_failure(job, 'failed', db_conn)
     finally:
-        # Remove the temporary audio and video files only if processing succeeded
-        if cleanup_files:
-            try:
-                if video_path and os.path.exists(video_path):
-                    os.remove(video_path)
-                if audio_path and os.path.exists(audio_path):
-                    os.remove(audio_path)
-            except OSError as e:
-                vxlog.error(f"Error removing temporary files: {e}")
-        else:
-            vxlog.info(f"Skipping cleanup becuase the enrichment failed for video {video_id}")
+        cleanup_step(job)
 
-def main():
-    vxlog.info("Data Enrichment is starting up")
 
-    db_conn = db.get_connection()
+def _record_failure(job: EnrichmentJob, status: str, db_conn):
+    db_conn.rollback()
+    with db_conn.cursor() as cur:
+        cur.execute(sqlQueries.UPDATE_ENRICHMENT_STATUS_ON_FAILURE_QUERY, (job.video_id, status))
+        db_conn.commit()
+    job.status = status
 
-    redis_client = redis.from_url(REDIS_URL, db=0, decode_responses=True)
+
+def cleanup_step(job: EnrichmentJob):
+    media_cache.unpin(job.video_path, job.audio_path, job.proxy_path)
+
+    # Remove the temporary audio and video files only if processing succeeded
+    if job.status == 'completed':
+        try:
+            if job.video_path:
+                media_cache.remove(job.video_path)
+            if job.audio_path:
+                media_cache.remove(job.audio_path)
+            if job.proxy_path:
+                media_cache.remove(job.proxy_path)
+        except OSError as e:
+            vxlog.error(f"Error removing temporary files: {e}")
+    else:
+        # Skip cleanup to retain files for debugging, the media cache quota bounds how much is kept
+        vxlog.info(f"Skipping cleanup becuase the enrichment failed for video {job.video_id}")
+
+    try:
+        media_cache.evict()
+    except OSError as e:
+        vxlog.error(f"Error evicting cached media: {e}")
+
+
+def process(video_id: str, db_conn):
+    return run_job(EnrichmentJob(video_id), db_conn)
+
+
+def run_job(job: EnrichmentJob, db_conn):
+    for step in (download_step, fingerprint_step, audio_step, analysis_step):
+        try:
+            step(job, db_conn)
+        except Exception as e:
+            job.error = e
+            break
+
+    store_step(job, db_conn)
+    return job.status
+
+
+# Staged version of process() where several videos can be in different steps at once
+def build_pipeline(on_done=None) -> Pipeline:
+    stages = [
+        Stage("download", download_step, workers=PIPELINE_DOWNLOAD_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage("fingerprint", fingerprint_step, workers=PIPELINE_DOWNLOAD_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, needs_db=True),
+        Stage("audio", audio_step, workers=PIPELINE_AUDIO_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage("analysis", analysis_step, workers=PIPELINE_ANALYSIS_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, needs_db=True),
+        Stage("store", store_step, workers=PIPELINE_STORE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, needs_db=True, handles_errors=True),
+    ]
+    return Pipeline(stages, connection_factory=db.get_connection, on_done=on_done)
+
+
+def consume_pubsub(redis_client, handle):
     pubsub = redis_client.pubsub()
     pubsub.subscribe(ENRICHMENT_QUEUE_CHANNEL)
     vxlog.info(f"Subscribed to Redis channel: '{ENRICHMENT_QUEUE_CHANNEL}'")
 
     try:
-        for payload in pubsub.listen():
-            if payload['type'] == "message":
-                video_id = payload['data']
-                process(video_id, db_conn)
+        while not _shutdown.is_set():
+            payload = pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if payload and payload['type'] == "message":
+                handle(EnrichmentJob(payload['data']))
+    finally:
+        pubsub.close()
+
+
+# Consumes a durable queue (RedisStreamQueue or PostgresLeaseQueue), jobs carry the receipt used for the ack
+def consume_queue(work_queue, handle):
+    vxlog.info(f"Consuming work queue {type(work_queue).__name__}")
+
+    while not _shutdown.is_set():
+        for message_id, video_id in work_queue.read():
+            if not video_id:
+                work_queue.dead_letter(message_id, video_id, "entry has no video_id")
+                continue
+
+            job = EnrichmentJob(video_id)
+            job.receipt = message_id
+            handle(job)
+
+
+def run_worker(args, worker_slot: int = 0):
+    db_conn = None
+    enrichment_pipeline = None
+    work_queue = None
+
+    # Connections are created here and not at import time so that forked workers never share a socket
+    redis_client = redis.from_url(REDIS_URL, db=0, decode_responses=True)
+
+    schema_conn = db.get_connection()
+    try:
+        db.ensure_schema(schema_conn)
+    finally:
+        schema_conn.close()
+
+    if args.queue == 'stream':
+        work_queue = RedisStreamQueue(redis_client)
+        work_queue.ensure_group()
+    elif args.queue == 'postgres':
+        work_queue = PostgresLeaseQueue(db.get_connection)
+        work_queue.ensure_schema()
+
+    def request_shutdown(signum, frame):
+        vxlog.info(f"Worker {worker_slot} received signal {signum}, finishing current videos")
+        _shutdown.set()
+        if isinstance(work_queue, PostgresLeaseQueue):
+            work_queue.stop()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    # Jobs are only acknowledged after their outcome is stored. Anything else, a crash or a failure
+    # that could not be recorded, stays pending so the queue redelivers it and counts the attempt
+    def on_done(job: EnrichmentJob):
+        if not work_queue or job.receipt is None:
+            return
+        if job.status in RECORDED_STATUSES:
+            work_queue.ack(job.receipt)
+        else:
+            vxlog.warning(f"No outcome recorded for video_id: {job.video_id}, leaving {job.receipt} for redelivery")
+
+    if args.pipeline:
+        enrichment_pipeline = build_pipeline(on_done=on_done)
+        enrichment_pipeline.start()
+    else:
+        db_conn = db.get_connection()
+
+    # Videos waiting for this process, drives the whisper model selection
+    def queue_depth():
+        depth = enrichment_pipeline.depth() if enrichment_pipeline else 0
+        if work_queue:
+            depth += work_queue.depth() / max(1, args.workers)
+        return depth
+
+    AudioProcessor.ModelPolicy.set_queue_depth_source(queue_depth)
+
+    def handle(job: EnrichmentJob):
+        nonlocal db_conn
+        if enrichment_pipeline:
+            enrichment_pipeline.submit(job)
+            return
+
+        try:
+            run_job(job, db_conn)
+        except Exception as e:
+            # Recording the outcome failed, the connection is replaced and the job left unacknowledged
+            vxlog.error(f"Could not record the outcome of video_id: {job.video_id}: {e}")
+            db_conn.close()
+            db_conn = db.get_connection()
+        on_done(job)
+
+    try:
+        if work_queue:
+            consume_queue(work_queue, handle)
+        else:
+            consume_pubsub(redis_client, handle)
 
     except KeyboardInterrupt:
         vxlog.info("KeyboardInterrupt shutting down DataEnrichment Server")
     except Exception as e:
         vxlog.error(f"DataEnrichment critical error {e}")
+        raise
     finally:
+        if enrichment_pipeline:
+            enrichment_pipeline.close()
+        if isinstance(work_queue, PostgresLeaseQueue):
+            work_queue.close()
         if db_conn:
             db_conn.close()
-        pubsub.close()
+        AudioProcessor.SentimentAnalyzer.loaded_models.log_usage()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Run the enrichment steps as a staged pipeline so several videos are processed at once'
+    )
+    parser.add_argument(
+        '--queue',
+        choices=['pubsub', 'stream', 'postgres'],
+        default='pubsub',
+        help='pubsub listens on the enrichment_queue channel, stream consumes the durable Redis stream with acks, '
+             'postgres claims unprocessed videos with leases in the database'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of forked worker processes sharing the preloaded models, requires --queue stream or postgres'
+    )
+    args = parser.parse_args()
+
+    vxlog.info("Data Enrichment is starting up")
+
+    if args.workers <= 1:
+        run_worker(args)
+        return
+
+    # Every pub/sub subscriber receives every message, so several workers would enrich each video N times
+    if args.queue == 'pubsub':
+        parser.error("--workers > 1 requires --queue stream or --queue postgres")
+
+    # Load the models once in the supervisor, the forked workers share the weights copy-on-write
+    AudioProcessor.SentimentAnalyzer.preload()
+
+    def child_main(worker_slot: int):
+        AudioProcessor.SentimentAnalyzer.limit_threads((os.cpu_count() or 1) // args.workers)
+        run_worker(args, worker_slot)
+
+    Supervisor(args.workers, child_main).run()
 
 if __name__ == "__main__":
     main()
-
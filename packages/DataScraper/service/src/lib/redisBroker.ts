@@ -31,8 +31,25 @@ async function publish(channel: string, message: string) {
     await publisher.publish(channel, message);
 }
 
+// Durable counterpart of publish, entries stay in the stream until a consumer group acks them
+const STREAM_MAX_LENGTH = 100_000;
+
+async function enqueue(stream: string, fields: Record<string, string>) {
+    if (!publisher.isOpen) {
+        await connect();
+    }
+    await publisher.xAdd(stream, '*', fields, {
+        TRIM: {
+            strategy: 'MAXLEN',
+            strategyModifier: '~',
+            threshold: STREAM_MAX_LENGTH
+        }
+    });
+}
+
 export const redisBroker = {
     connect,
     disconnect,
     publish,
+    enqueue,
 }; 
\ No newline at end of file
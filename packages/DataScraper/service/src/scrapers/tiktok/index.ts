@@ -219,6 +219,7 @@ export class TiktokScraper extends AbstractScraper {
             await DatabaseManager.saveVideo(extractedVideoPageData);
 
             await redisBroker.publish('enrichment_queue', extractedVideoPageData.video_id);
+            await redisBroker.enqueue('enrichment_stream', { video_id: extractedVideoPageData.video_id });
 
             statusManager
                 .updateStep("data_persistence", "active", `Saved video ${extractedVideoPageData.video_id} and its ${extractedVideoPageData.comments.length} comments`)